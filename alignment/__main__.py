@@ -1,13 +1,21 @@
+import math
 import os
+import argparse
 import base64
 
 from aiohttp import web
 from structlog import get_logger
 
 from alignment.discord_user import DiscordUserHandler
+from alignment.images import ImageProxyHandler
 from alignment.websocket import WebsocketHandler
 from alignment.webapp import WebappHandler
+from alignment.bus import LocalBus, RedisBus
+from alignment.metrics import MetricsHandler
+from alignment.prefork import Supervisor
+from alignment.replay import LocalReplayLog, RedisReplayLog
 from alignment.redis import RedisPool
+from alignment.stream import UpdateStream
 
 log = get_logger()
 
@@ -15,13 +23,64 @@ COOKIE_SECRET = base64.urlsafe_b64decode(os.environ['COOKIE_SECRET'])
 OAUTH_CLIENT_ID = os.environ['OAUTH_CLIENT_ID']
 OAUTH_CLIENT_SECRET = os.environ['OAUTH_CLIENT_SECRET']
 REDIRECT_URI = '{}/auth'.format(os.environ['REDIRECT_URI'])
+# One URL, or several comma separated ones to shard rooms across
 REDIS_URL = os.environ['REDIS_URL']
 PORT = int(os.environ.get('PORT', 5000))
 
 REDIS_POOL_MIN = int(os.environ.get('REDIS_POOL_MIN', 5))
 REDIS_POOL_MAX = int(os.environ.get('REDIS_POOL_MAX', 10))
 
-def run():
+# Give every room its own pub/sub channel, so nodes only see their own rooms
+PUBSUB_SHARDED = bool(int(os.environ.get('PUBSUB_SHARDED', 0)))
+
+# Per-websocket outbound queue: drop-oldest, coalesce or disconnect when full
+SEND_QUEUE_SIZE = int(os.environ.get('SEND_QUEUE_SIZE', 256))
+SEND_QUEUE_POLICY = os.environ.get('SEND_QUEUE_POLICY', 'drop-oldest')
+
+# Batch position updates per room every TICK_MS milliseconds (0 to disable)
+TICK_MS = int(os.environ.get('TICK_MS', 0)) or None
+
+# Also append updates to this Redis Stream, for single-writer persistence.
+# A persisting node reads it as UPDATE_STREAM_CONSUMER (the hostname if
+# unset), which should be the same after a restart.
+UPDATE_STREAM = os.environ.get('UPDATE_STREAM')
+UPDATE_STREAM_CONSUMER = os.environ.get('UPDATE_STREAM_CONSUMER')
+
+# 'redis' relays messages between nodes, 'local' only within this process
+MESSAGE_BUS = os.environ.get('MESSAGE_BUS', 'redis')
+
+# Number each room's updates and keep the last REPLAY_SIZE of them, so
+# reconnecting clients can catch up (0 to disable)
+REPLAY_SIZE = int(os.environ.get('REPLAY_SIZE', 0))
+
+# Admission control on /ws: per-websocket messages per second and burst,
+# and websockets per room and per process (0 for no limit)
+WS_RATE = float(os.environ.get('WS_RATE', 100))
+WS_BURST = int(os.environ.get('WS_BURST', 200))
+WS_MAX_ROOM_CONNECTIONS = int(os.environ.get('WS_MAX_ROOM_CONNECTIONS', 0))
+WS_MAX_CONNECTIONS = int(os.environ.get('WS_MAX_CONNECTIONS', 0))
+
+# On shutdown, clients are told to reconnect within RECONNECT_WINDOW seconds
+# and websockets still open after DRAIN_TIMEOUT seconds are closed
+DRAIN_TIMEOUT = float(os.environ.get('DRAIN_TIMEOUT', 10))
+RECONNECT_WINDOW = float(os.environ.get('RECONNECT_WINDOW', 5))
+
+# Serve Prometheus metrics on /metrics; METRICS_TRACE also times every HTTP
+# request and websocket frame
+METRICS = bool(int(os.environ.get('METRICS', 0)))
+METRICS_TRACE = bool(int(os.environ.get('METRICS_TRACE', 0)))
+
+# Proxy and cache images from these hosts on /image, keeping up to
+# IMAGE_CACHE_MB of them in IMAGE_CACHE_DIR
+IMAGE_PROXY_HOSTS = os.environ.get(
+    'IMAGE_PROXY_HOSTS', 'cdn.discordapp.com').split(',')
+IMAGE_CACHE_DIR = os.environ.get('IMAGE_CACHE_DIR', 'image-cache')
+IMAGE_CACHE_MB = int(os.environ.get('IMAGE_CACHE_MB', 256))
+
+# Worker processes sharing the port, each with its own Redis pool
+WORKERS = int(os.environ.get('WORKERS', 1))
+
+def run(sock=None):
     discord_user = DiscordUserHandler(
         cookie_secret=COOKIE_SECRET,
         oauth_client_id=OAUTH_CLIENT_ID,
@@ -33,16 +92,71 @@ def run():
         redis_pool_min=REDIS_POOL_MIN,
         redis_pool_max=REDIS_POOL_MAX)
 
-    websocket = WebsocketHandler()
+    bus = LocalBus() if MESSAGE_BUS == 'local' else RedisBus()
+    update_stream = None
+    if UPDATE_STREAM:
+        update_stream = UpdateStream(
+            UPDATE_STREAM, consumer=UPDATE_STREAM_CONSUMER)
+    replay_log = None
+    if REPLAY_SIZE:
+        replay_class = (
+            LocalReplayLog if MESSAGE_BUS == 'local' else RedisReplayLog)
+        replay_log = replay_class(size=REPLAY_SIZE)
+    websocket = WebsocketHandler(
+        sharded=PUBSUB_SHARDED,
+        send_queue_size=SEND_QUEUE_SIZE,
+        overflow_policy=SEND_QUEUE_POLICY,
+        tick_ms=TICK_MS,
+        update_stream=update_stream,
+        replay_log=replay_log,
+        rate=WS_RATE or None,
+        burst=WS_BURST or None,
+        max_room_connections=WS_MAX_ROOM_CONNECTIONS or None,
+        max_connections=WS_MAX_CONNECTIONS or None,
+        drain_timeout=DRAIN_TIMEOUT,
+        reconnect_window=RECONNECT_WINDOW)
     webapp = WebappHandler()
+    images = ImageProxyHandler(
+        cache_dir=IMAGE_CACHE_DIR,
+        max_cache_bytes=IMAGE_CACHE_MB << 20,
+        allowed_hosts=[host.strip() for host in IMAGE_PROXY_HOSTS])
 
     app = web.Application()
+    if METRICS:
+        MetricsHandler(trace=METRICS_TRACE).setup(app)
     redis_pool.setup(app)
+    bus.setup(app)
     discord_user.setup(app)
     websocket.setup(app)
     webapp.setup(app)
+    # after discord_user, whose HTTP session it shares
+    images.setup(app)
+
+    if sock is not None:
+        web.run_app(app, sock=sock, print=None)
+    else:
+        log.info('starting app', port=PORT)
+        web.run_app(app, host='0.0.0.0', port=PORT)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='alignment')
+    parser.add_argument(
+        '--workers', type=int, default=WORKERS,
+        help='number of worker processes sharing the port')
+    args = parser.parse_args(argv)
 
-    log.info('starting app', port=PORT)
-    web.run_app(app, host='0.0.0.0', port=PORT)
+    if REPLAY_SIZE and ',' in REDIS_URL and not PUBSUB_SHARDED:
+        parser.error('REPLAY_SIZE with several REDIS_URLs needs '
+                     'PUBSUB_SHARDED=1, rooms are published on their shard')
+    if args.workers <= 1:
+        run()
+        return
+    if MESSAGE_BUS == 'local':
+        parser.error('--workers needs MESSAGE_BUS=redis, workers relay '
+                     'messages to each other through Redis')
+    # leave workers time to flush after draining before they're killed
+    Supervisor(run, args.workers, port=PORT,
+               shutdown_timeout=int(math.ceil(DRAIN_TIMEOUT)) + 20).run()
 
-run()
+main()
@@ -6,73 +6,351 @@ from aiohttp import web
 import asyncio
 from structlog import get_logger
 
+from alignment import binary as compact
+from alignment import envelope
+from alignment import metrics
+from alignment.bus import BUS_KEY
+from alignment.limits import validate_update
 from alignment.redis import REDIS_POOL_KEY
 from alignment.room import RoomStore
+from alignment.users import UserRegistry
 
 log = get_logger()
 
 
 class APIHandler:
     PERSIST_KEY = 'persist_task'
+    PERSIST_RECEIVER_KEY = 'persist_receiver'
 
     def __init__(self,
                  pubsub_key='alignment_rooms',
-                 room_persist_prefix='alignment:room'):
+                 room_persist_prefix='alignment:room',
+                 sharded=False,
+                 flush_interval=0.1,
+                 flush_size=1000,
+                 update_stream=None,
+                 replay_log=None,
+                 cache_size=1024,
+                 cache_ttl=5,
+                 room_ttl=None,
+                 position_ttl=None,
+                 page_size=500,
+                 max_batch_size=1000,
+                 drain_timeout=10):
+        """
+        :sharded: must match the :sharded: setting of the WebsocketHandler.
+        Persistence needs every room, so it pattern-subscribes to all of the
+        per-room channels.
+        :flush_interval: and :flush_size: configure RoomStore's write-behind
+        buffer, :cache_size: and :cache_ttl: its room snapshot cache, and
+        :room_ttl: and :position_ttl: how long idle rooms and positions live.
+        The users of up to :cache_size: rooms are kept in memory too, to
+        persist compact protocol positions.
+        :update_stream: an UpdateStream shared with the WebsocketHandler. When
+        given, positions are persisted from the stream's consumer group
+        instead of pub/sub, so each update is written by exactly one node.
+        Each node's cached rooms then only see the updates it persisted
+        itself, and miss the others' for up to :cache_ttl: seconds.
+        :replay_log: the WebsocketHandler's ReplayLog, if it has one, so
+        positions set through the API are numbered and logged like any
+        other update.
+        :page_size: is the most positions read from Redis at once, by the
+        paginated positions endpoint and when streaming a room.
+        :max_batch_size: is the most rooms or positions accepted by a single
+        batch request.
+        On shutdown, messages already received from the bus are persisted
+        and flushed, for up to :drain_timeout: seconds.
+        """
         self.pubsub_key = pubsub_key
         self.room_persist_prefix = room_persist_prefix
+        self.sharded = sharded
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self.update_stream = update_stream
+        self.replay_log = replay_log
+        self.cache_size = cache_size
+        self.cache_ttl = cache_ttl
+        self.room_ttl = room_ttl
+        self.position_ttl = position_ttl
+        self.page_size = page_size
+        self.max_batch_size = max_batch_size
+        self.drain_timeout = drain_timeout
+        self.user_registry = UserRegistry(
+            room_persist_prefix, max_rooms=cache_size)
+        # ids of stream entries persisted but not yet flushed, so not acked
+        self.unacked = []
 
     def setup(self, app):
+        self.room_store = RoomStore(
+            app,
+            self.room_persist_prefix,
+            flush_interval=self.flush_interval,
+            flush_size=self.flush_size,
+            cache_size=self.cache_size,
+            cache_ttl=self.cache_ttl,
+            room_ttl=self.room_ttl,
+            position_ttl=self.position_ttl)
+
+        app.on_startup.append(self.room_store.start)
         app.on_startup.append(self.start_persist_position)
         # app.on_startup.append(self.setup_default_room)
         app.on_shutdown.append(self.end_persist_position)
-
-        self.room_store = RoomStore(app, self.room_persist_prefix)
+        # after the persist loop has stopped adding positions
+        app.on_shutdown.append(self.room_store.stop)
 
         app.router.add_get('/api/v1/room/{room}', self.get, name='room_api')
+        app.router.add_get(
+            '/api/v1/room/{room}/positions', self.get_positions,
+            name='room_positions_api')
         app.router.add_post('/api/v1/room/', self.create)
+        app.router.add_post('/api/v1/rooms/', self.create_batch)
+        app.router.add_post(
+            '/api/v1/room/{room}/positions', self.set_positions)
 
     async def start_persist_position(self, app):
-        app[self.PERSIST_KEY] = app.loop.create_task(self.persist(app))
+        if self.update_stream is not None:
+            persist = self.persist_stream(app)
+        else:
+            persist = self.persist(app)
+        app[self.PERSIST_KEY] = app.loop.create_task(persist)
 
     async def end_persist_position(self, app):
-        app[self.PERSIST_KEY].cancel()
-        await app[self.PERSIST_KEY]
+        task = app[self.PERSIST_KEY]
+        receiver = app.get(self.PERSIST_RECEIVER_KEY)
+        if receiver is not None:
+            # Unsubscribe, which ends the loop once it has persisted what
+            # was received before
+            await app[BUS_KEY].close(receiver)
+            try:
+                await asyncio.wait_for(
+                    asyncio.shield(task, loop=app.loop), self.drain_timeout,
+                    loop=app.loop)
+            except asyncio.TimeoutError:
+                log.warning("gave up persisting received positions")
+        task.cancel()
+        await task
 
     async def persist(self, app):
         """
-        Listen on the Redis channel specified in :pubsub_key: for messages.
-        When they're received, fan them out to all websockets in that room except the websocket that
-        the message originated from (identified by SID)
+        Listen on the bus channel specified in :pubsub_key: (or every per-room
+        channel, when sharded) for messages and persist the positions they
+        carry.
         """
-        redis = app[REDIS_POOL_KEY]
+        bus = app[BUS_KEY]
+        receiver = app[self.PERSIST_RECEIVER_KEY] = bus.receiver()
         try:
-            channel, *_ = await redis.subscribe(self.pubsub_key)
-            async for msg in channel.iter(
-                    encoding='utf-8', decoder=json.loads):
-                room = msg.pop('room', None)
-                if room is None:
-                    log.error("message missing userid or room",)
-                    continue
-
-                user = msg.get('user')
-                position = msg.get('position')
-                msg.pop('sid') # not needed for persistence
-                if user is not None and room is not None:
-                    await self.room_store.set_position(room, user, position)
+            if self.sharded:
+                await bus.psubscribe(receiver, self.pattern)
+            else:
+                await bus.subscribe(receiver, self.pubsub_key)
+            async for msg in receiver:
+                await self.persist_message(msg)
 
         except asyncio.CancelledError:
             pass
         finally:
-            await redis.unsubscribe(self.pubsub_key)
+            await bus.close(receiver)
+
+    async def persist_stream(self, app):
+        """
+        Persist positions from :update_stream:. Entries are acknowledged only
+        once the room store has flushed them to Redis. Our own unacknowledged
+        entries are handled first, and entries abandoned by other consumers
+        are claimed every :claim_idle_ms: of the stream's.
+        """
+        redis = app[REDIS_POOL_KEY]
+        stream = self.update_stream
+        claim_interval = stream.claim_idle_ms / 1000
+        try:
+            await stream.ensure_group(redis)
+            entries = await stream.read_pending(redis)
+            while entries:
+                await self.persist_entries(redis, entries)
+                entries = await stream.read_pending(
+                    redis, after=entries[-1][0])
+            # Blocking reads get a connection of their own so they don't hold
+            # up other commands sharing a pooled connection.
+            with await redis as blocking:
+                next_claim = app.loop.time() + claim_interval
+                while True:
+                    entries = await stream.read_new(blocking)
+                    if app.loop.time() >= next_claim:
+                        entries += await stream.claim_stale(redis)
+                        next_claim = app.loop.time() + claim_interval
+                    await self.persist_entries(redis, entries)
+        except asyncio.CancelledError:
+            pass
+
+    async def persist_entries(self, redis, entries):
+        """
+        Persist a batch of stream entries and acknowledge them once flushed,
+        along with any whose flush failed before.
+        """
+        if not entries and not self.unacked:
+            return
+        for entry_id, data in entries:
+            self.unacked.append(entry_id)
+            if data is None:
+                continue
+            await self.persist_message(data.decode('utf-8'))
+        if await self.room_store.flush():
+            acked, self.unacked = self.unacked, []
+            await self.update_stream.ack(redis, acked)
+
+    async def persist_message(self, data):
+        """
+        Persist the positions carried by an envelope.
+        """
+        try:
+            room, _batch, updates, sent, _seq = envelope.read(data)
+        except envelope.EnvelopeError as e:
+            log.error("malformed envelope", error=str(e))
+            return
+        if sent is not None:
+            metrics.BUS_LAG_SECONDS.observe(
+                max(time.time() - sent, 0), ('persist',))
+
+        for update in updates:
+            if update.sid is None:
+                # published by set_positions, which wrote it already
+                continue
+            if update.kind == envelope.POSITION:
+                await self.persist_compact(room, update)
+                continue
+            if update.kind != envelope.JSON:
+                continue
+            try:
+                decoded = json.loads(update.payload)
+            except ValueError:
+                log.error("undecodable update", room=room)
+                continue
+            user = decoded.get('user')
+            position = decoded.get('position')
+            if user is not None:
+                await self.room_store.set_position(room, user, position)
+
+    async def persist_compact(self, room, update):
+        """
+        Persist a compact protocol position, looking its user up by handle.
+        """
+        handle, x, y = compact.decode_position(update.payload)
+        user = await self.user_registry.lookup(
+            self.room_store.room_redis(room), room, handle)
+        if user is None:
+            log.error("position for unknown user handle", room=room,
+                      handle=handle)
+            return
+        await self.room_store.set_position(
+            room, json.loads(user), {'x': x, 'y': y})
+
+    @property
+    def pattern(self):
+        return self.pubsub_key + ':*'
+
+    def channel_name(self, room):
+        if self.sharded:
+            return '{}:{}'.format(self.pubsub_key, room)
+        return self.pubsub_key
+
+    async def publish_positions(self, app, room, positions, chunk_size=500):
+        """
+        Relay (user, position) pairs written straight to Redis to :room:'s
+        websockets, as one batch envelope per :chunk_size:. Their sid is
+        None, which no websocket has, so persisting skips them.
+        """
+        for start in range(0, len(positions), chunk_size):
+            updates = [
+                envelope.Update(None, user['id'], json.dumps(
+                    {'user': user, 'position': position}))
+                for user, position in positions[start:start + chunk_size]]
+            data = envelope.pack(room, updates, batch=True, sent=time.time())
+            if self.replay_log is not None:
+                await self.replay_log.publish(
+                    app, self.channel_name(room), room, data)
+            else:
+                await app[BUS_KEY].publish(
+                    self.channel_name(room), data,
+                    room=room if self.sharded else None)
 
 
     async def get(self, request):
+        """
+        The room as JSON. With ``?stream=1`` it's streamed instead, its
+        positions written out a page at a time as they're read from Redis,
+        for rooms too large to hold in memory at once.
+        """
         name = request.match_info['room']
-        room = await self.room_store.get_room(name)
+        if request.query.get('stream') == '1':
+            return await self.stream(request, name)
+        room = await self.room_store.get_snapshot(name)
         if room is None:
             raise web.HTTPNotFound
 
-        return web.json_response(room)
+        headers = {'ETag': room.etag, 'Cache-Control': 'no-cache'}
+        if_none_match = request.headers.get('If-None-Match', '')
+        if room.etag in (tag.strip() for tag in if_none_match.split(',')):
+            return web.Response(status=304, headers=headers)
+
+        return web.Response(
+            text=room.to_json(),
+            content_type='application/json',
+            headers=headers)
+
+    async def stream(self, request, name):
+        meta = await self.room_store.get_meta(name)
+        if meta is None:
+            raise web.HTTPNotFound
+        image, size = meta
+
+        resp = web.StreamResponse(headers={'Cache-Control': 'no-cache'})
+        resp.content_type = 'application/json'
+        resp.enable_chunked_encoding()
+        await resp.prepare(request)
+        await resp.write('{{"image": {}, "size": {}, "positions": ['.format(
+            json.dumps(image), size).encode('utf-8'))
+        separator = ''
+        cursor = None
+        while True:
+            page, cursor = await self.room_store.get_positions_page(
+                name, cursor, self.page_size)
+            if page:
+                await resp.write(
+                    (separator + ', '.join(page)).encode('utf-8'))
+                separator = ', '
+            if cursor is None:
+                break
+        await resp.write(b']}')
+        await resp.write_eof()
+        return resp
+
+    async def get_positions(self, request):
+        """
+        A page of a room's positions, least recently updated first, as
+        ``{"positions": [...], "next": cursor}``. Pass ``next`` back as
+        ``?cursor=`` for the following page; it's null after the last one.
+        ``?limit=`` asks for fewer than :page_size: positions per page.
+        """
+        name = request.match_info['room']
+        cursor = request.query.get('cursor')
+        try:
+            limit = min(int(request.query.get('limit', self.page_size)),
+                        self.page_size)
+            if limit < 1:
+                raise ValueError(limit)
+            if cursor is not None:
+                self.room_store.parse_cursor(cursor)
+        except ValueError:
+            raise web.HTTPBadRequest(text='invalid cursor or limit parameter')
+        if cursor is None and await self.room_store.get_meta(name) is None:
+            raise web.HTTPNotFound
+
+        page, cursor = await self.room_store.get_positions_page(
+            name, cursor, limit)
+        return web.Response(
+            text='{{"positions": [{}], "next": {}}}'.format(
+                ', '.join(page), json.dumps(cursor)),
+            content_type='application/json',
+            headers={'Cache-Control': 'no-cache'})
 
     async def create(self, request):
         body = await request.json()
@@ -81,7 +359,9 @@ class APIHandler:
             raise web.HTTPBadRequest(text='missing image parameter')
         room = str(uuid.uuid4())
         await self.room_store.create_room(room, image)
+        return web.json_response(self.room_urls(request, room))
 
+    def room_urls(self, request, room):
         resp = {
             'room': room,
             'api_url': str(request.app.router['room_api'].url_for(room=room))
@@ -90,5 +370,91 @@ class APIHandler:
         room_app = request.app.router.get('app')
         if room_app is not None:
             resp['app_url'] = str(room_app.url_for(room=room).with_fragment(room))
+        return resp
 
-        return web.json_response(resp)
+    async def read_batch(self, request, field):
+        """The list in the :field: of a batch request's JSON body"""
+        try:
+            body = await request.json()
+        except ValueError:
+            raise web.HTTPBadRequest(text='body is not JSON')
+        items = body.get(field) if isinstance(body, dict) else None
+        if not isinstance(items, list):
+            raise web.HTTPBadRequest(text='missing {} list'.format(field))
+        if len(items) > self.max_batch_size:
+            raise web.HTTPRequestEntityTooLarge(
+                text='at most {} {} per request'.format(
+                    self.max_batch_size, field))
+        return items
+
+    async def create_batch(self, request):
+        """
+        Create many rooms from ``{"rooms": [{"image": .., "size": ..}, ..]}``.
+        Responds with ``{"rooms": [..]}``, holding for each room in turn
+        what creating it alone would, or ``{"error": ..}``.
+        """
+        items = await self.read_batch(request, 'rooms')
+        results = [None] * len(items)
+        rooms = []
+        for i, item in enumerate(items):
+            if not isinstance(item, dict) or not isinstance(
+                    item.get('image'), str):
+                results[i] = {'error': 'missing image parameter'}
+                continue
+            size = item.get('size')
+            if size is not None and (
+                    not isinstance(size, int) or isinstance(size, bool)
+                    or size < 1):
+                results[i] = {'error': 'invalid size parameter'}
+                continue
+            rooms.append((i, (str(uuid.uuid4()), item['image'], size)))
+
+        errors = await self.room_store.create_rooms(
+            [room for _i, room in rooms])
+        for (i, (name, _image, _size)), error in zip(rooms, errors):
+            if error is not None:
+                log.error("failed to create room", room=name,
+                          error=str(error))
+                results[i] = {'error': 'failed to create room'}
+            else:
+                results[i] = self.room_urls(request, name)
+        return web.json_response({'rooms': results})
+
+    async def set_positions(self, request):
+        """
+        Upsert many positions in a room from ``{"positions": [{"user": ..,
+        "position": ..}, ..]}``. Responds with ``{"positions": [..]}``,
+        holding ``{"ok": true}`` or ``{"error": ..}`` for each in turn.
+        """
+        name = request.match_info['room']
+        items = await self.read_batch(request, 'positions')
+        if await self.room_store.get_meta(name) is None:
+            raise web.HTTPNotFound
+
+        results = [None] * len(items)
+        positions = []
+        for i, item in enumerate(items):
+            error = validate_update(item)
+            if error is None and 'user' not in item:
+                error = 'missing user'
+            if error is not None:
+                results[i] = {'error': error}
+                continue
+            positions.append((i, (item['user'], item['position'])))
+
+        errors = await self.room_store.set_positions(
+            name, [position for _i, position in positions])
+        written = []
+        for (i, position), error in zip(positions, errors):
+            if error is not None:
+                log.error("failed to set position", room=name,
+                          error=str(error))
+                results[i] = {'error': 'failed to set position'}
+            else:
+                results[i] = {'ok': True}
+                written.append(position)
+        try:
+            await self.publish_positions(request.app, name, written)
+        except Exception:
+            log.exception("failed to publish positions", room=name)
+        return web.json_response({'positions': results})
@@ -0,0 +1,62 @@
+"""
+The compact websocket sub-protocol.
+
+Clients negotiate it by requesting the PROTOCOL websocket sub-protocol. They
+then register the users they are going to move with a text frame:
+
+    {"register": [{"id": "11358", "username": ...}, ...]}
+
+and receive each user's room-wide numeric handle back:
+
+    {"handles": {"11358": 7, ...}}
+
+From then on a position update is a binary frame holding one or more 12 byte
+records: the handle as an unsigned 32 bit integer followed by x and y as 32
+bit floats, all big-endian. Updates the server can't express that way are
+still delivered to these clients as JSON text frames.
+"""
+import struct
+
+PROTOCOL = 'alignment.bin.v1'
+
+RECORD = struct.Struct('!Iff')
+
+
+class ProtocolError(ValueError):
+    """A binary frame that isn't a whole number of records"""
+
+
+def pack(handle, x, y):
+    return RECORD.pack(handle, x, y)
+
+
+def unpack(data):
+    """Split a binary frame into a list of (handle, x, y)"""
+    if not data or len(data) % RECORD.size:
+        raise ProtocolError('frame length {} is not a multiple of {}'.format(
+            len(data), RECORD.size))
+    return list(RECORD.iter_unpack(data))
+
+
+def encode_position(handle, x, y):
+    """The envelope payload of a compact position update"""
+    return '{} {:g} {:g}'.format(handle, x, y)
+
+
+def decode_position(payload):
+    handle, x, y = payload.split(' ')
+    return int(handle), _number(x), _number(y)
+
+
+def _number(value):
+    value = float(value)
+    return int(value) if value.is_integer() else value
+
+
+def position_json(user, x, y):
+    """
+    The JSON protocol equivalent of a compact position update, given the
+    user's encoded JSON.
+    """
+    return '{{"user": {}, "position": {{"x": {:g}, "y": {:g}}}}}'.format(
+        user, x, y)
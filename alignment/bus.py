@@ -0,0 +1,229 @@
+import abc
+from collections import defaultdict
+from fnmatch import fnmatchcase
+
+import asyncio
+from aioredis.pubsub import Receiver
+from structlog import get_logger
+
+from alignment.redis import REDIS_POOL_KEY, REDIS_SHARDS_KEY
+
+log = get_logger()
+
+BUS_KEY = 'message_bus'
+
+
+class BusReceiver:
+    """
+    The messages delivered to one subscriber, in order.
+    Iterate over it to read them; iteration ends once it's closed.
+    """
+
+    def __init__(self, loop):
+        self._queue = asyncio.Queue(loop=loop)
+        self.channels = set()
+        self.patterns = set()
+
+    def put(self, data):
+        self._queue.put_nowait(data)
+
+    def stop(self):
+        self._queue.put_nowait(None)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        data = await self._queue.get()
+        if data is None:
+            raise StopAsyncIteration
+        return data
+
+
+class MessageBus(abc.ABC):
+    """
+    Publish/subscribe for room envelopes.
+
+    Subscribers get a BusReceiver and (un)subscribe it to channels or glob
+    patterns. The bus keeps track of which local receivers want which
+    channels; subclasses decide how published messages reach them.
+
+    A channel that carries a single room's messages is published and
+    subscribed to with that :room:, so a sharded bus can route it to the
+    room's shard.
+    """
+
+    def __init__(self):
+        self.loop = None
+        self._channels = defaultdict(set)
+        self._patterns = defaultdict(set)
+
+    def setup(self, app):
+        app[BUS_KEY] = self
+        app.on_startup.append(self.start)
+        # First, so a RedisBus stops reading before its pools are closed,
+        # whichever order the two were set up in.
+        app.on_cleanup.insert(0, self.stop)
+
+    async def start(self, app):
+        self.loop = app.loop
+
+    async def stop(self, app):
+        pass
+
+    def receiver(self):
+        return BusReceiver(self.loop)
+
+    @abc.abstractmethod
+    async def publish(self, channel, data, room=None):
+        """Send :data: to the receivers of :channel:, on every node"""
+
+    async def subscribe(self, receiver, channel, room=None):
+        first = not self._channels.get(channel)
+        self._channels[channel].add(receiver)
+        receiver.channels.add(channel)
+        if first:
+            await self._subscribe(channel, room)
+
+    async def unsubscribe(self, receiver, channel):
+        receiver.channels.discard(channel)
+        subscribers = self._channels.get(channel)
+        if subscribers is None:
+            return
+        subscribers.discard(receiver)
+        if not subscribers:
+            del self._channels[channel]
+            await self._unsubscribe(channel)
+
+    async def psubscribe(self, receiver, pattern):
+        first = not self._patterns.get(pattern)
+        self._patterns[pattern].add(receiver)
+        receiver.patterns.add(pattern)
+        if first:
+            await self._psubscribe(pattern)
+
+    async def punsubscribe(self, receiver, pattern):
+        receiver.patterns.discard(pattern)
+        subscribers = self._patterns.get(pattern)
+        if subscribers is None:
+            return
+        subscribers.discard(receiver)
+        if not subscribers:
+            del self._patterns[pattern]
+            await self._punsubscribe(pattern)
+
+    async def close(self, receiver):
+        """Drop all of :receiver:'s subscriptions and end its iteration"""
+        for channel in list(receiver.channels):
+            await self.unsubscribe(receiver, channel)
+        for pattern in list(receiver.patterns):
+            await self.punsubscribe(receiver, pattern)
+        receiver.stop()
+
+    def deliver(self, channel, data):
+        """Hand :data: to the receivers subscribed to :channel: itself"""
+        for receiver in self._channels.get(channel, ()):
+            receiver.put(data)
+
+    def deliver_pattern(self, pattern, data):
+        """Hand :data: to the receivers subscribed to :pattern:"""
+        for receiver in self._patterns.get(pattern, ()):
+            receiver.put(data)
+
+    # Hooks for subclasses, called when the first local receiver subscribes
+    # to something or the last one unsubscribes.
+
+    async def _subscribe(self, channel, room):
+        pass
+
+    async def _unsubscribe(self, channel):
+        pass
+
+    async def _psubscribe(self, pattern):
+        pass
+
+    async def _punsubscribe(self, pattern):
+        pass
+
+
+class LocalBus(MessageBus):
+    """
+    An in-process bus for single node deployments: published messages are
+    handed straight to local receivers without a Redis round trip.
+    """
+
+    async def publish(self, channel, data, room=None):
+        self.deliver(channel, data)
+        for pattern in list(self._patterns):
+            if fnmatchcase(channel, pattern):
+                self.deliver_pattern(pattern, data)
+
+
+class RedisBus(MessageBus):
+    """
+    A bus over Redis pub/sub, so messages reach every node. A single Redis
+    subscription per channel or pattern is shared by all local receivers.
+
+    With several Redis shards, a room's channel lives on the room's shard
+    and other channels on the first one. Patterns are subscribed to on every
+    shard, with one reader per shard feeding the local receivers.
+    """
+
+    async def start(self, app):
+        await super().start(app)
+        self.redis = app[REDIS_POOL_KEY]
+        self.shards = app.get(REDIS_SHARDS_KEY)
+        pools = [self.redis] if self.shards is None else self.shards.pools
+        self._receivers = {}
+        self._readers = []
+        for pool in pools:
+            # Never stop a receiver when it runs out of channels, a node can
+            # legitimately have no subscriptions for a while.
+            receiver = Receiver(
+                loop=app.loop, on_close=lambda *args, **kwargs: None)
+            self._receivers[pool] = receiver
+            self._readers.append(app.loop.create_task(self._read(receiver)))
+        # channel -> the pool it's subscribed on
+        self._routes = {}
+
+    async def stop(self, app):
+        for reader in self._readers:
+            reader.cancel()
+            await reader
+        for receiver in self._receivers.values():
+            receiver.stop()
+
+    def _pool(self, room):
+        if room is None or self.shards is None:
+            return self.redis
+        return self.shards.for_room(room)
+
+    async def _read(self, receiver):
+        try:
+            async for channel, msg in receiver.iter(encoding='utf-8'):
+                name = channel.name.decode('utf-8')
+                if channel.is_pattern:
+                    _dest, msg = msg
+                    self.deliver_pattern(name, msg)
+                else:
+                    self.deliver(name, msg)
+        except asyncio.CancelledError:
+            pass
+
+    async def publish(self, channel, data, room=None):
+        await self._pool(room).publish(channel, data)
+
+    async def _subscribe(self, channel, room):
+        pool = self._routes[channel] = self._pool(room)
+        await pool.subscribe(self._receivers[pool].channel(channel))
+
+    async def _unsubscribe(self, channel):
+        await self._routes.pop(channel, self.redis).unsubscribe(channel)
+
+    async def _psubscribe(self, pattern):
+        for pool, receiver in self._receivers.items():
+            await pool.psubscribe(receiver.pattern(pattern))
+
+    async def _punsubscribe(self, pattern):
+        for pool in self._receivers:
+            await pool.punsubscribe(pattern)
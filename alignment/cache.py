@@ -0,0 +1,57 @@
+import time
+from collections import OrderedDict
+
+import asyncio
+
+
+class CoalescingCache:
+    """
+    A size-bounded cache of coroutine results that expire after :ttl:
+    seconds. Concurrent misses for the same key share a single call, so a
+    burst of requests only ever causes one upstream fetch.
+    """
+
+    def __init__(self, ttl, maxsize=1024, loop=None):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.loop = loop
+        self._entries = OrderedDict()
+        self._inflight = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    async def get(self, key, fetch):
+        """
+        Return the cached value for :key:, otherwise await :fetch:() (or join
+        a fetch already in progress) and cache its result. Failures are not
+        cached.
+        """
+        entry = self._entries.get(key)
+        if entry is not None:
+            expires, value = entry
+            if expires > time.monotonic():
+                self._entries.move_to_end(key)
+                return value
+            del self._entries[key]
+
+        inflight = self._inflight.get(key)
+        if inflight is None:
+            inflight = asyncio.ensure_future(
+                self._fetch(key, fetch), loop=self.loop)
+            self._inflight[key] = inflight
+        # one waiter giving up mustn't cancel the fetch for everyone else
+        return await asyncio.shield(inflight, loop=self.loop)
+
+    def invalidate(self, key):
+        self._entries.pop(key, None)
+
+    async def _fetch(self, key, fetch):
+        try:
+            value = await fetch()
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+            return value
+        finally:
+            self._inflight.pop(key, None)
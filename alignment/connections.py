@@ -0,0 +1,79 @@
+class ConnectionRegistry:
+    """
+    The connections on this node, by room and by sid.
+
+    Each room is an insertion-ordered set of connections (a dict with None
+    values), so adding and removing are O(1), and is dropped as soon as it
+    empties, so rooms that come and go leave nothing behind. Looking up a
+    room never creates it.
+
+    in_room() returns a tuple that is safe to iterate while connections come
+    and go. It is cached until the room next changes, so fanning out many
+    updates to a busy room doesn't copy it every time.
+    """
+
+    def __init__(self):
+        self._rooms = {}
+        self._snapshots = {}
+        self._sids = {}
+        self._count = 0
+
+    def add(self, room, connection):
+        """Register :connection:, which must have a ``sid``, in :room:"""
+        connections = self._rooms.setdefault(room, {})
+        if connection not in connections:
+            connections[connection] = None
+            self._count += 1
+        self._snapshots.pop(room, None)
+        self._sids[connection.sid] = connection
+
+    def remove(self, room, connection):
+        """
+        Unregister :connection: from :room:, returning whether that left the
+        room empty.
+        """
+        connections = self._rooms.get(room)
+        if connections is None:
+            return True
+        if connection in connections:
+            del connections[connection]
+            self._count -= 1
+        self._snapshots.pop(room, None)
+        if self._sids.get(connection.sid) is connection:
+            del self._sids[connection.sid]
+        if connections:
+            return False
+        del self._rooms[room]
+        return True
+
+    def in_room(self, room):
+        """The connections in :room:, oldest first"""
+        snapshot = self._snapshots.get(room)
+        if snapshot is None:
+            connections = self._rooms.get(room)
+            if connections is None:
+                return ()
+            snapshot = self._snapshots[room] = tuple(connections)
+        return snapshot
+
+    def count(self, room):
+        return len(self._rooms.get(room, ()))
+
+    def get(self, sid):
+        """The latest connection with :sid:, or None"""
+        return self._sids.get(sid)
+
+    def rooms(self):
+        return list(self._rooms)
+
+    def __contains__(self, room):
+        return room in self._rooms
+
+    def __iter__(self):
+        """Every connection, as of when iteration starts"""
+        return iter([
+            connection for connections in list(self._rooms.values())
+            for connection in connections])
+
+    def __len__(self):
+        return self._count
@@ -1,11 +1,15 @@
 import uuid
 
+import aiohttp
 from aiohttp import web
 from aiohttp_session.cookie_storage import EncryptedCookieStorage
 import aiohttp_session
 
+from alignment.cache import CoalescingCache
 from alignment.discordclient import DiscordClient
 
+HTTP_SESSION_KEY = 'http_session'
+
 
 class DiscordUserHandler:
     STATE_KEY = 'state'
@@ -17,12 +21,28 @@ class DiscordUserHandler:
                  oauth_client_secret,
                  redirect_uri,
                  landing='/app',
+                 user_info_ttl=300,
+                 user_info_cache_size=10000,
+                 http_pool_size=100,
+                 discord_client_class=DiscordClient,
     ):
+        """
+        Discord's answer to /me is cached per access token for
+        :user_info_ttl: seconds. All requests to Discord share one pooled
+        HTTP session of up to :http_pool_size: connections, which is also
+        available to other handlers as app[HTTP_SESSION_KEY].
+        """
         self.cookie_secret = cookie_secret
         self.oauth_client_id = oauth_client_id
         self.oauth_client_secret = oauth_client_secret
         self.redirect_uri = redirect_uri
         self.landing = landing
+        self.user_info_ttl = user_info_ttl
+        self.user_info_cache_size = user_info_cache_size
+        self.http_pool_size = http_pool_size
+        self.discord_client_class = discord_client_class
+        self.http_session = None
+        self.user_info_cache = None
 
     def setup(self, app):
         aiohttp_session.setup(app, EncryptedCookieStorage(self.cookie_secret))
@@ -30,12 +50,42 @@ class DiscordUserHandler:
         app.router.add_get('/auth', self.auth)
         app.router.add_get('/me', self.user_info)
 
+        app.on_startup.append(self.start_http_session)
+        app.on_cleanup.append(self.close_http_session)
+
+    async def start_http_session(self, app):
+        self.http_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=self.http_pool_size, loop=app.loop),
+            loop=app.loop)
+        app[HTTP_SESSION_KEY] = self.http_session
+        self.user_info_cache = CoalescingCache(
+            ttl=self.user_info_ttl,
+            maxsize=self.user_info_cache_size,
+            loop=app.loop)
+
+    async def close_http_session(self, app):
+        if self.http_session is not None:
+            await self.http_session.close()
+
     def discord_client(self, **kwargs):
-        return DiscordClient(
+        return self.discord_client_class(
             client_id=self.oauth_client_id,
             client_secret=self.oauth_client_secret,
+            session=self.http_session,
             **kwargs)
 
+    async def fetch_user_info(self, token):
+        """
+        Discord's user info for :token:, cached. Concurrent lookups for the
+        same token share one request.
+        """
+        async def fetch():
+            discord = self.discord_client(access_token=token)
+            _user, userDict = await discord.user_info()
+            return userDict
+        return await self.user_info_cache.get(token, fetch)
+
     async def root(self, request):
         session = await aiohttp_session.get_session(request)
         state = str(uuid.uuid4())
@@ -69,6 +119,5 @@ class DiscordUserHandler:
         token = session[self.ACCESS_TOKEN_KEY]
         if not token:
             raise web.HTTPFound('/')
-        discord = self.discord_client(access_token=token)
-        _user, userDict = await discord.user_info()
+        userDict = await self.fetch_user_info(token)
         return web.json_response(userDict)
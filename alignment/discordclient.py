@@ -1,4 +1,13 @@
+from urllib.parse import parse_qsl
+
+import asyncio
+import async_timeout
 from aioauth_client import OAuth2Client
+from aiohttp import web
+from structlog import get_logger
+
+log = get_logger()
+
 
 class DiscordClient(OAuth2Client):
     access_token_url = 'https://discordapp.com/api/oauth2/token'
@@ -7,6 +16,22 @@ class DiscordClient(OAuth2Client):
     name = 'discord'
     user_info_url = 'https://discordapp.com/api/v6/users/@me'
 
+    def __init__(self, *args, session=None, max_retries=3, timeout=10,
+                 max_retry_delay=30, **kwargs):
+        """
+        :session: a shared aiohttp ClientSession to make requests with.
+        Without one, every request opens (and closes) its own session.
+        Rate limited (429) requests are retried up to :max_retries: times,
+        waiting as long as Discord asks but no more than :max_retry_delay:
+        seconds. Each attempt has its own :timeout:, which the waits don't
+        count towards.
+        """
+        super().__init__(*args, **kwargs)
+        self.session = session
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.max_retry_delay = max_retry_delay
+
     @staticmethod
     def user_parse(data):
         yield 'id', data.get('id')
@@ -23,3 +48,50 @@ class DiscordClient(OAuth2Client):
             headers['Authorization'] = "Bearer {}".format(self.access_token)
 
         return self._request(method, url, headers=headers, **aio_kwargs)
+
+    async def _request(self, method, url, loop=None, timeout=None, **kwargs):
+        """Make a request through the shared session, backing off on 429s"""
+        if self.session is None:
+            return await super()._request(
+                method, url, loop=loop, timeout=timeout, **kwargs)
+
+        timeout = timeout or self.timeout
+        for attempt in range(self.max_retries + 1):
+            try:
+                with async_timeout.timeout(timeout, loop=loop):
+                    async with self.session.request(
+                            method, url, **kwargs) as response:
+                        if (response.status == 429
+                                and attempt < self.max_retries):
+                            delay = await self.retry_after(response)
+                        elif response.status >= 300:
+                            raise web.HTTPBadRequest(
+                                reason='HTTP status code: %s' % response.status)
+                        elif 'json' in response.headers.get(
+                                'CONTENT-TYPE', ''):
+                            return await response.json()
+                        else:
+                            return dict(parse_qsl(await response.text()))
+            except asyncio.TimeoutError:
+                raise web.HTTPBadRequest(reason='HTTP timeout')
+            # waited out with the connection released
+            delay = min(delay, self.max_retry_delay)
+            log.warning("discord rate limited", url=url, retry_after=delay)
+            await asyncio.sleep(delay, loop=loop)
+
+    @staticmethod
+    async def retry_after(response):
+        """
+        Seconds to wait before retrying a rate limited request. Discord puts
+        milliseconds in the body's retry_after, HTTP puts seconds in the
+        Retry-After header.
+        """
+        try:
+            body = await response.json()
+            return float(body['retry_after']) / 1000
+        except Exception:
+            pass
+        try:
+            return float(response.headers.get('Retry-After', 1))
+        except ValueError:
+            return 1.0
@@ -0,0 +1,88 @@
+"""
+Room updates travel over Redis in an envelope: a one line JSON header naming
+the room and, for every update, the sid of the websocket it came from, its
+coalescing key and its length, followed by the updates exactly as the clients
+sent them. The updates themselves are never decoded or re-encoded on their
+way to other websockets.
+"""
+import json
+from collections import namedtuple
+
+# Kinds of update payload
+JSON = 'json'  # a JSON protocol message, as sent by the client
+POSITION = 'pos'  # a compact protocol position: "handle x y"
+USER = 'user'  # a compact protocol registration: {"handle": .., "user": ..}
+
+Update = namedtuple('Update', ['sid', 'key', 'payload', 'kind'])
+Update.__new__.__defaults__ = (JSON,)
+
+Envelope = namedtuple('Envelope', ['room', 'batch', 'updates', 'sent', 'seq'])
+
+
+class EnvelopeError(ValueError):
+    """The data is not a well-formed envelope"""
+
+
+def pack(room, updates, batch=False, sent=None):
+    """
+    Wrap :updates: for :room:. A :batch: is delivered to websockets as a
+    single JSON list, otherwise there should be exactly one update.
+    :sent: is the publish time (time.time()), for measuring bus lag.
+    """
+    header = {
+        'room': room,
+        'updates': [
+            [u.sid, u.key, len(u.payload)] + ([u.kind] if u.kind != JSON else [])
+            for u in updates
+        ],
+    }
+    if batch:
+        header['batch'] = True
+    if sent is not None:
+        header['sent'] = round(sent, 4)
+    return '{}\n{}'.format(
+        json.dumps(header, separators=(',', ':')),
+        ''.join(u.payload for u in updates))
+
+
+def unpack(data):
+    """
+    Split an envelope into (room, batch, [Update, ...]).
+    """
+    return read(data)[:3]
+
+
+def read(data):
+    """
+    Split an envelope into an Envelope; sent and seq are None if they weren't
+    recorded.
+    """
+    head, _, body = data.partition('\n')
+    try:
+        header = json.loads(head)
+        room = header['room']
+        updates = []
+        offset = 0
+        for sid, key, length, *kind in header['updates']:
+            updates.append(Update(
+                sid, key, body[offset:offset + length], *kind))
+            offset += length
+    except (ValueError, KeyError, TypeError) as e:
+        raise EnvelopeError(str(e))
+    if offset != len(body):
+        raise EnvelopeError('envelope length mismatch')
+    return Envelope(
+        room, header.get('batch', False), updates, header.get('sent'),
+        header.get('seq'))
+
+
+def sequence(data, seq):
+    """
+    Add the room sequence number :seq: to an already packed envelope.
+    """
+    return '{{"seq":{},{}'.format(seq, data[1:])
+
+
+def frame(payloads):
+    """A websocket frame delivering JSON :payloads: as a list"""
+    return '[{}]'.format(','.join(payloads))
@@ -0,0 +1,347 @@
+"""
+A caching proxy for the avatars and room images clients display, so each is
+fetched from its origin once rather than by every browser in every room.
+"""
+import hashlib
+import io
+import os
+import re
+import time
+from collections import OrderedDict
+from functools import partial
+
+import aiohttp
+import asyncio
+from aiohttp import web
+from PIL import Image
+from structlog import get_logger
+from yarl import URL
+
+from alignment import metrics
+from alignment.cache import CoalescingCache
+from alignment.discord_user import HTTP_SESSION_KEY
+
+log = get_logger()
+
+CACHE_CONTROL = 'public, max-age=604800'
+# types served, with the extension their files are stored under
+IMAGE_TYPES = {
+    'image/png': '.png',
+    'image/jpeg': '.jpg',
+    'image/gif': '.gif',
+    'image/webp': '.webp',
+}
+# what resized variants are saved as; GIFs may be animated, so aren't resized
+RESIZE_FORMATS = {'.png': 'PNG', '.jpg': 'JPEG', '.webp': 'WEBP'}
+ORIGINAL = 'orig'
+# names of the files the cache writes; anything else in the directory is
+# left alone
+CACHE_FILE = re.compile(
+    r'^(?P<key>[0-9a-f]{64})\.(?P<variant>orig|\d+)'
+    r'(?P<ext>\.(?:png|jpg|gif|webp))$')
+
+
+class FetchError(Exception):
+    """The origin didn't return an image the proxy is willing to serve"""
+
+
+class CachedImage:
+    """
+    An image in the disk cache: the files of the original and of its resized
+    variants, by variant.
+    """
+
+    def __init__(self, key, ext):
+        self.key = key
+        self.ext = ext
+        # variant -> (path, bytes)
+        self.files = {}
+        # whether resized variants have been made (there may be none, if the
+        # image is small already)
+        self.resized = False
+
+    @property
+    def size(self):
+        return sum(size for _path, size in self.files.values())
+
+
+def resize_image(data, ext, sizes, max_pixels):
+    """
+    {size: encoded image} for :data: shrunk to fit each of :sizes:, leaving
+    out the sizes it fits already.
+    """
+    if ext not in RESIZE_FORMATS:
+        return {}
+    with Image.open(io.BytesIO(data)) as image:
+        if image.width * image.height > max_pixels:
+            return {}
+        image.load()
+        variants = {}
+        for size in sizes:
+            if max(image.size) <= size:
+                continue
+            variant = image.copy()
+            variant.thumbnail((size, size), Image.LANCZOS)
+            encoded = io.BytesIO()
+            variant.save(encoded, RESIZE_FORMATS[ext])
+            variants[size] = encoded.getvalue()
+        return variants
+
+
+class ImageProxyHandler:
+    def __init__(self,
+                 cache_dir='image-cache',
+                 max_cache_bytes=256 << 20,
+                 allowed_hosts=('cdn.discordapp.com',),
+                 allowed_schemes=('https',),
+                 sizes=(32, 64, 128),
+                 max_image_bytes=4 << 20,
+                 max_pixels=4096 * 4096,
+                 fetch_timeout=10):
+        """
+        Serves ``/image?url=...&size=...``: the image at url, fetched once
+        through the shared HTTP session (app[HTTP_SESSION_KEY]) and kept in
+        :cache_dir:. The cache holds up to :max_cache_bytes:, evicting the
+        least recently used images first. Concurrent misses for an image
+        share one fetch. Worker processes may share :cache_dir:, each
+        keeping to its own budget.
+
+        Only :allowed_schemes: URLs on :allowed_hosts: are fetched and
+        redirects aren't followed, so the proxy can't be pointed at internal
+        services. Anything but a PNG, JPEG, GIF or WebP image of up to
+        :max_image_bytes: is refused.
+
+        The first request with a size also resizes the image to each of
+        :sizes:; a size is served the smallest variant at least that large.
+        """
+        self.cache_dir = cache_dir
+        self.max_cache_bytes = max_cache_bytes
+        self.allowed_hosts = {host.lower() for host in allowed_hosts}
+        self.allowed_schemes = set(allowed_schemes)
+        self.sizes = sorted(sizes)
+        self.max_image_bytes = max_image_bytes
+        self.max_pixels = max_pixels
+        self.fetch_timeout = fetch_timeout
+        self.loop = None
+        self.session = None
+        self.own_session = None
+        self.fetches = None
+        # key -> CachedImage, least recently used first
+        self.index = OrderedDict()
+        self.cache_bytes = 0
+
+    def setup(self, app):
+        app.on_startup.append(self.start)
+        app.on_cleanup.append(self.stop)
+        app.router.add_get('/image', self.get_image, name='image')
+
+    async def start(self, app):
+        self.loop = app.loop
+        self.session = app.get(HTTP_SESSION_KEY)
+        if self.session is None:
+            self.session = self.own_session = aiohttp.ClientSession(
+                loop=app.loop)
+        # only shares fetches in progress; the disk cache keeps the results
+        self.fetches = CoalescingCache(ttl=0, maxsize=0, loop=app.loop)
+        await app.loop.run_in_executor(None, self.load_index)
+        log.info('loaded image cache', images=len(self.index),
+                 bytes=self.cache_bytes)
+
+    async def stop(self, app):
+        if self.own_session is not None:
+            await self.own_session.close()
+
+    def load_index(self):
+        """Rebuild the index from the files in the cache, oldest first"""
+        os.makedirs(self.cache_dir, exist_ok=True)
+        files = []
+        now = time.time()
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if name.endswith('.tmp') and CACHE_FILE.match(name[:-4]):
+                # Another worker may be writing it; only one left behind by
+                # a crash is old.
+                try:
+                    if now - os.stat(path).st_mtime > self.fetch_timeout:
+                        os.remove(path)
+                except FileNotFoundError:
+                    pass
+                continue
+            match = CACHE_FILE.match(name)
+            if match is None:
+                continue
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, match.group('key'),
+                          match.group('variant'), match.group('ext'), path,
+                          stat.st_size))
+        for _mtime, key, variant, ext, path, size in sorted(files):
+            entry = self.index.get(key)
+            if entry is None:
+                entry = self.index[key] = CachedImage(key, ext)
+            entry.files[variant] = (path, size)
+            entry.resized = entry.resized or variant != ORIGINAL
+            self.cache_bytes += size
+        for key, entry in list(self.index.items()):
+            if ORIGINAL not in entry.files:
+                self.cache_bytes -= entry.size
+                self.remove_files(self.index.pop(key))
+        self.evict()
+
+    def check_url(self, url):
+        if not url:
+            raise web.HTTPBadRequest(text='missing url parameter')
+        try:
+            target = URL(url)
+        except ValueError:
+            raise web.HTTPBadRequest(text='invalid url parameter')
+        if (target.scheme not in self.allowed_schemes or
+                (target.host or '').lower() not in self.allowed_hosts or
+                target.user is not None):
+            raise web.HTTPForbidden(text='image host not allowed')
+        return target.with_fragment(None)
+
+    def variant(self, size):
+        """The variant served for a requested :size:"""
+        if size is None:
+            return ORIGINAL
+        return str(next((s for s in self.sizes if s >= size), self.sizes[-1]))
+
+    async def get_image(self, request):
+        url = self.check_url(request.query.get('url'))
+        size = request.query.get('size')
+        if size is not None:
+            try:
+                size = int(size)
+            except ValueError:
+                raise web.HTTPBadRequest(text='invalid size parameter')
+        variant = self.variant(size)
+
+        key = hashlib.sha256(str(url).encode('utf-8')).hexdigest()
+        entry = self.index.get(key)
+        if entry is not None and not os.path.exists(
+                entry.files[ORIGINAL][0]):
+            # evicted by another process sharing the cache directory
+            self.cache_bytes -= entry.size
+            self.remove_files(self.index.pop(key))
+            entry = None
+        if entry is not None and (entry.resized or size is None):
+            metrics.IMAGE_REQUESTS.inc(labels=('hit',))
+        else:
+            try:
+                entry = await self.fetches.get(key, partial(
+                    self.load, key, url, size is not None))
+            except FetchError as e:
+                metrics.IMAGE_REQUESTS.inc(labels=('error',))
+                log.info("image fetch failed", url=str(url), error=str(e))
+                raise web.HTTPBadGateway(text=str(e))
+            metrics.IMAGE_REQUESTS.inc(labels=('miss',))
+        if key in self.index:
+            self.index.move_to_end(key)
+        if variant not in entry.files:
+            variant = ORIGINAL
+        path, _size = entry.files[variant]
+
+        etag = '"{}-{}"'.format(key[:20], variant)
+        headers = {
+            'ETag': etag,
+            'Cache-Control': CACHE_CONTROL,
+            'X-Content-Type-Options': 'nosniff',
+        }
+        if_none_match = request.headers.get('If-None-Match', '')
+        if etag in (tag.strip() for tag in if_none_match.split(',')):
+            return web.Response(status=304, headers=headers)
+        return web.FileResponse(path, headers=headers)
+
+    async def load(self, key, url, resize):
+        """
+        The CachedImage for :url:, fetching it if it isn't cached and, if
+        asked to :resize:, making its variants if that hasn't been done.
+        """
+        entry = self.index.get(key)
+        if entry is not None and (entry.resized or not resize):
+            return entry
+        if entry is None:
+            data, ext = await self.fetch(url)
+            entry = CachedImage(key, ext)
+            files = {ORIGINAL: data}
+        else:
+            path, _size = entry.files[ORIGINAL]
+            data = await self.loop.run_in_executor(None, read_file, path)
+            files = {}
+
+        if resize:
+            try:
+                variants = await self.loop.run_in_executor(
+                    None, resize_image, data, entry.ext, self.sizes,
+                    self.max_pixels)
+            except Exception:
+                log.exception("failed to resize image", url=str(url))
+                variants = {}
+            files.update(
+                (str(size), encoded) for size, encoded in variants.items())
+            entry.resized = True
+
+        self.cache_bytes -= entry.size
+        await self.loop.run_in_executor(None, self.write_files, entry, files)
+        self.cache_bytes += entry.size
+        self.index[key] = entry
+        self.index.move_to_end(key)
+        self.evict()
+        return entry
+
+    async def fetch(self, url):
+        """(data, extension) of the image at :url:"""
+        try:
+            async with self.session.get(
+                    url, allow_redirects=False,
+                    timeout=self.fetch_timeout) as resp:
+                if resp.status != 200:
+                    raise FetchError(
+                        'origin responded with {}'.format(resp.status))
+                ext = IMAGE_TYPES.get(resp.content_type)
+                if ext is None:
+                    raise FetchError('origin did not respond with an image')
+                if (resp.content_length or 0) > self.max_image_bytes:
+                    raise FetchError('image is too large')
+                data = bytearray()
+                async for chunk in resp.content.iter_chunked(1 << 16):
+                    data.extend(chunk)
+                    if len(data) > self.max_image_bytes:
+                        raise FetchError('image is too large')
+                return bytes(data), ext
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            raise FetchError('failed to fetch image: {!r}'.format(e))
+
+    def write_files(self, entry, files):
+        for variant, data in files.items():
+            path = os.path.join(self.cache_dir, '{}.{}{}'.format(
+                entry.key, variant, entry.ext))
+            # written under another name first, so a crash can't leave a
+            # truncated image behind
+            with open(path + '.tmp', 'wb') as f:
+                f.write(data)
+            os.replace(path + '.tmp', path)
+            entry.files[variant] = (path, len(data))
+
+    def evict(self):
+        """Remove least recently used images until the cache fits"""
+        while self.cache_bytes > self.max_cache_bytes and len(self.index) > 1:
+            _key, entry = self.index.popitem(last=False)
+            self.cache_bytes -= entry.size
+            self.remove_files(entry)
+
+    @staticmethod
+    def remove_files(entry):
+        for path, _size in entry.files.values():
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+def read_file(path):
+    with open(path, 'rb') as f:
+        return f.read()
@@ -0,0 +1,79 @@
+"""
+Admission control for inbound websocket traffic: per-connection rate limits
+and validation of what clients send, so bad traffic is dropped before it is
+published to every node.
+"""
+import math
+import time
+from numbers import Real
+
+# Longest user id or username accepted from a client
+MAX_FIELD_LENGTH = 256
+
+
+class TokenBucket:
+    """
+    Allows :rate: messages per second on average, in bursts of up to
+    :burst:.
+    """
+
+    def __init__(self, rate, burst, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self.tokens = burst
+        self.updated = clock()
+
+    def consume(self, tokens=1):
+        """Take :tokens: if there are enough, returning whether there were"""
+        now = self.clock()
+        self.tokens = min(
+            self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < tokens:
+            return False
+        self.tokens -= tokens
+        return True
+
+
+def validate_user(user):
+    """Returns why :user: is unacceptable, or None if it's fine"""
+    if not isinstance(user, dict):
+        return 'user is not an object'
+    id_ = user.get('id')
+    if not isinstance(id_, (str, int)) or isinstance(id_, bool):
+        return 'user id is not a string'
+    for field in ('id', 'username', 'discriminator', 'avatar'):
+        value = user.get(field)
+        if isinstance(value, str) and len(value) > MAX_FIELD_LENGTH:
+            return 'user {} is too long'.format(field)
+    return None
+
+
+def validate_coordinate(value):
+    return (isinstance(value, Real) and not isinstance(value, bool)
+            and math.isfinite(value))
+
+
+def validate_update(decoded):
+    """
+    Returns why a decoded JSON protocol update is unacceptable, or None if
+    it's fine. Updates are ``{"user": {"id": ..}, "position": {"x": .., "y":
+    ..}}`` or, as the web app sends them, ``{"userID": .., "position":
+    ..}``; other fields are passed through untouched.
+    """
+    if not isinstance(decoded, dict):
+        return 'message is not an object'
+    if 'user' in decoded or 'userID' not in decoded:
+        error = validate_user(decoded.get('user'))
+    else:
+        error = validate_user({'id': decoded['userID']})
+    if error is not None:
+        return error
+    position = decoded.get('position')
+    if not isinstance(position, dict):
+        return 'position is not an object'
+    if not (validate_coordinate(position.get('x'))
+            and validate_coordinate(position.get('y'))):
+        return 'position coordinates are not finite numbers'
+    return None
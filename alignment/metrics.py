@@ -0,0 +1,247 @@
+"""
+In-process counters, gauges and histograms for the hot paths, exposed in the
+Prometheus text format by MetricsHandler.
+
+Recording a sample is a dict update (plus a bisect for histograms), so the
+instrumentation is always on. Per-frame and per-request timings are only
+recorded while tracing is enabled.
+"""
+import abc
+import time
+from bisect import bisect_left
+
+from aiohttp import web
+
+# Set by MetricsHandler(trace=True): record timings for every HTTP request
+# and every websocket frame written
+TRACING = False
+
+
+class Metric(abc.ABC):
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+    @abc.abstractmethod
+    def samples(self):
+        """Yields (name, labels dict, value)"""
+
+    def _labels(self, values, extra=()):
+        return dict(zip(self.labelnames, values), **dict(extra))
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values = {}
+        self._function = None
+
+    def inc(self, amount=1, labels=()):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def set_function(self, function):
+        """
+        Read the (unlabelled) value from :function: at scrape time instead,
+        for totals that are already kept elsewhere.
+        """
+        self._function = function
+
+    def samples(self):
+        if self._function is not None:
+            yield self.name, {}, self._function()
+            return
+        for labels, value in list(self._values.items()):
+            yield self.name, self._labels(labels), value
+
+
+class Gauge(Counter):
+    type = 'gauge'
+
+    def set(self, value, labels=()):
+        self._values[labels] = value
+
+    def dec(self, amount=1, labels=()):
+        self.inc(-amount, labels)
+
+
+class Histogram(Metric):
+    type = 'histogram'
+    DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                       0.25, 0.5, 1, 2.5, 5)
+
+    def __init__(self, *args, buckets=DEFAULT_BUCKETS, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.buckets = tuple(buckets)
+        self._counts = {}
+        self._sums = {}
+
+    def observe(self, value, labels=()):
+        counts = self._counts.get(labels)
+        if counts is None:
+            counts = self._counts[labels] = [0] * (len(self.buckets) + 1)
+            self._sums[labels] = 0
+        counts[bisect_left(self.buckets, value)] += 1
+        self._sums[labels] += value
+
+    def time(self, labels=()):
+        """Context manager observing the duration of its body"""
+        return _Timer(self, labels)
+
+    def samples(self):
+        for labels, counts in list(self._counts.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                yield (self.name + '_bucket',
+                       self._labels(labels, [('le', _format(bound))]),
+                       cumulative)
+            yield self.name + '_sum', self._labels(labels), self._sums[labels]
+            yield self.name + '_count', self._labels(labels), cumulative
+
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.monotonic()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.monotonic() - self.start, self.labels)
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append('# HELP {} {}'.format(
+                metric.name, metric.documentation.replace('\n', ' ')))
+            lines.append('# TYPE {} {}'.format(metric.name, metric.type))
+            for name, labels, value in metric.samples():
+                if labels:
+                    name += '{{{}}}'.format(','.join(
+                        '{}="{}"'.format(k, _escape(v))
+                        for k, v in labels.items()))
+                lines.append('{} {}'.format(name, _format(value)))
+        return '\n'.join(lines) + '\n'
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('\n', r'\n').replace(
+        '"', r'\"')
+
+
+def _format(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+REGISTRY = Registry()
+
+WS_CONNECTIONS = REGISTRY.register(Gauge(
+    'alignment_websockets_open', 'Open websockets on this node'))
+WS_MESSAGES = REGISTRY.register(Counter(
+    'alignment_websocket_messages_received_total',
+    'Messages received from websockets', ['protocol']))
+WS_FRAMES = REGISTRY.register(Counter(
+    'alignment_websocket_frames_queued_total',
+    'Frames queued for delivery to websockets'))
+WS_REJECTED = REGISTRY.register(Counter(
+    'alignment_websocket_rejected_total',
+    'Websockets and messages turned away by admission control', ['reason']))
+WS_QUEUED = REGISTRY.register(Gauge(
+    'alignment_websocket_queued',
+    'Frames waiting in websocket send queues'))
+WS_DROPPED = REGISTRY.register(Counter(
+    'alignment_websocket_dropped_total',
+    'Frames dropped from full websocket send queues'))
+WS_COALESCED = REGISTRY.register(Counter(
+    'alignment_websocket_coalesced_total',
+    'Frames replaced by a newer one in full websocket send queues'))
+WS_OVERFLOWS = REGISTRY.register(Counter(
+    'alignment_websocket_overflow_disconnects_total',
+    'Websockets disconnected for falling behind'))
+WS_SEND_SECONDS = REGISTRY.register(Histogram(
+    'alignment_websocket_send_seconds',
+    'Time to write one frame to a websocket (tracing only)'))
+BUS_PUBLISH_SECONDS = REGISTRY.register(Histogram(
+    'alignment_bus_publish_seconds',
+    'Time to publish an envelope, a Redis round trip on the Redis bus'))
+BUS_LAG_SECONDS = REGISTRY.register(Histogram(
+    'alignment_bus_lag_seconds',
+    'Time from publishing an envelope to a subscriber receiving it',
+    ['subscriber']))
+FANOUT_SECONDS = REGISTRY.register(Histogram(
+    'alignment_fanout_seconds',
+    'Time to render and queue an envelope for every local websocket'))
+PERSISTED_UPDATES = REGISTRY.register(Counter(
+    'alignment_persisted_updates_total', 'Position updates persisted'))
+PERSIST_BACKLOG = REGISTRY.register(Gauge(
+    'alignment_persist_backlog',
+    'Positions buffered in memory waiting to be written to Redis'))
+ROOMSTORE_SECONDS = REGISTRY.register(Histogram(
+    'alignment_roomstore_seconds', 'Duration of RoomStore Redis operations',
+    ['operation']))
+HTTP_SECONDS = REGISTRY.register(Histogram(
+    'alignment_http_request_seconds',
+    'HTTP request handling time (tracing only)',
+    ['method', 'route', 'status']))
+IMAGE_REQUESTS = REGISTRY.register(Counter(
+    'alignment_image_requests_total',
+    'Image proxy requests, by whether the image was cached', ['result']))
+
+
+class MetricsHandler:
+    def __init__(self, path='/metrics', trace=False):
+        """
+        :trace: also time every HTTP request and websocket frame written.
+        """
+        self.path = path
+        self.trace = trace
+
+    def setup(self, app):
+        global TRACING
+        TRACING = self.trace
+        app.router.add_get(self.path, self.metrics)
+        if self.trace:
+            app.middlewares.append(self.trace_request)
+
+    async def metrics(self, request):
+        return web.Response(
+            text=REGISTRY.render(),
+            content_type='text/plain',
+            headers={'X-Content-Type-Options': 'nosniff'})
+
+    @web.middleware
+    async def trace_request(self, request, handler):
+        start = time.monotonic()
+        status = 500
+        try:
+            response = await handler(request)
+            status = response.status
+            return response
+        except web.HTTPException as e:
+            status = e.status
+            raise
+        finally:
+            info = request.match_info.route.get_info()
+            route = (info.get('formatter') or info.get('path')
+                     or info.get('prefix') or 'unmatched')
+            HTTP_SECONDS.observe(
+                time.monotonic() - start,
+                (request.method, route, str(status)))
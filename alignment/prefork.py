@@ -0,0 +1,126 @@
+import math
+import os
+import signal
+import socket
+import time
+
+from structlog import get_logger
+
+log = get_logger()
+
+
+class Supervisor:
+    """
+    Pre-fork server: binds the listening socket once, then forks :workers:
+    processes that each serve it with their own event loop (and so their own
+    Redis pool). Since fan-out goes through the message bus, a websocket may
+    land on any worker.
+
+    Workers that die are restarted. SIGTERM or SIGINT is passed on to every
+    worker, which shut down gracefully; any still running after
+    :shutdown_timeout: seconds are killed.
+    """
+
+    def __init__(self,
+                 target,
+                 workers,
+                 host='0.0.0.0',
+                 port=5000,
+                 backlog=128,
+                 shutdown_timeout=30,
+                 restart_delay=1):
+        """
+        :target: is called in each worker with the listening socket, and
+        should serve it until the worker is told to stop.
+        :restart_delay: is how long to wait before restarting a worker that
+        died within that many seconds of starting, so a worker that can't
+        start doesn't fork in a tight loop.
+        :shutdown_timeout: is rounded up to whole seconds, as alarm() takes.
+        """
+        self.target = target
+        self.workers = workers
+        self.host = host
+        self.port = port
+        self.backlog = backlog
+        self.shutdown_timeout = int(math.ceil(shutdown_timeout))
+        self.restart_delay = restart_delay
+        self.children = {}
+        self.stopping = False
+        self.sock = None
+
+    def bind(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((self.host, self.port))
+        sock.listen(self.backlog)
+        sock.set_inheritable(True)
+        return sock
+
+    def spawn(self, index):
+        pid = os.fork()
+        if pid == 0:
+            # the worker's event loop installs its own handlers
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            signal.signal(signal.SIGALRM, signal.SIG_DFL)
+            code = 0
+            try:
+                log.info('worker started', worker=index, pid=os.getpid())
+                self.target(self.sock)
+            except BaseException:
+                log.exception('worker failed', worker=index)
+                code = 1
+            finally:
+                os._exit(code)
+        self.children[pid] = (index, time.monotonic())
+
+    def stop(self, signum, _frame):
+        if self.stopping:
+            return
+        self.stopping = True
+        log.info('stopping workers', workers=len(self.children))
+        self.signal_children(signal.SIGTERM)
+        signal.alarm(self.shutdown_timeout)
+
+    def kill(self, _signum, _frame):
+        log.warning('workers did not stop in time, killing them',
+                    workers=len(self.children))
+        self.signal_children(signal.SIGKILL)
+
+    def signal_children(self, signum):
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    def run(self):
+        self.sock = self.bind()
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGALRM, self.kill)
+        log.info('starting workers', workers=self.workers,
+                 host=self.host, port=self.port)
+        for index in range(self.workers):
+            self.spawn(index)
+
+        while self.children:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            if pid not in self.children:
+                continue
+            index, started = self.children.pop(pid)
+            if self.stopping:
+                continue
+            log.warning('worker exited, restarting', worker=index, pid=pid,
+                        status=status)
+            if time.monotonic() - started < self.restart_delay:
+                time.sleep(self.restart_delay)
+            if not self.stopping:
+                self.spawn(index)
+
+        signal.alarm(0)
+        self.sock.close()
+        log.info('all workers stopped')
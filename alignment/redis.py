@@ -1,13 +1,91 @@
+import hashlib
+from bisect import bisect
+
 import aioredis
 
 REDIS_POOL_KEY = 'redis_pool'
+REDIS_SHARDS_KEY = 'redis_shards'
+
+
+async def run_script(redis, script, keys=(), args=()):
+    """EVALSHA :script:, falling back to EVAL if Redis hasn't cached it"""
+    sha = hashlib.sha1(script.encode('utf-8')).hexdigest()
+    try:
+        return await redis.evalsha(sha, keys=list(keys), args=list(args))
+    except aioredis.ReplyError as e:
+        if not str(e).startswith('NOSCRIPT'):
+            raise
+        return await redis.eval(script, keys=list(keys), args=list(args))
+
+
+def room_redis(app, room):
+    """The Redis pool holding :room:'s keys (and its channel, when sharded)"""
+    shards = app.get(REDIS_SHARDS_KEY)
+    if shards is None:
+        return app.get(REDIS_POOL_KEY)
+    return shards.for_room(room)
+
+
+class HashRing:
+    """
+    Consistent hashing of keys onto nodes. Each node gets :replicas: points
+    on the ring so keys spread evenly, and adding a node only moves the
+    keys that now hash to it, about 1/N of them.
+    """
+
+    def __init__(self, nodes, replicas=160):
+        points = sorted(
+            (self.hash('{}#{}'.format(node, i)), node)
+            for node in nodes for i in range(replicas))
+        self._hashes = [h for h, _node in points]
+        self._nodes = [node for _h, node in points]
+
+    @staticmethod
+    def hash(key):
+        return int.from_bytes(
+            hashlib.md5(key.encode('utf-8')).digest()[:8], 'big')
+
+    def get(self, key):
+        i = bisect(self._hashes, self.hash(key)) % len(self._hashes)
+        return self._nodes[i]
+
+
+class RedisShards:
+    """
+    Pools to several Redis servers, with rooms assigned to them by
+    consistent hashing of the room name.
+    """
+
+    def __init__(self, pools):
+        """
+        :pools: maps each Redis URL to its pool. The URL identifies the shard
+        on the ring, so the same URLs always give the same assignment.
+        """
+        self._pools = pools
+        self._ring = HashRing(list(pools))
+
+    @property
+    def pools(self):
+        return list(self._pools.values())
+
+    def for_room(self, room):
+        return self._pools[self._ring.get(room)]
+
 
 class RedisPool:
     def __init__(self,
                  redis_url,
                  redis_pool_min=5,
                  redis_pool_max=10):
-        self.redis_url = redis_url
+        """
+        :redis_url: is one URL, or several (a list or a comma separated
+        string) to shard rooms across. The first is also home to everything
+        that isn't per room, such as the unsharded pub/sub channel, so add
+        new shards at the end.
+        """
+        if isinstance(redis_url, str):
+            redis_url = [url.strip() for url in redis_url.split(',')]
+        self.redis_urls = list(redis_url)
         self.redis_pool_min = redis_pool_min
         self.redis_pool_max = redis_pool_max
 
@@ -16,18 +94,22 @@ class RedisPool:
         app.on_cleanup.append(self.destroy_redis_pool)
 
     async def create_redis_pool(self, app):
-        """Initialise a new redis pool using the parameters passed to the class"""
-        redis = await aioredis.create_redis_pool(
-            self.redis_url,
-            minsize=self.redis_pool_min,
-            maxsize=self.redis_pool_max,
-            loop=app.loop)
-        app[REDIS_POOL_KEY] = redis
+        """Initialise a redis pool for every URL passed to the class"""
+        pools = {}
+        for url in self.redis_urls:
+            pools[url] = await aioredis.create_redis_pool(
+                url,
+                minsize=self.redis_pool_min,
+                maxsize=self.redis_pool_max,
+                loop=app.loop)
+        app[REDIS_POOL_KEY] = pools[self.redis_urls[0]]
+        app[REDIS_SHARDS_KEY] = RedisShards(pools)
 
     async def destroy_redis_pool(self, app):
-        """Destroy this class's redis pool"""
-        pool = app.get(REDIS_POOL_KEY)
-        if pool is None:
+        """Destroy this class's redis pools"""
+        shards = app.get(REDIS_SHARDS_KEY)
+        if shards is None:
             return
-        pool.close()
-        await pool.wait_closed()
+        for pool in shards.pools:
+            pool.close()
+            await pool.wait_closed()
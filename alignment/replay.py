@@ -0,0 +1,146 @@
+"""
+Per-room sequence numbers and a bounded log of recent envelopes, so that a
+reconnecting websocket can be sent just the updates it missed.
+
+The sequence number is assigned, logged and published in one step, so every
+subscriber sees a room's envelopes in sequence order.
+"""
+import abc
+import time
+from collections import defaultdict, deque, OrderedDict
+
+from alignment import envelope
+from alignment.bus import BUS_KEY
+from alignment.redis import room_redis, run_script
+
+# KEYS: sequence counter, replay list
+# ARGV: envelope, replay size, ttl, channel
+# Same splice as envelope.sequence(); returns the sequence number.
+PUBLISH_SCRIPT = """
+local seq = redis.call('INCR', KEYS[1])
+local data = '{"seq":' .. seq .. ',' .. string.sub(ARGV[1], 2)
+redis.call('LPUSH', KEYS[2], data)
+redis.call('LTRIM', KEYS[2], 0, tonumber(ARGV[2]) - 1)
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+redis.call('EXPIRE', KEYS[2], ARGV[3])
+redis.call('PUBLISH', ARGV[4], data)
+return seq
+"""
+
+
+class ReplayLog(abc.ABC):
+    """
+    Keeps the last :size: envelopes of every room.
+    """
+
+    def __init__(self, size=256):
+        self.size = size
+
+    @abc.abstractmethod
+    async def publish(self, app, channel, room, data):
+        """
+        Number the envelope :data: for :room:, log it and publish it.
+        """
+
+    async def since(self, app, room, last_seq):
+        """
+        The envelopes of :room: after :last_seq:, oldest first, or None if
+        some of them are no longer in the log.
+        """
+        current, entries = await self._entries(app, room)
+        if last_seq > current:
+            # the log was reset since the client last saw it
+            return None
+        missed = [(seq, data) for seq, data in entries if seq > last_seq]
+        if len(missed) < current - last_seq:
+            return None
+        return [data for _seq, data in sorted(missed)]
+
+    async def recent(self, app, room):
+        """
+        (current sequence number, [envelope, ...]) of :room:, with every
+        envelope still in the log, oldest first.
+        """
+        current, entries = await self._entries(app, room)
+        return current, [data for _seq, data in sorted(entries)]
+
+    @abc.abstractmethod
+    async def _entries(self, app, room):
+        """(current sequence number, [(seq, envelope), ...]) of :room:"""
+
+
+class LocalReplayLog(ReplayLog):
+    """
+    An in-process log, for use with a LocalBus. Like RedisReplayLog's, a
+    room's counter and log are dropped after :ttl: seconds without updates.
+    """
+
+    def __init__(self, size=256, ttl=3600):
+        super().__init__(size)
+        self.ttl = ttl
+        self._seqs = defaultdict(int)
+        self._logs = defaultdict(lambda: deque(maxlen=self.size))
+        # room -> when it was last published to, least recent first
+        self._published = OrderedDict()
+
+    def _expire(self):
+        idle = time.monotonic() - self.ttl
+        while self._published:
+            room, published = next(iter(self._published.items()))
+            if published > idle:
+                break
+            del self._published[room]
+            self._seqs.pop(room, None)
+            self._logs.pop(room, None)
+
+    async def publish(self, app, channel, room, data):
+        self._expire()
+        self._published[room] = time.monotonic()
+        self._published.move_to_end(room)
+        self._seqs[room] += 1
+        seq = self._seqs[room]
+        data = envelope.sequence(data, seq)
+        self._logs[room].append((seq, data))
+        await app[BUS_KEY].publish(channel, data)
+        return seq
+
+    async def _entries(self, app, room):
+        self._expire()
+        return self._seqs.get(room, 0), list(self._logs.get(room, ()))
+
+
+class RedisReplayLog(ReplayLog):
+    """
+    A log kept in Redis, shared by every node, for use with a RedisBus.
+    A room's counter and log expire after :ttl: seconds without updates;
+    clients resuming after that are sent a snapshot instead.
+
+    The publish happens on the room's Redis shard, so with several shards
+    the bus must be sharded too, with each room's channel on its shard.
+    """
+
+    def __init__(self, size=256, ttl=3600, key_prefix='alignment:room'):
+        super().__init__(size)
+        self.ttl = ttl
+        self.key_prefix = key_prefix
+
+    def _get_seq_key(self, room):
+        return self.key_prefix + ':seq:' + room
+
+    def _get_replay_key(self, room):
+        return self.key_prefix + ':replay:' + room
+
+    async def publish(self, app, channel, room, data):
+        return await run_script(
+            room_redis(app, room), PUBLISH_SCRIPT,
+            keys=[self._get_seq_key(room), self._get_replay_key(room)],
+            args=[data, self.size, self.ttl, channel])
+
+    async def _entries(self, app, room):
+        pipe = room_redis(app, room).pipeline()
+        current = pipe.get(self._get_seq_key(room))
+        entries = pipe.lrange(
+            self._get_replay_key(room), 0, -1, encoding='utf-8')
+        await pipe.execute()
+        current, entries = int(await current or 0), await entries
+        return current, [(envelope.read(data).seq, data) for data in entries]
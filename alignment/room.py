@@ -1,20 +1,292 @@
+import hashlib
 import json
+import math
 import time
+from collections import defaultdict, OrderedDict
 
-from alignment.redis import REDIS_POOL_KEY
+import asyncio
+from structlog import get_logger
+
+from alignment import metrics
+from alignment.redis import (
+    REDIS_POOL_KEY, REDIS_SHARDS_KEY, room_redis, run_script)
+from alignment.users import UserRegistry
+
+log = get_logger()
+
+# KEYS: meta, position hash, position sort zset
+# ARGV: oldest live position score
+# Returns false if the room doesn't exist, otherwise
+# {image, size, id1, position1, id2, position2, ...} in sort order.
+GET_ROOM_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return false
+end
+local result = redis.call('HMGET', KEYS[1], 'image', 'size')
+local ids = redis.call('ZRANGEBYSCORE', KEYS[3], ARGV[1], '+inf')
+-- HMGET in chunks, unpack() is limited by the Lua stack size
+for first = 1, #ids, 1000 do
+    local chunk = {unpack(ids, first, math.min(first + 999, #ids))}
+    local positions = redis.call('HMGET', KEYS[2], unpack(chunk))
+    for i, id in ipairs(chunk) do
+        if positions[i] then
+            result[#result + 1] = id
+            result[#result + 1] = positions[i]
+        end
+    end
+end
+return result
+"""
+
+# KEYS: position hash, position sort zset
+# ARGV: cutoff score, batch size
+# Removes up to a batch of positions last set before the cutoff, returning
+# how many were removed.
+TRIM_POSITIONS_SCRIPT = """
+local ids = redis.call(
+    'ZRANGEBYSCORE', KEYS[2], '-inf', '(' .. ARGV[1], 'LIMIT', 0, ARGV[2])
+if #ids > 0 then
+    redis.call('HDEL', KEYS[1], unpack(ids))
+    redis.call('ZREM', KEYS[2], unpack(ids))
+end
+return #ids
+"""
+
+
+class RoomSnapshot:
+    """
+    A room's meta and encoded positions, as cached by RoomStore.
+    The ETag is a hash of the serialised room, so reloading a room that
+    hasn't changed, on any node, keeps it.
+    """
+
+    def __init__(self, image, size, positions):
+        self.image = image
+        self.size = size
+        self.positions = positions
+        self.loaded = time.monotonic()
+        # room sequence number of the latest update included, if known
+        self.seq = None
+        self._json = None
+        self._etag = None
+
+    @property
+    def etag(self):
+        if self._etag is None:
+            self._etag = '"{}"'.format(hashlib.sha1(
+                self.to_json().encode('utf-8')).hexdigest()[:24])
+        return self._etag
+
+    def set_position(self, id_, encoded):
+        self.positions.pop(id_, None)
+        self.positions[id_] = encoded
+        self._json = None
+        self._etag = None
+
+    def to_dict(self):
+        return {
+            'image': self.image,
+            'size': self.size,
+            'positions': [json.loads(p) for p in self.positions.values()],
+        }
+
+    def to_json(self):
+        """
+        The room serialised as JSON. The stored positions are spliced in as-is
+        rather than being decoded and re-encoded.
+        """
+        if self._json is None:
+            self._json = '{{"image": {}, "size": {}, "positions": [{}]}}'.format(
+                json.dumps(self.image), self.size,
+                ', '.join(self.positions.values()))
+        return self._json
 
 
 class RoomStore:
     DEFAULT_SIZE = 128
 
-    def __init__(self, app, room_prefix):
+    def __init__(self,
+                 app,
+                 room_prefix,
+                 flush_interval=0.1,
+                 flush_size=1000,
+                 cache_size=1024,
+                 cache_ttl=5,
+                 room_ttl=None,
+                 position_ttl=None,
+                 compact_interval=60,
+                 compact_batch=500):
+        """
+        Positions are buffered in memory (write-behind), keeping only the
+        latest position per user, and written to Redis in a single pipeline
+        every :flush_interval: seconds or once :flush_size: users are pending.
+
+        Up to :cache_size: recently read rooms are kept in memory and updated
+        from every position this store sees. Entries are reloaded after
+        :cache_ttl: seconds, to pick up updates persisted by other nodes.
+
+        With :room_ttl: (seconds), a room's keys, including its users' compact
+        protocol handles, expire once it has been idle that long. With
+        :position_ttl:, positions not updated for that long are ignored by
+        reads and removed by a background janitor every :compact_interval:
+        seconds, :compact_batch: rooms or positions at a time. With either,
+        rooms record their last activity in the active rooms sorted set, for
+        the janitor to go through, and leave it once they're idle for longer
+        than :room_ttl: or :position_ttl:.
+
+        With several Redis shards, every key of a room (and its entry in the
+        active rooms set) lives on the room's shard.
+        """
         self.app = app
         self.room_prefix = room_prefix
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self.cache_size = cache_size
+        self.cache_ttl = cache_ttl
+        self.room_ttl = room_ttl
+        self.position_ttl = position_ttl
+        self.compact_interval = compact_interval
+        self.compact_batch = compact_batch
+        # only for the names of its keys, which expire with the room's
+        self._users = UserRegistry(room_prefix)
+        self._cache = OrderedDict()
+        self._pending = defaultdict(OrderedDict)
+        self._pending_count = 0
+        self._flushing = {}
+        # Held by flushes and batch writes, so a position can't be written
+        # over by an older one that was already on its way to Redis.
+        self._write_lock = None
+        self._flush_wanted = None
+        self._flusher = None
+        self._janitor = None
+
+    async def start(self, app):
+        self._write_lock = asyncio.Lock(loop=app.loop)
+        self._flush_wanted = asyncio.Event(loop=app.loop)
+        self._flusher = app.loop.create_task(self._flush_loop())
+        if self.room_ttl or self.position_ttl:
+            self._janitor = app.loop.create_task(self._compact_loop())
+
+    async def stop(self, app):
+        """Stop the background tasks and write out everything pending"""
+        if self._janitor is not None:
+            self._janitor.cancel()
+            await self._janitor
+            self._janitor = None
+        if self._flusher is not None:
+            self._flusher.cancel()
+            await self._flusher
+            self._flusher = None
+        while self._pending_count:
+            if not await self.flush():
+                break
+
+    async def _flush_loop(self):
+        try:
+            while True:
+                try:
+                    await asyncio.wait_for(
+                        self._flush_wanted.wait(),
+                        self.flush_interval,
+                        loop=self.app.loop)
+                except asyncio.TimeoutError:
+                    pass
+                self._flush_wanted.clear()
+                await self.flush()
+        except asyncio.CancelledError:
+            pass
+
+    async def _compact_loop(self):
+        try:
+            while True:
+                await asyncio.sleep(self.compact_interval, loop=self.app.loop)
+                try:
+                    await self.compact()
+                except Exception:
+                    log.exception("failed to compact rooms")
+        except asyncio.CancelledError:
+            pass
+
+    async def compact(self):
+        """
+        Forget rooms idle for longer than :room_ttl: (Redis has expired their
+        keys already) and trim positions older than :position_ttl:, a batch
+        at a time so no single command holds up Redis for long.
+        Returns the number of positions removed.
+        """
+        removed = 0
+        for redis in self.shards:
+            removed += await self._compact_shard(redis, self.time())
+        return removed
+
+    async def _compact_shard(self, redis, now):
+        active_key = self._get_active_rooms_key()
+        if self.room_ttl:
+            with metrics.ROOMSTORE_SECONDS.time(('compact_rooms',)):
+                await redis.zremrangebyscore(
+                    active_key, max=now - self.room_ttl)
+        if not self.position_ttl:
+            return 0
+
+        cutoff = now - self.position_ttl
+        removed = 0
+        idle = []
+        start = 0
+        while True:
+            # Ranks shift as rooms become active, so a room may be skipped
+            # until the next run; that's fine for a janitor.
+            rooms = await redis.zrevrange(
+                active_key, start, start + self.compact_batch - 1,
+                withscores=True, encoding='utf-8')
+            for room, last_active in rooms:
+                removed += await self._trim_positions(redis, room, cutoff)
+                if last_active < cutoff:
+                    idle.append(room)
+            if len(rooms) < self.compact_batch:
+                break
+            start += self.compact_batch
+        # Every position of these is gone now. Should one have just become
+        # active again, its flush adds it back.
+        for chunk_start in range(0, len(idle), self.compact_batch):
+            with metrics.ROOMSTORE_SECONDS.time(('compact_rooms',)):
+                await redis.zrem(
+                    active_key,
+                    *idle[chunk_start:chunk_start + self.compact_batch])
+        return removed
+
+    async def _trim_positions(self, redis, name, cutoff):
+        removed = 0
+        while True:
+            with metrics.ROOMSTORE_SECONDS.time(('trim_positions',)):
+                trimmed = await run_script(
+                    redis, TRIM_POSITIONS_SCRIPT,
+                    keys=[self._get_position_key(name),
+                          self._get_position_sort_key(name)],
+                    args=[cutoff, self.compact_batch])
+            removed += trimmed
+            if trimmed < self.compact_batch:
+                return removed
+
+    def _live_since(self):
+        """The oldest score of a position that hasn't expired"""
+        if not self.position_ttl:
+            return float('-inf')
+        return self.time() - self.position_ttl
 
     @property
     def redis(self):
         return self.app[REDIS_POOL_KEY]
 
+    @property
+    def shards(self):
+        """Every Redis pool rooms are stored on"""
+        shards = self.app.get(REDIS_SHARDS_KEY)
+        return [self.redis] if shards is None else shards.pools
+
+    def room_redis(self, name):
+        """The Redis pool :name:'s keys are stored on"""
+        return room_redis(self.app, name)
+
     def _get_room_meta_key(self, room):
         return self.room_prefix + ':meta:' + room
 
@@ -24,45 +296,397 @@ class RoomStore:
     def _get_position_sort_key(self, room):
         return self.room_prefix + ':position:sort:' + room
 
+    def _get_active_rooms_key(self):
+        return self.room_prefix + ':active'
+
+    def _get_room_keys(self, room):
+        """Every key of :room:, which expire together with :room_ttl:"""
+        return [self._get_room_meta_key(room), self._get_position_key(room),
+                self._get_position_sort_key(room)] + self._users.keys(room)
+
+    @property
+    def _tracks_active(self):
+        """Whether to keep the active rooms set, for the janitor"""
+        return bool(self.room_ttl or self.position_ttl)
+
     async def create_room(self, name, image, size=None):
+        pipe = self.room_redis(name).pipeline()
+        self._queue_create_room(pipe, name, image, size)
+        with metrics.ROOMSTORE_SECONDS.time(('create_room',)):
+            await pipe.execute()
+        self._cache.pop(name, None)
+
+    async def create_rooms(self, rooms, chunk_size=500):
+        """
+        Create many rooms at once, :rooms: being (name, image, size) tuples.
+        Each shard's rooms are written in pipelines of :chunk_size: rooms.
+        Returns, in order, None for every room created and the exception for
+        every room that wasn't.
+        """
+        results = [None] * len(rooms)
+        by_shard = defaultdict(list)
+        for i, (name, _image, _size) in enumerate(rooms):
+            by_shard[self.room_redis(name)].append(i)
+
+        async def create(redis, indices):
+            for start in range(0, len(indices), chunk_size):
+                chunk = indices[start:start + chunk_size]
+                pipe = redis.pipeline()
+                counts = [
+                    self._queue_create_room(pipe, *rooms[i]) for i in chunk]
+                for i, error in zip(
+                        chunk, await self._execute_items(pipe, counts)):
+                    results[i] = error
+                    self._cache.pop(rooms[i][0], None)
+
+        with metrics.ROOMSTORE_SECONDS.time(('create_rooms',)):
+            await asyncio.gather(
+                *(create(redis, indices)
+                  for redis, indices in by_shard.items()),
+                loop=self.app.loop)
+        return results
+
+    def _queue_create_room(self, pipe, name, image, size=None):
+        """Queue the commands creating a room, returning how many there are"""
         if size is None:
             size = self.DEFAULT_SIZE
-        await self.redis.hmset_dict(
-            self._get_room_meta_key(name), image=image, size=size)
+        meta_key = self._get_room_meta_key(name)
+        pipe.hmset_dict(meta_key, image=image, size=size)
+        count = 1
+        if self._tracks_active:
+            pipe.zadd(self._get_active_rooms_key(), self.time(), name)
+            count += 1
+        if self.room_ttl:
+            # and any users left over from a room of the same name
+            for key in self._get_room_keys(name):
+                pipe.expire(key, self.room_ttl)
+                count += 1
+        return count
+
+    @staticmethod
+    async def _execute_items(pipe, counts):
+        """
+        Execute :pipe:, where the i-th item queued counts[i] commands.
+        Returns the first error of each item, or None if it had none.
+        """
+        try:
+            replies = await pipe.execute(return_exceptions=True)
+        except Exception as e:
+            return [e] * len(counts)
+        errors = []
+        start = 0
+        for count in counts:
+            errors.append(next((
+                reply for reply in replies[start:start + count]
+                if isinstance(reply, Exception)), None))
+            start += count
+        return errors
 
     @staticmethod
     def time():
-        return time.clock_gettime(time.CLOCK_MONOTONIC_RAW)
+        # Wall time, so that scores compare across nodes and restarts
+        return time.time()
 
     async def set_position(self, name, user, position):
         id_ = user['id']
         encoded = json.dumps({'user': user, 'position': position})
-        await self.redis.hset(self._get_position_key(name), id_, encoded)
-        await self.redis.zadd(
-            self._get_position_sort_key(name), self.time(), id_)
+        room = self._pending[name]
+        if id_ in room:
+            room.move_to_end(id_)
+        else:
+            self._pending_count += 1
+        room[id_] = (encoded, self.time())
+        snapshot = self._cache.get(name)
+        if snapshot is not None:
+            snapshot.set_position(id_, encoded)
+        metrics.PERSIST_BACKLOG.set(self._pending_count)
+        if (self._pending_count >= self.flush_size
+                and self._flush_wanted is not None):
+            self._flush_wanted.set()
+
+    async def set_positions(self, name, positions, chunk_size=500):
+        """
+        Upsert many positions in :name: at once, :positions: being (user,
+        position) pairs. They're written straight to Redis, bypassing the
+        write-behind buffer, in pipelines of :chunk_size: positions.
+        Returns, in order, None for every position written and the exception
+        for every one that wasn't.
+        """
+        redis = self.room_redis(name)
+        position_key = self._get_position_key(name)
+        sort_key = self._get_position_sort_key(name)
+        results = []
+        for start in range(0, len(positions), chunk_size):
+            chunk = positions[start:start + chunk_size]
+            score = self.time()
+            pipe = redis.pipeline()
+            encoded = []
+            for user, position in chunk:
+                encoded.append((user['id'], json.dumps(
+                    {'user': user, 'position': position})))
+                pipe.hset(position_key, *encoded[-1])
+                pipe.zadd(sort_key, score, user['id'])
+            room_commands = 0
+            if self._tracks_active:
+                pipe.zadd(self._get_active_rooms_key(), score, name)
+                room_commands += 1
+            if self.room_ttl:
+                for key in self._get_room_keys(name):
+                    pipe.expire(key, self.room_ttl)
+                    room_commands += 1
+            counts = [2] * len(chunk) + [room_commands]
+            async with self._write_lock:
+                with metrics.ROOMSTORE_SECONDS.time(('set_positions',)):
+                    *errors, room_error = await self._execute_items(
+                        pipe, counts)
+                for (id_, value), error in zip(encoded, errors):
+                    if error is None:
+                        self._written(name, id_, value)
+            if room_error is not None:
+                log.error("failed to mark room active", room=name,
+                          error=str(room_error))
+            results.extend(errors)
+        return results
+
+    def _written(self, name, id_, encoded):
+        """Forget any older buffered position, now :encoded: is in Redis"""
+        pending = self._pending.get(name)
+        if pending is not None and pending.pop(id_, None) is not None:
+            self._pending_count -= 1
+            metrics.PERSIST_BACKLOG.set(self._pending_count)
+            if not pending:
+                del self._pending[name]
+        snapshot = self._cache.get(name)
+        if snapshot is not None:
+            snapshot.set_position(id_, encoded)
+
+    async def flush(self):
+        """
+        Write every buffered position to Redis, in one pipeline per shard.
+        Returns False if a write failed; the positions of that shard's rooms
+        stay buffered unless they have been superseded in the meantime.
+        """
+        if not self._pending_count:
+            return True
+        async with self._write_lock:
+            return await self._flush()
+
+    async def _flush(self):
+        if not self._pending_count:
+            return True
+        pending, self._pending = self._pending, defaultdict(OrderedDict)
+        self._pending_count = 0
+        metrics.PERSIST_BACKLOG.set(0)
+        # still visible to readers until the pipelines complete
+        self._flushing = pending
+
+        by_shard = defaultdict(OrderedDict)
+        for name, users in pending.items():
+            by_shard[self.room_redis(name)][name] = users
+        try:
+            with metrics.ROOMSTORE_SECONDS.time(('flush',)):
+                results = await asyncio.gather(
+                    *(self._flush_shard(redis, rooms)
+                      for redis, rooms in by_shard.items()),
+                    loop=self.app.loop, return_exceptions=True)
+        finally:
+            self._flushing = {}
+
+        flushed = True
+        for rooms, result in zip(by_shard.values(), results):
+            if isinstance(result, Exception):
+                log.error("failed to flush positions",
+                          rooms=len(rooms), exc_info=result)
+                self._requeue(rooms)
+                flushed = False
+            else:
+                metrics.PERSISTED_UPDATES.inc(
+                    sum(len(users) for users in rooms.values()))
+        return flushed
+
+    async def _flush_shard(self, redis, pending):
+        pipe = redis.pipeline()
+        active_key = self._get_active_rooms_key()
+        for name, users in pending.items():
+            position_key = self._get_position_key(name)
+            sort_key = self._get_position_sort_key(name)
+            last_active = 0
+            for id_, (encoded, score) in users.items():
+                pipe.hset(position_key, id_, encoded)
+                pipe.zadd(sort_key, score, id_)
+                last_active = max(last_active, score)
+            if self._tracks_active:
+                pipe.zadd(active_key, last_active, name)
+            if self.room_ttl:
+                for key in self._get_room_keys(name):
+                    pipe.expire(key, self.room_ttl)
+        await pipe.execute()
+
+    def _requeue(self, pending):
+        for name, users in pending.items():
+            room = self._pending[name]
+            for id_, value in users.items():
+                if id_ not in room:
+                    room[id_] = value
+                    self._pending_count += 1
+        metrics.PERSIST_BACKLOG.set(self._pending_count)
+
+    def _unflushed(self, name):
+        """Encoded positions in :name: not yet written to Redis, oldest first"""
+        return OrderedDict(
+            (id_, encoded)
+            for id_, (encoded, _score) in self._unflushed_scored(name).items())
+
+    def _unflushed_scored(self, name):
+        """Like _unflushed, but with the (encoded, score) of each position"""
+        unflushed = OrderedDict(self._flushing.get(name, ()))
+        for id_, value in self._pending.get(name, {}).items():
+            unflushed.pop(id_, None)
+            unflushed[id_] = value
+        return unflushed
+
+    async def get_snapshot(self, name):
+        """
+        Return the RoomSnapshot for :name:, from the cache if it's fresh.
+        Returns None if the room doesn't exist.
+        """
+        snapshot = self._cache.get(name)
+        if snapshot is not None:
+            if time.monotonic() - snapshot.loaded < self.cache_ttl:
+                self._cache.move_to_end(name)
+                return snapshot
+            del self._cache[name]
+
+        snapshot = await self.load_snapshot(name)
+        if snapshot is not None and self.cache_size:
+            self._cache[name] = snapshot
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return snapshot
+
+    async def load_snapshot(self, name):
+        """
+        Fetch a room's meta and encoded positions in a single round trip,
+        bypassing the cache. Returns None if the room doesn't exist.
+        """
+        with metrics.ROOMSTORE_SECONDS.time(('load_room',)):
+            reply = await run_script(
+                self.room_redis(name), GET_ROOM_SCRIPT, keys=[
+                    self._get_room_meta_key(name),
+                    self._get_position_key(name),
+                    self._get_position_sort_key(name),
+                ], args=[self._live_since()])
+        if reply is None or reply[0] is None:
+            # meta without an image isn't a room, as in get_meta()
+            return None
+
+        image, size, *stored = reply
+        unflushed = self._unflushed(name)
+        positions = OrderedDict(
+            (id_, encoded.decode('utf-8'))
+            for id_, encoded in (
+                (id_.decode('utf-8'), encoded)
+                for id_, encoded in zip(stored[::2], stored[1::2]))
+            if id_ not in unflushed)
+        positions.update(unflushed)
+        return RoomSnapshot(image.decode('utf-8'), int(size), positions)
 
     async def get_room(self, name):
-        meta_key = self._get_room_meta_key(name)
-        exists = await self.redis.exists(meta_key)
-        if not exists:
+        snapshot = await self.get_snapshot(name)
+        if snapshot is None:
             return None
+        return snapshot.to_dict()
 
-        image, size = await self.redis.hmget(
-            meta_key,
-            'image',
-            'size',
-            encoding='utf-8',
-        )
+    async def get_room_json(self, name):
+        """Like get_room, but returns the room already serialised as JSON"""
+        snapshot = await self.get_snapshot(name)
+        if snapshot is None:
+            return None
+        return snapshot.to_json()
 
-        return {
-            'image': image,
-            'size': int(size),
-            'positions': list([p async for p in self.get_positions(name)]),
-        }
+    async def get_meta(self, name):
+        """(image, size) of :name:, or None if the room doesn't exist"""
+        image, size = await self.room_redis(name).hmget(
+            self._get_room_meta_key(name), 'image', 'size', encoding='utf-8')
+        if image is None:
+            return None
+        return image, int(size)
+
+    async def get_positions(self, name, page_size=500):
+        """:name:'s positions, read from Redis a page at a time"""
+        cursor = None
+        while True:
+            page, cursor = await self.get_positions_page(
+                name, cursor, page_size)
+            for encoded in page:
+                yield json.loads(encoded)
+            if cursor is None:
+                return
+
+    async def get_positions_page(self, name, cursor=None, limit=500):
+        """
+        Up to about :limit: of :name:'s encoded positions, least recently
+        updated first, and the cursor of the next page (None after the last).
 
-    async def get_positions(self, name):
-        users = await self.redis.hgetall(self._get_position_key(name), encoding='utf-8')
-        keys = await self.redis.zrangebyscore(self._get_position_sort_key(name), encoding='utf-8')
-        for key in keys:
-            if key in users:
-                yield json.loads(users[key])
+        The cursor is the score of the page's last position and how many
+        positions with that score were returned, so each page is a single
+        bounded ZRANGEBYSCORE however large the room. A user who moves while
+        the room is paged through moves to a later page and may be returned
+        again, the later position being the current one; nobody is skipped.
+
+        Raises ValueError if :cursor: is malformed.
+        """
+        live_since = self._live_since()
+        after, skip, inclusive = live_since, 0, True
+        if cursor is not None:
+            score, skip = self.parse_cursor(cursor)
+            if score >= live_since:
+                after, inclusive = score, False
+            else:
+                # the rest of the previous page has expired since
+                skip = 0
+
+        redis = self.room_redis(name)
+        with metrics.ROOMSTORE_SECONDS.time(('get_positions',)):
+            entries = await redis.zrangebyscore(
+                self._get_position_sort_key(name), min=after, offset=skip,
+                count=limit, withscores=True, encoding='utf-8')
+            encoded = await redis.hmget(
+                self._get_position_key(name),
+                *(id_ for id_, _score in entries),
+                encoding='utf-8') if entries else []
+
+        unflushed = self._unflushed_scored(name)
+        page = [
+            (score, position)
+            for (id_, score), position in zip(entries, encoded)
+            if position is not None and id_ not in unflushed]
+        last = len(entries) < limit
+        end = math.inf if last else entries[-1][1]
+        # Positions not flushed yet go in the page covering their score
+        page.extend(
+            (score, position) for position, score in unflushed.values()
+            if (after <= score if inclusive else after < score)
+            and score <= end)
+        page.sort(key=lambda entry: entry[0])
+        positions = [position for _score, position in page]
+        if last:
+            return positions, None
+
+        ties = sum(1 for _id, score in entries if score == end)
+        if end == after:
+            ties += skip
+        return positions, self.format_cursor(end, ties)
+
+    @staticmethod
+    def format_cursor(score, skip):
+        return '{!r}:{}'.format(float(score), skip)
+
+    @staticmethod
+    def parse_cursor(cursor):
+        """(score, skip) of a cursor, raising ValueError if it's malformed"""
+        score, _, skip = cursor.rpartition(':')
+        score, skip = float(score), int(skip)
+        if math.isnan(score) or skip < 0:
+            raise ValueError('invalid cursor {!r}'.format(cursor))
+        return score, skip
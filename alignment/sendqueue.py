@@ -0,0 +1,70 @@
+import collections
+
+import asyncio
+
+DROP_OLDEST = 'drop-oldest'
+COALESCE = 'coalesce'
+DISCONNECT = 'disconnect'
+POLICIES = (DROP_OLDEST, COALESCE, DISCONNECT)
+
+
+class QueueOverflow(Exception):
+    """The queue is full and its policy is to disconnect the slow consumer"""
+
+
+class SendQueue:
+    """
+    Bounded outbound message queue for a single websocket.
+
+    put() never blocks. When the queue is full the :policy: decides what
+    happens:
+
+    * drop-oldest: discard the oldest queued message
+    * coalesce: replace the queued message with the same key (e.g. the same
+      user's older position), falling back to drop-oldest
+    * disconnect: raise QueueOverflow so the caller can drop the client
+    """
+
+    def __init__(self, maxsize=256, policy=DROP_OLDEST, loop=None):
+        if policy not in POLICIES:
+            raise ValueError('unknown overflow policy {!r}'.format(policy))
+        self.maxsize = maxsize
+        self.policy = policy
+        self.dropped = 0
+        self.coalesced = 0
+        self._entries = collections.deque()
+        self._keys = {}
+        self._ready = asyncio.Event(loop=loop)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def put(self, msg, key=None):
+        if len(self._entries) >= self.maxsize:
+            if self.policy == DISCONNECT:
+                raise QueueOverflow()
+            if self.policy == COALESCE and key in self._keys:
+                self._keys[key][1] = msg
+                self.coalesced += 1
+                return
+            self._pop()
+            self.dropped += 1
+
+        entry = [key, msg]
+        self._entries.append(entry)
+        if key is not None:
+            self._keys[key] = entry
+        self._ready.set()
+
+    async def get(self):
+        while not self._entries:
+            self._ready.clear()
+            await self._ready.wait()
+        return self._pop()
+
+    def _pop(self):
+        entry = self._entries.popleft()
+        key, msg = entry
+        if key is not None and self._keys.get(key) is entry:
+            del self._keys[key]
+        return msg
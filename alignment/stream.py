@@ -0,0 +1,106 @@
+import socket
+
+import aioredis
+
+
+class UpdateStream:
+    """
+    A Redis Stream of room updates read through a consumer group, so that
+    each update is handled by exactly one consumer across all nodes.
+
+    Entries that a consumer read but never acknowledged (e.g. because its node
+    died) are claimed by another consumer once they have been idle for
+    :claim_idle_ms:.
+
+    :consumer: names this node's consumer. It should stay the same across
+    restarts, so a restarted node picks up its own pending entries straight
+    away, and must differ between processes reading the stream at once;
+    it defaults to the hostname.
+    """
+
+    FIELD = b'msg'
+
+    def __init__(self,
+                 key='alignment_updates',
+                 group='alignment-persist',
+                 consumer=None,
+                 maxlen=100000,
+                 claim_idle_ms=30000,
+                 block_ms=1000,
+                 count=500):
+        self.key = key
+        self.group = group
+        self.consumer = consumer or socket.gethostname()
+        self.maxlen = maxlen
+        self.claim_idle_ms = claim_idle_ms
+        self.block_ms = block_ms
+        self.count = count
+
+    def append(self, redis, data):
+        """Add an encoded update to the stream, trimming it approximately"""
+        return redis.execute(
+            b'XADD', self.key, b'MAXLEN', b'~', self.maxlen, b'*',
+            self.FIELD, data)
+
+    async def ensure_group(self, redis):
+        try:
+            await redis.execute(
+                b'XGROUP', b'CREATE', self.key, self.group, b'0', b'MKSTREAM')
+        except aioredis.ReplyError as e:
+            if not str(e).startswith('BUSYGROUP'):
+                raise
+
+    async def read_pending(self, redis, after=b'0'):
+        """
+        Entries delivered to this consumer before but not acknowledged, with
+        ids greater than :after:. Returns a list of (entry id, data).
+        """
+        return await self._read_group(redis, after, block=False)
+
+    async def read_new(self, redis):
+        """
+        Block for up to :block_ms: waiting for entries not yet delivered to
+        any consumer. Returns a list of (entry id, data).
+        """
+        return await self._read_group(redis, b'>', block=True)
+
+    async def _read_group(self, redis, start, block):
+        args = [b'GROUP', self.group, self.consumer, b'COUNT', self.count]
+        if block:
+            args += [b'BLOCK', self.block_ms]
+        reply = await redis.execute(
+            b'XREADGROUP', *args, b'STREAMS', self.key, start)
+        if not reply:
+            return []
+        _stream, entries = reply[0]
+        return [(entry_id, self._data(fields)) for entry_id, fields in entries]
+
+    async def claim_stale(self, redis):
+        """
+        Take over entries other consumers have left unacknowledged for longer
+        than :claim_idle_ms:. Returns a list of (entry id, data).
+        """
+        pending = await redis.execute(
+            b'XPENDING', self.key, self.group, b'-', b'+', self.count)
+        stale = [
+            entry_id for entry_id, consumer, idle, _deliveries in pending
+            if idle >= self.claim_idle_ms
+            and consumer.decode('utf-8') != self.consumer
+        ]
+        if not stale:
+            return []
+        entries = await redis.execute(
+            b'XCLAIM', self.key, self.group, self.consumer,
+            self.claim_idle_ms, *stale)
+        # entries trimmed from the stream come back as nil
+        return [(entry_id, self._data(fields))
+                for entry_id, fields in (e for e in entries if e)
+                if fields is not None]
+
+    def ack(self, redis, entry_ids):
+        return redis.execute(b'XACK', self.key, self.group, *entry_ids)
+
+    def _data(self, fields):
+        fields = fields or []
+        values = dict(zip(fields[::2], fields[1::2]))
+        return values.get(self.FIELD)
@@ -0,0 +1,130 @@
+import json
+from collections import defaultdict, OrderedDict
+
+from alignment.redis import run_script
+
+# KEYS: handle -> user hash, user id -> handle hash, handle counter
+# ARGV: user id, encoded user
+# Returns the user's handle, allocating one the first time it's seen.
+REGISTER_SCRIPT = """
+local handle = redis.call('HGET', KEYS[2], ARGV[1])
+if not handle then
+    handle = redis.call('INCR', KEYS[3])
+    redis.call('HSET', KEYS[2], ARGV[1], handle)
+end
+redis.call('HSET', KEYS[1], handle, ARGV[2])
+return tonumber(handle)
+"""
+
+
+class UserRegistry:
+    """
+    Room-scoped numeric handles for users, so compact protocol updates don't
+    need to carry the whole user. Handles are allocated in Redis, so they're
+    the same on every node, and kept in memory for rooms this node serves.
+
+    Without Redis (:redis: is None) handles are allocated in memory, which is
+    only consistent within a single node.
+
+    With :max_rooms:, only that many rooms are kept in memory and the least
+    recently used one is forgotten; their handles are still in Redis, so this
+    needs Redis.
+    """
+
+    def __init__(self, room_prefix='alignment:room', max_rooms=None):
+        self.room_prefix = room_prefix
+        self.max_rooms = max_rooms
+        self._users = defaultdict(dict)
+        self._handles = defaultdict(dict)
+        self._counters = defaultdict(int)
+        self._recent = OrderedDict()
+
+    def _get_users_key(self, room):
+        return self.room_prefix + ':users:' + room
+
+    def _get_handles_key(self, room):
+        return self.room_prefix + ':handles:' + room
+
+    def _get_counter_key(self, room):
+        return self.room_prefix + ':users:next:' + room
+
+    def keys(self, room):
+        """Every Redis key kept for :room:"""
+        return [self._get_users_key(room), self._get_handles_key(room),
+                self._get_counter_key(room)]
+
+    async def register(self, redis, room, user):
+        """Return :user:'s handle in :room:, allocating it if needed"""
+        encoded = json.dumps(user)
+        if redis is None:
+            handle = self.handle(room, user['id'])
+            if handle is None:
+                self._counters[room] += 1
+                handle = self._counters[room]
+            self.remember(room, handle, user['id'], encoded)
+            return handle
+        handle = await run_script(redis, REGISTER_SCRIPT, keys=[
+            self._get_users_key(room),
+            self._get_handles_key(room),
+            self._get_counter_key(room),
+        ], args=[user['id'], encoded])
+        self.remember(room, handle, user['id'], encoded)
+        return handle
+
+    def remember(self, room, handle, id_, encoded):
+        self._users[room][handle] = encoded
+        self._handles[room][id_] = handle
+        self._touch(room)
+
+    def _touch(self, room):
+        if self.max_rooms is None:
+            return
+        self._recent[room] = None
+        self._recent.move_to_end(room)
+        while len(self._recent) > self.max_rooms:
+            oldest, _ = self._recent.popitem(last=False)
+            self.forget(oldest)
+
+    async def load(self, redis, room):
+        """Fetch every registered user in :room: from Redis"""
+        if redis is None:
+            return self._users[room]
+        users = await redis.hgetall(self._get_users_key(room), encoding='utf-8')
+        for handle, encoded in users.items():
+            id_ = json.loads(encoded).get('id')
+            self.remember(room, int(handle), id_, encoded)
+        return self._users[room]
+
+    def forget(self, room):
+        """
+        Drop what's known locally about :room:, once no local websocket is in
+        it. Without Redis nobody else knows its handles, so they start over.
+        """
+        self._users.pop(room, None)
+        self._handles.pop(room, None)
+        self._counters.pop(room, None)
+        self._recent.pop(room, None)
+
+    def users(self, room):
+        """Encoded users known locally in :room:, by handle"""
+        return dict(self._users.get(room, {}))
+
+    def user(self, room, handle):
+        """The encoded user for :handle:, if known locally"""
+        return self._users.get(room, {}).get(handle)
+
+    def handle(self, room, id_):
+        return self._handles.get(room, {}).get(id_)
+
+    async def lookup(self, redis, room, handle):
+        """The encoded user for :handle:, fetching it from Redis if needed"""
+        encoded = self.user(room, handle)
+        if encoded is not None:
+            self._touch(room)
+        elif redis is not None:
+            encoded = await redis.hget(
+                self._get_users_key(room), handle, encoding='utf-8')
+            if encoded is not None:
+                self.remember(
+                    room, handle, json.loads(encoded).get('id'), encoded)
+        return encoded
@@ -1,14 +1,175 @@
+import gzip
+import hashlib
+import mimetypes
+import os
+import re
+from functools import partial
+
 from aiohttp import web
+from structlog import get_logger
+
+try:
+    import brotli
+except ImportError:  # optional, only gzip variants are served without it
+    brotli = None
+
+log = get_logger()
+
+# create-react-app puts a content hash in the names of everything it builds
+# under static/, e.g. main.3f2a1b9c.js
+FINGERPRINTED = re.compile(r'\.[0-9a-f]{8,}\.')
+IMMUTABLE = 'public, max-age=31536000, immutable'
+REVALIDATE = 'no-cache'
+
+COMPRESSIBLE = re.compile(
+    r'^(text/|application/(javascript|json|xml|manifest\+json)|image/svg)')
+
+
+class Asset:
+    """
+    A file from the build, with its ETag and, for small files, its contents
+    and compressed variants held in memory.
+    """
+
+    def __init__(self, path, content_type, etag, cache_control,
+                 body=None, variants=None):
+        self.path = path
+        self.content_type = content_type
+        self.etag = etag
+        self.cache_control = cache_control
+        # None when the file is large enough to be sent from disk
+        self.body = body
+        # encoding -> compressed body
+        self.variants = variants or {}
+
+    def select(self, accept_encoding):
+        """(encoding or None, body, etag) for a request's Accept-Encoding"""
+        accepted = parse_accept_encoding(accept_encoding)
+        for encoding in ('br', 'gzip'):
+            if encoding in self.variants and encoding in accepted:
+                return (encoding, self.variants[encoding],
+                        '{}-{}"'.format(self.etag[:-1], encoding))
+        return None, self.body, self.etag
+
+
+def parse_accept_encoding(header):
+    """The content codings accepted by an Accept-Encoding header"""
+    accepted = set()
+    for coding in header.split(','):
+        name, *params = coding.split(';')
+        quality = 1
+        for param in params:
+            key, _, value = param.strip().partition('=')
+            if key == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    pass
+        if quality > 0:
+            accepted.add(name.strip().lower())
+    return accepted
+
+
+def load_asset(path, cache_control, sendfile_size, compress_min_size):
+    content_type, _encoding = mimetypes.guess_type(path)
+    content_type = content_type or 'application/octet-stream'
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(partial(f.read, 1 << 16), b''):
+            digest.update(chunk)
+    etag = '"{}"'.format(digest.hexdigest()[:20])
+    if os.path.getsize(path) > sendfile_size:
+        return Asset(path, content_type, etag, cache_control)
+
+    with open(path, 'rb') as f:
+        body = f.read()
+    variants = {}
+    if len(body) >= compress_min_size and COMPRESSIBLE.match(content_type):
+        candidates = {'gzip': partial(gzip.compress, compresslevel=9)}
+        if brotli is not None:
+            candidates['br'] = partial(brotli.compress, quality=11)
+        for encoding, compress in candidates.items():
+            # prefer what the build precompressed
+            precompressed = path + ('.br' if encoding == 'br' else '.gz')
+            if os.path.exists(precompressed):
+                with open(precompressed, 'rb') as f:
+                    compressed = f.read()
+            else:
+                compressed = compress(body)
+            if len(compressed) < len(body) * 0.9:
+                variants[encoding] = compressed
+    return Asset(path, content_type, etag, cache_control, body, variants)
+
 
 class WebappHandler:
-    def __init__(self):
-        with open('build/index.html') as idx:
-            self.react_template = idx.read()
+    def __init__(self,
+                 build_dir='build',
+                 sendfile_size=1 << 20,
+                 compress_min_size=256):
+        """
+        Serves the React app shell and its static files from :build_dir:.
+        Everything is read, hashed and compressed once at startup. Files
+        larger than :sendfile_size: bytes are sent from disk instead.
+        """
+        self.build_dir = build_dir
+        self.sendfile_size = sendfile_size
+        self.compress_min_size = compress_min_size
+        self.index = None
+        self.assets = {}
 
     def setup(self, app):
-        app.router.add_get('/app', self.app_page, name="app")
+        app.on_startup.append(self.load_assets)
+        app.router.add_get('/app', self.app_page, name='app_index')
         app.router.add_get('/app/room/{room}', self.app_page, name="app")
-        app.router.add_static('/static', 'build/static')
+        app.router.add_get('/static/{path:.+}', self.static, name='static')
+
+    async def load_assets(self, app):
+        # compressing can take a while, keep the loop responsive meanwhile
+        await app.loop.run_in_executor(None, self._load_assets)
+        log.info('loaded assets', count=len(self.assets))
+
+    def _load_assets(self):
+        load = partial(load_asset,
+                       sendfile_size=self.sendfile_size,
+                       compress_min_size=self.compress_min_size)
+        self.index = load(
+            os.path.join(self.build_dir, 'index.html'), REVALIDATE)
+        static_dir = os.path.join(self.build_dir, 'static')
+        for root, _dirs, files in os.walk(static_dir):
+            for name in files:
+                if name.endswith(('.gz', '.br')) and name[:-3] in files:
+                    continue
+                path = os.path.join(root, name)
+                relative = os.path.relpath(path, static_dir).replace(os.sep, '/')
+                cache_control = (
+                    IMMUTABLE if FINGERPRINTED.search(name) else REVALIDATE)
+                self.assets[relative] = load(path, cache_control)
 
     async def app_page(self, request):
-        return web.Response(text=self.react_template, content_type='text/html')
+        return self.respond(request, self.index)
+
+    async def static(self, request):
+        asset = self.assets.get(request.match_info['path'])
+        if asset is None:
+            raise web.HTTPNotFound
+        return self.respond(request, asset)
+
+    def respond(self, request, asset):
+        encoding, body, etag = asset.select(
+            request.headers.get('Accept-Encoding', ''))
+        headers = {'ETag': etag, 'Cache-Control': asset.cache_control}
+        if asset.variants:
+            headers['Vary'] = 'Accept-Encoding'
+
+        if_none_match = request.headers.get('If-None-Match')
+        if if_none_match is not None and (
+                if_none_match.strip() == '*' or
+                etag in (tag.strip() for tag in if_none_match.split(','))):
+            return web.Response(status=304, headers=headers)
+
+        if body is None:
+            return web.FileResponse(asset.path, headers=headers)
+        if encoding is not None:
+            headers['Content-Encoding'] = encoding
+        return web.Response(
+            body=body, content_type=asset.content_type, headers=headers)
@@ -1,104 +1,829 @@
 import json
 import itertools
-from collections import namedtuple, defaultdict
+import math
+import random
+import struct
+import time
+from collections import defaultdict, Counter, OrderedDict
 import logging
 
 import asyncio
 from aiohttp import web, WSMsgType, WSCloseCode
 from structlog import get_logger
 
-from alignment.redis import REDIS_POOL_KEY
+from alignment import binary as compact
+from alignment import envelope
+from alignment import metrics
+from alignment.limits import TokenBucket, validate_update, validate_user
+from alignment.bus import BUS_KEY
+from alignment.connections import ConnectionRegistry
+from alignment.envelope import Update
+from alignment.redis import REDIS_POOL_KEY, room_redis
+from alignment.room import RoomSnapshot, RoomStore
+from alignment.sendqueue import SendQueue, QueueOverflow, DROP_OLDEST
+from alignment.users import UserRegistry
 
 log = get_logger()
 
-WebsocketHandle = namedtuple('WebsocketHandle', ['ws', 'sid'])
+
+class WebsocketHandle:
+    """
+    A connected websocket, its outbound queue and the task writing that queue
+    to the socket, so a slow client only ever holds up itself.
+    """
+    __slots__ = ('ws', 'sid', 'queue', 'binary', 'sequenced', 'held',
+                 'writer', 'finished', 'disconnecting')
+
+    def __init__(self, ws, sid, queue, binary=False, sequenced=False,
+                 loop=None):
+        self.ws = ws
+        self.sid = sid
+        self.queue = queue
+        self.binary = binary
+        # frames are wrapped with the room sequence number
+        self.sequenced = sequenced
+        # while resuming: live (seq, frame, key)s held back until the missed
+        # updates have been queued
+        self.held = None
+        self.writer = None
+        # set once the websocket's handler is done with it
+        self.finished = asyncio.Event(loop=loop)
+        # set once it's being closed for falling behind
+        self.disconnecting = False
+
+    async def write_messages(self):
+        try:
+            while not self.ws.closed:
+                await self.send(await self.queue.get())
+        except asyncio.CancelledError:
+            pass
+        except (ConnectionError, RuntimeError) as e:
+            log.info("websocket write failed", sid=self.sid, error=str(e))
+
+    async def send(self, msg):
+        if metrics.TRACING:
+            start = time.monotonic()
+        if isinstance(msg, bytes):
+            await self.ws.send_bytes(msg)
+        else:
+            await self.ws.send_str(msg)
+        if metrics.TRACING:
+            metrics.WS_SEND_SECONDS.observe(time.monotonic() - start)
+
+    async def flush(self):
+        """Stop the writer and write out whatever is still queued"""
+        self.writer.cancel()
+        await asyncio.wait([self.writer])
+        try:
+            while len(self.queue) and not self.ws.closed:
+                await self.send(await self.queue.get())
+        except (ConnectionError, RuntimeError) as e:
+            log.info("websocket write failed", sid=self.sid, error=str(e))
 
 
 class WebsocketHandler:
     WEBSOCKET_KEY = 'websockets'
-    LISTENER_KEY = 'redis-listener'
+    LISTENER_KEY = 'bus-listener'
+    RECEIVER_KEY = 'bus-receiver'
+    SUBSCRIPTIONS_KEY = 'bus-subscriptions'
+    STATS_KEY = 'websocket-stats'
+    TICKER_KEY = 'tick-broadcaster'
+
+    def __init__(self,
+                 pubsub_key='alignment_rooms',
+                 sharded=False,
+                 send_queue_size=256,
+                 overflow_policy=DROP_OLDEST,
+                 tick_ms=None,
+                 update_stream=None,
+                 room_prefix='alignment:room',
+                 replay_log=None,
+                 max_msg_size=64 * 1024,
+                 rate=None,
+                 burst=None,
+                 max_room_connections=None,
+                 max_connections=None,
+                 validate=True,
+                 drain_timeout=10,
+                 reconnect_window=5):
+        """
+        :sharded: when set, every room gets its own channel (``pubsub_key:room``)
+        and this node only subscribes to the channels of rooms that have at
+        least one local websocket.
+        :send_queue_size: and :overflow_policy: configure each websocket's
+        outbound SendQueue.
+        :tick_ms: when set, inbound updates are held for up to this many
+        milliseconds, keeping only the latest one per user, and each room's
+        updates are published and delivered as a single batch. Clients then
+        receive a JSON list of updates per frame instead of single updates.
+        :update_stream: an UpdateStream every update is also appended to, for
+        an APIHandler persisting from the same stream.
+        :room_prefix: the Redis key prefix of the compact protocol's user
+        handles and of the rooms sent to websockets joining with
+        ``?snapshot=1``; it should match the APIHandler's
+        :room_persist_prefix:.
+        :replay_log: a ReplayLog numbering each room's updates. Websockets
+        connecting with ``?seq=1`` then get every update wrapped as
+        ``{"seq": n, "update": ...}`` (``"updates"`` for a batch), and ones
+        reconnecting with ``?last_seq=n`` are first sent what they missed.
+
+        Admission control, applied before anything is published:
+        :max_msg_size: bytes per frame, larger ones close the websocket with
+        1009 (message too big). :rate: messages (or compact records) per
+        second per websocket, in bursts of up to :burst:; messages over the
+        limit are dropped, and a websocket that keeps going after another
+        :burst: of them is closed with 1008 (policy violation).
+        :max_room_connections: per room and :max_connections: on this node;
+        websockets over either are closed with 1013 (try again later).
+        :validate: drops updates that don't look like a user's position.
 
-    def __init__(self, pubsub_key='alignment_rooms'):
+        On shutdown the node drains: new websockets are turned away with 1012
+        and open ones are handed off, all at once. Each is sent what's still
+        queued for it, then ``{"reconnect": {"after": s}}`` with s a random
+        delay of up to :reconnect_window: seconds, so clients don't all
+        reconnect together, and is closed with 1012 (service restart) if it
+        hasn't closed itself after s seconds. Any still open after
+        :drain_timeout: seconds are closed regardless.
+        """
         self.pubsub_key = pubsub_key
+        self.sharded = sharded
+        self.send_queue_size = send_queue_size
+        self.overflow_policy = overflow_policy
+        self.tick_ms = tick_ms
+        self.update_stream = update_stream
+        self.replay_log = replay_log
+        self.max_msg_size = max_msg_size
+        self.rate = rate
+        self.burst = burst or rate
+        self.max_room_connections = max_room_connections
+        self.max_connections = max_connections
+        self.validate = validate
+        self.drain_timeout = drain_timeout
+        self.reconnect_window = reconnect_window
+        self.draining = False
+        self.pending = defaultdict(OrderedDict)
+        self.unkeyed = itertools.count()
+        self.room_prefix = room_prefix
+        self.user_registry = UserRegistry(room_prefix)
+        # rooms with local websockets -> the task loading their users
+        self.user_loads = {}
+        # RoomSnapshots of the rooms with local websockets, kept current from
+        # the updates this node relays
+        self.room_states = {}
+        # rooms whose state is being loaded -> (task, updates seen meanwhile)
+        self.room_loads = {}
 
     def setup(self, app):
-        app[self.WEBSOCKET_KEY] = defaultdict(list)
+        self.room_store = RoomStore(app, self.room_prefix, cache_size=0)
+        app[self.WEBSOCKET_KEY] = ConnectionRegistry()
+        app[self.SUBSCRIPTIONS_KEY] = set()
+        app[self.STATS_KEY] = Counter()
+        self.subscription_lock = asyncio.Lock(loop=app.loop)
         app.router.add_get('/ws', self.handle_ws, name='ws')
+        app.router.add_get('/ws/stats', self.stats)
+        metrics.WS_CONNECTIONS.set_function(
+            lambda: len(app[self.WEBSOCKET_KEY]))
+        metrics.WS_QUEUED.set_function(
+            lambda: self.queue_stats(app)['queued'])
+        metrics.WS_DROPPED.set_function(
+            lambda: self.queue_stats(app)['dropped'])
+        metrics.WS_COALESCED.set_function(
+            lambda: self.queue_stats(app)['coalesced'])
+        metrics.WS_OVERFLOWS.set_function(
+            lambda: app[self.STATS_KEY]['overflow_disconnects'])
 
         app.on_startup.append(self.start_send_messages)
-        app.on_shutdown.append(self.close_open_websockets)
         app.on_shutdown.append(self.shutdown_send_messages)
+        if self.tick_ms:
+            app.on_startup.append(self.start_tick)
+            # Runs before shutdown_send_messages so the last batch still
+            # goes out over Redis.
+            app.on_shutdown.insert(0, self.shutdown_tick)
+        # First of all, whichever handlers were set up before this one, so
+        # what clients send while being handed off is still persisted.
+        app.on_shutdown.insert(0, self.drain)
+
 
+    def channel_name(self, room):
+        if self.sharded:
+            return '{}:{}'.format(self.pubsub_key, room)
+        return self.pubsub_key
 
     async def start_send_messages(self, app):
+        app[self.RECEIVER_KEY] = app[BUS_KEY].receiver()
+        if not self.sharded:
+            await app[BUS_KEY].subscribe(
+                app[self.RECEIVER_KEY], self.pubsub_key)
         app[self.LISTENER_KEY] = app.loop.create_task(self.send_messages(app))
 
     async def shutdown_send_messages(self, app):
         app[self.LISTENER_KEY].cancel()
         await app[self.LISTENER_KEY]
 
+    async def start_tick(self, app):
+        app[self.TICKER_KEY] = app.loop.create_task(self.tick(app))
+
+    async def shutdown_tick(self, app):
+        app[self.TICKER_KEY].cancel()
+        await app[self.TICKER_KEY]
+        await self.flush_pending(app)
+
+    async def tick(self, app):
+        """
+        Every :tick_ms: publish the updates collected since the last tick.
+        """
+        try:
+            while True:
+                await asyncio.sleep(self.tick_ms / 1000, loop=app.loop)
+                await self.flush_pending(app)
+        except asyncio.CancelledError:
+            pass
+
+    async def flush_pending(self, app):
+        """
+        Publish one batch per room holding the latest update from each user.
+        """
+        pending, self.pending = self.pending, defaultdict(OrderedDict)
+        for room, updates in pending.items():
+            try:
+                await self.publish(app, room, envelope.pack(
+                    room, list(updates.values()), batch=True,
+                    sent=time.time()))
+            except Exception:
+                log.exception("failed to publish batch", room=room)
+
+    async def publish(self, app, room, data):
+        """
+        Publish an envelope for :room: and, if configured, append it to the
+        update stream as well.
+        """
+        with metrics.BUS_PUBLISH_SECONDS.time():
+            if self.replay_log is not None:
+                published = self.replay_log.publish(
+                    app, self.channel_name(room), room, data)
+            else:
+                published = app[BUS_KEY].publish(
+                    self.channel_name(room), data,
+                    room=room if self.sharded else None)
+            if self.update_stream is None:
+                await published
+            else:
+                await asyncio.gather(
+                    published,
+                    self.update_stream.append(app[REDIS_POOL_KEY], data),
+                    loop=app.loop)
+
+    def queue_update(self, room, update):
+        key = update.key
+        if key is None:
+            key = next(self.unkeyed)
+        updates = self.pending[room]
+        # move_to_end keeps the batch in the order users last moved
+        updates[key] = update
+        updates.move_to_end(key)
+
     async def send_messages(self, app):
         """
-        Listen on the Redis channel specified in :pubsub_key: for messages.
+        Listen on the bus channel specified in :pubsub_key: (or, when sharded,
+        on the channels of every room with a local websocket) for messages.
         When they're received, fan them out to all websockets in that room except the websocket that
         the message originated from (identified by SID)
         """
-        redis = await app[REDIS_POOL_KEY]
+        receiver = app[self.RECEIVER_KEY]
         try:
-            channel, *_ = await redis.subscribe(self.pubsub_key)
-            async for msg in channel.iter(
-                    encoding='utf-8', decoder=json.loads):
-                sid = msg.pop('sid', None)
-                room = msg.pop('room', None)
-                if sid is None or room is None:
-                    log.error(
-                        "message missing sid or room", sid=sid, room=room)
+            async for msg in receiver:
+                try:
+                    room, batch, updates, sent, seq = envelope.read(msg)
+                except envelope.EnvelopeError as e:
+                    log.error("malformed envelope", error=str(e))
                     continue
-                for ws in app[self.WEBSOCKET_KEY][room]:
-                    if ws.ws.closed or ws.sid == sid:
-                        continue
-                    await ws.ws.send_json(msg)
+                if sent is not None:
+                    metrics.BUS_LAG_SECONDS.observe(
+                        max(time.time() - sent, 0), ('fanout',))
+                with metrics.FANOUT_SECONDS.time():
+                    self.deliver(app, room, updates, batch, seq)
         except asyncio.CancelledError:
             pass
         finally:
-            await redis.unsubscribe(self.pubsub_key)
+            await app[BUS_KEY].close(receiver)
+
+    def deliver(self, app, room, updates, batch, seq=None):
+        """
+        Send :updates: to every websocket in :room: except the ones they came
+        from. A batch goes out as a single frame per protocol. Each distinct
+        frame is built only once, however many websockets receive it.
+        Rooms without local websockets are ignored, so nothing is kept about
+        them.
+        """
+        if room not in app[self.WEBSOCKET_KEY]:
+            return
+        for update in updates:
+            if update.kind == envelope.USER:
+                registered = json.loads(update.payload)
+                user = registered['user']
+                self.user_registry.remember(
+                    room, registered['handle'], user.get('id'), json.dumps(user))
+        self.track_state(room, updates, seq)
+
+        rendered = {}
+        def render(i, binary):
+            if (i, binary) not in rendered:
+                rendered[i, binary] = self.render(room, updates[i], binary)
+            return rendered[i, binary]
+
+        key = updates[0].key if len(updates) == 1 else None
+        senders = {update.sid for update in updates}
+        frames = {}
+        queued = 0
+        for ws in app[self.WEBSOCKET_KEY].in_room(room):
+            if ws.ws.closed:
+                continue
+            excluded = ws.sid if ws.sid in senders else None
+            kind = (excluded, ws.binary, ws.sequenced)
+            if kind not in frames:
+                frames[kind] = self.build_frames(
+                    updates, batch, seq, excluded, ws.binary, ws.sequenced,
+                    render)
+            for frame in frames[kind]:
+                if ws.held is not None:
+                    ws.held.append((seq, frame, key))
+                else:
+                    self.enqueue(app, ws, room, frame, key)
+                queued += 1
+        metrics.WS_FRAMES.inc(queued)
+
+    def build_frames(self, updates, batch, seq, excluded, binary, sequenced,
+                     render):
+        """
+        The frames delivering :updates: to a websocket, leaving out those
+        from :excluded:. :render:(index, binary) renders a single update.
+        """
+        parts = [
+            render(i, binary) for i, update in enumerate(updates)
+            if update.sid != excluded
+        ]
+        frames = self.combine(parts, batch)
+        if sequenced and seq is not None:
+            field = 'updates' if batch else 'update'
+            frames = [
+                frame if isinstance(frame, bytes)
+                else '{{"seq": {}, "{}": {}}}'.format(seq, field, frame)
+                for frame in frames
+            ]
+        return frames
+
+    def track_state(self, room, updates, seq=None):
+        """
+        Apply :updates: to :room:'s local state, if this node keeps one.
+        """
+        state = self.room_states.get(room)
+        if state is None:
+            loading = self.room_loads.get(room)
+            if loading is not None:
+                loading[1].append((updates, seq))
+            return
+        if seq is not None:
+            state.seq = seq
+        self.apply_updates(state, room, updates)
+
+    def apply_updates(self, state, room, updates):
+        for update in updates:
+            if update.key is None or update.kind == envelope.USER:
+                continue
+            encoded = self.render(room, update, False)
+            if encoded is not None:
+                state.set_position(update.key, encoded)
 
-    async def close_open_websockets(self, app):
+    async def room_state(self, app, room):
         """
-        Iterate over all registered websockts and close them all.
+        The RoomSnapshot of :room:, loaded from Redis by the first websocket
+        to ask for it and maintained locally from then on. Joins while it is
+        loading share the one read.
         """
-        for ws in itertools.chain(*app[self.WEBSOCKET_KEY].values()):
-            await ws.ws.close(
-                code=WSCloseCode.GOING_AWAY, message="server-shutdown")
+        state = self.room_states.get(room)
+        if state is not None:
+            return state
+        if room not in self.room_loads:
+            self.room_loads[room] = (
+                app.loop.create_task(self.load_room_state(app, room)), [])
+        return await asyncio.shield(self.room_loads[room][0])
+
+    async def load_room_state(self, app, room):
+        """
+        Positions reach Redis a flush interval or so after they're sent, so
+        the stored room may lack the latest ones. With a replay log, the
+        envelopes it still holds are applied over the stored room, and the
+        snapshot is tagged with the last of them: as long as the log holds
+        more than a flush interval's worth of a room's updates, the
+        snapshot has everything up to its sequence number. Without one, a
+        room first loaded on this node may be up to the APIHandler's
+        :flush_interval: out of date: positions sent before this node
+        subscribed to the room and not yet flushed are missing, until those
+        users next move.
+        """
+        try:
+            state = seq = None
+            if REDIS_POOL_KEY in app:
+                state = await self.room_store.load_snapshot(room)
+            if state is None:
+                state = RoomSnapshot(None, RoomStore.DEFAULT_SIZE, OrderedDict())
+            if self.replay_log is not None:
+                # Read after the stored room, so any position in it is no
+                # newer than the logged ones applied over it. Updates after
+                # the log's last are relayed meanwhile, and applied below.
+                seq, logged = await self.replay_log.recent(app, room)
+                for data in logged:
+                    self.apply_updates(
+                        state, room, envelope.read(data).updates)
+            state.seq = seq
+            _task, relayed = self.room_loads[room]
+            self.room_states[room] = state
+            # updates relayed while Redis was being read are newer
+            for updates, seq in relayed:
+                self.track_state(room, updates, seq)
+            if room not in app[self.WEBSOCKET_KEY]:
+                # everyone left in the meantime
+                del self.room_states[room]
+            return state
+        finally:
+            del self.room_loads[room]
+
+    def render(self, room, update, binary):
+        """
+        The frame delivering :update: to a JSON (text) or compact (binary)
+        protocol websocket, or None if it can't be expressed in that protocol.
+        """
+        if update.kind == envelope.POSITION:
+            handle, x, y = compact.decode_position(update.payload)
+            if binary:
+                return compact.pack(handle, x, y)
+            user = self.user_registry.user(room, handle)
+            if user is None:
+                log.error("position for unknown user handle", room=room,
+                          handle=handle)
+                return None
+            return compact.position_json(user, x, y)
+
+        if not binary:
+            # registrations are only of interest to compact clients
+            return update.payload if update.kind == envelope.JSON else None
+
+        handle = self.user_registry.handle(room, update.key)
+        if update.kind == envelope.JSON and handle is not None:
+            try:
+                position = json.loads(update.payload)['position']
+                return compact.pack(handle, position['x'], position['y'])
+            except (ValueError, KeyError, TypeError, struct.error):
+                pass
+        return update.payload
+
+    @staticmethod
+    def combine(parts, batch):
+        """
+        Turn rendered updates into the frames to send. A batch becomes at
+        most one binary frame of records and one text frame with a JSON list.
+        """
+        parts = [part for part in parts if part is not None]
+        if not batch:
+            return parts
+        records = [part for part in parts if isinstance(part, bytes)]
+        texts = [part for part in parts if not isinstance(part, bytes)]
+        frames = []
+        if records:
+            frames.append(b''.join(records))
+        if texts:
+            frames.append(envelope.frame(texts))
+        return frames
+
+    def enqueue(self, app, ws, room, msg, key=None):
+        try:
+            ws.queue.put(msg, key=key)
+        except QueueOverflow:
+            self.disconnect_slow(app, ws, room)
+
+    def disconnect_slow(self, app, ws, room):
+        if ws.disconnecting:
+            return
+        ws.disconnecting = True
+        log.warning("send queue overflow, disconnecting", sid=ws.sid, room=room)
+        app[self.STATS_KEY]['overflow_disconnects'] += 1
+        app.loop.create_task(ws.ws.close(
+            code=WSCloseCode.TRY_AGAIN_LATER, message="send-queue-overflow"))
+
+    async def stats(self, request):
+        """
+        Report outbound queue depth and drop counts for this node.
+        """
+        return web.json_response(self.queue_stats(request.app))
+
+    def queue_stats(self, app):
+        handles = list(app[self.WEBSOCKET_KEY])
+        depths = [len(ws.queue) for ws in handles]
+        totals = app[self.STATS_KEY]
+        return {
+            'connections': len(handles),
+            'queued': sum(depths),
+            'max_queue_depth': max(depths, default=0),
+            'dropped': totals['dropped'] + sum(
+                ws.queue.dropped for ws in handles),
+            'coalesced': totals['coalesced'] + sum(
+                ws.queue.coalesced for ws in handles),
+            'overflow_disconnects': totals['overflow_disconnects'],
+        }
+
+    async def sync_subscription(self, app, room):
+        """
+        Make this node's subscription to :room:'s channel match whether it has
+        any local websockets in that room. Only used in sharded mode.
+        """
+        async with self.subscription_lock:
+            subscribed = app[self.SUBSCRIPTIONS_KEY]
+            wanted = room in app[self.WEBSOCKET_KEY]
+            channel = self.channel_name(room)
+            if wanted and room not in subscribed:
+                await app[BUS_KEY].subscribe(
+                    app[self.RECEIVER_KEY], channel, room=room)
+                subscribed.add(room)
+            elif not wanted and room in subscribed:
+                await app[BUS_KEY].unsubscribe(app[self.RECEIVER_KEY], channel)
+                subscribed.discard(room)
+
+    async def submit(self, app, room, update):
+        """Publish an inbound update, or hold it for the next tick"""
+        if self.tick_ms:
+            self.queue_update(room, update)
+        else:
+            await self.publish(app, room, envelope.pack(
+                room, [update], sent=time.time()))
+
+    async def load_users(self, app, room):
+        """
+        Make sure the compact protocol users of :room: are known locally,
+        loading them from Redis for the first websocket in the room.
+        """
+        load = self.user_loads.get(room)
+        if load is None or (load.done() and load.exception() is not None):
+            # joins while it runs wait for the same load; a failed one is
+            # retried by the next
+            load = self.user_loads[room] = app.loop.create_task(
+                self.user_registry.load(room_redis(app, room), room))
+        await asyncio.shield(load)
+        return self.user_registry.users(room)
+
+    async def register_users(self, app, handle, room, users, registered):
+        """
+        Allocate handles for a compact protocol client's users, announce them
+        to the room and tell the client which handle is whose.
+        """
+        redis = room_redis(app, room)
+        handles = {}
+        if not isinstance(users, list):
+            users = []
+        for user in users:
+            error = validate_user(user)
+            if error is not None:
+                log.error("cannot register user", sid=handle.sid, error=error)
+                continue
+            user_handle = await self.user_registry.register(redis, room, user)
+            registered[user_handle] = user['id']
+            handles[user['id']] = user_handle
+            # Published straight away, ahead of any position using it
+            await self.publish(app, room, envelope.pack(room, [Update(
+                handle.sid, None,
+                json.dumps({'handle': user_handle, 'user': user}),
+                envelope.USER)], sent=time.time()))
+        handle.queue.put(json.dumps({'handles': handles}))
+
+    @staticmethod
+    def snapshot_frame(state, sequenced=False):
+        if sequenced and state.seq is not None:
+            return '{{"room": {}, "seq": {}}}'.format(state.to_json(), state.seq)
+        return '{{"room": {}}}'.format(state.to_json())
+
+    async def resume(self, app, handle, room, last_seq):
+        """
+        Send a reconnected websocket the updates to :room: after :last_seq:,
+        or the whole room if the replay log no longer has all of them, then
+        release the live updates held back meanwhile.
+        """
+        try:
+            missed = await self.replay_log.since(app, room, last_seq)
+            if missed is None:
+                state = await self.room_state(app, room)
+                handle.queue.put(self.snapshot_frame(state, True))
+                last_seq = state.seq or 0
+            for data in missed or ():
+                _room, batch, updates, _sent, seq = envelope.read(data)
+                for frame in self.build_frames(
+                        updates, batch, seq, handle.sid, False, True,
+                        lambda i, binary: self.render(
+                            room, updates[i], binary)):
+                    self.enqueue(app, handle, room, frame)
+                last_seq = seq
+        finally:
+            held, handle.held = handle.held, None
+            for seq, frame, key in held:
+                if seq is None or seq > last_seq:
+                    self.enqueue(app, handle, room, frame, key)
+
+    async def drain(self, app):
+        """
+        Stop accepting websockets and hand off the open ones concurrently,
+        then publish any updates they sent meanwhile.
+        """
+        self.draining = True
+        handles = list(app[self.WEBSOCKET_KEY])
+        if handles:
+            log.info("draining websockets", count=len(handles))
+            _done, pending = await asyncio.wait(
+                [self.hand_off(handle) for handle in handles],
+                timeout=self.drain_timeout, loop=app.loop)
+            for task in pending:
+                task.cancel()
+            if pending:
+                log.warning("websockets still open after drain timeout",
+                            count=len(pending))
+                await asyncio.gather(
+                    *(handle.ws.close(code=WSCloseCode.SERVICE_RESTART,
+                                      message='server-restart')
+                      for handle in handles if not handle.ws.closed),
+                    loop=app.loop, return_exceptions=True)
+        if self.tick_ms:
+            await self.flush_pending(app)
+
+    async def hand_off(self, handle):
+        """
+        Tell :handle:'s client to reconnect after a random delay and close
+        the websocket once that's passed, unless the client did already.
+        """
+        after = random.uniform(0, self.reconnect_window)
+        await handle.flush()
+        try:
+            await handle.send(
+                '{{"reconnect": {{"after": {:.3f}}}}}'.format(after))
+        except (ConnectionError, RuntimeError):
+            pass
+        try:
+            await asyncio.wait_for(handle.finished.wait(), after)
+        except asyncio.TimeoutError:
+            await handle.ws.close(
+                code=WSCloseCode.SERVICE_RESTART, message='server-restart')
 
     async def handle_ws(self, request):
         """
         Listen for room activity on a websocket. Every message that is
-        recieved is annotated with the sid and the room then put onto the redis
-        pubsub channel.
+        recieved is wrapped in an envelope with the sid and the room then put
+        onto the redis pubsub channel.
+
+        With ``?snapshot=1`` the websocket is first sent the room as the API
+        would return it, as ``{"room": {...}}``; see load_room_state() for
+        how current that is. With a replay log, JSON protocol websockets
+        can ask for sequence numbers with ``?seq=1`` and resume with
+        ``?last_seq=n``; the snapshot then carries its sequence number as
+        ``{"room": {...}, "seq": n}``.
         """
         sid = request.query.get('sid')
         if sid is None:
             raise web.HTTPBadRequest(text='missing sid parameter')
 
         room = request.query.get('room', 'default')
+        last_seq = request.query.get('last_seq')
+        if last_seq is not None:
+            try:
+                last_seq = int(last_seq)
+            except ValueError:
+                raise web.HTTPBadRequest(text='invalid last_seq parameter')
 
-        ws = web.WebSocketResponse()
+        ws = web.WebSocketResponse(
+            protocols=(compact.PROTOCOL,), max_msg_size=self.max_msg_size)
         await ws.prepare(request)
+        binary = ws.ws_protocol == compact.PROTOCOL
+
+        websockets = request.app[self.WEBSOCKET_KEY]
+        if self.draining:
+            metrics.WS_REJECTED.inc(labels=('draining',))
+            await ws.close(
+                code=WSCloseCode.SERVICE_RESTART, message='server-restart')
+            return ws
+        full = None
+        if self.max_connections and len(websockets) >= self.max_connections:
+            full = 'server-full'
+        elif (self.max_room_connections and
+              websockets.count(room) >= self.max_room_connections):
+            full = 'room-full'
+        if full is not None:
+            metrics.WS_REJECTED.inc(labels=(full,))
+            await ws.close(code=WSCloseCode.TRY_AGAIN_LATER, message=full)
+            return ws
+        sequenced = (self.replay_log is not None and not binary and (
+            last_seq is not None or request.query.get('seq') == '1'))
 
-        handle = WebsocketHandle(ws, sid)
+        handle = WebsocketHandle(ws, sid, SendQueue(
+            maxsize=self.send_queue_size,
+            policy=self.overflow_policy,
+            loop=request.app.loop), binary=binary, sequenced=sequenced,
+            loop=request.app.loop)
+        if sequenced and last_seq is not None:
+            handle.held = []
+        handle.writer = request.app.loop.create_task(handle.write_messages())
+        # compact protocol handles registered by this websocket -> user ids
+        registered = {}
+        bucket = TokenBucket(self.rate, self.burst) if self.rate else None
+        # messages dropped by the rate limit since the last one let through
+        throttled = 0
 
-        request.app[self.WEBSOCKET_KEY][room].append(handle)
+        websockets.add(room, handle)
         try:
+            if self.sharded:
+                await self.sync_subscription(request.app, room)
+            users = await self.load_users(request.app, room)
+            if binary:
+                handle.queue.put('{{"users": {{{}}}}}'.format(', '.join(
+                    '"{}": {}'.format(h, user) for h, user in users.items())))
+            if handle.held is not None:
+                await self.resume(request.app, handle, room, last_seq)
+            elif request.query.get('snapshot') == '1':
+                # Subscribed already, so the snapshot misses nothing; any
+                # update queued ahead of it is included in it as well.
+                state = await self.room_state(request.app, room)
+                handle.queue.put(self.snapshot_frame(state, sequenced))
             async for msg in ws:
+                if msg.type in (WSMsgType.TEXT, WSMsgType.BINARY):
+                    cost = 1
+                    if msg.type == WSMsgType.BINARY:
+                        cost = max(1, len(msg.data) // compact.RECORD.size)
+                    if bucket is not None and not bucket.consume(cost):
+                        metrics.WS_REJECTED.inc(labels=('rate-limited',))
+                        throttled += 1
+                        if throttled > self.burst:
+                            log.warning("websocket over rate limit", sid=sid,
+                                        room=room)
+                            await ws.close(
+                                code=WSCloseCode.POLICY_VIOLATION,
+                                message='rate-limited')
+                            break
+                        continue
+                    throttled = 0
+
                 if msg.type == WSMsgType.TEXT:
-                    decoded = json.loads(msg.data)
-                    decoded.update(sid=sid, room=room)
-                    await request.app[REDIS_POOL_KEY].publish_json(
-                        self.pubsub_key, decoded)
+                    metrics.WS_MESSAGES.inc(labels=('json',))
+                    # Decoded only to check it and find the user; what gets
+                    # forwarded is the original text.
+                    try:
+                        decoded = json.loads(msg.data)
+                    except ValueError:
+                        decoded = None
+                    if not isinstance(decoded, dict):
+                        metrics.WS_REJECTED.inc(labels=('invalid',))
+                        log.error("message is not an object", sid=sid)
+                        continue
+                    if binary and 'register' in decoded:
+                        await self.register_users(
+                            request.app, handle, room, decoded['register'],
+                            registered)
+                        continue
+                    error = validate_update(decoded) if self.validate else None
+                    if error is not None:
+                        metrics.WS_REJECTED.inc(labels=('invalid',))
+                        log.error("invalid update", sid=sid, error=error)
+                        continue
+                    user = decoded.get('user')
+                    key = (user.get('id') if isinstance(user, dict)
+                           else decoded.get('userID'))
+                    await self.submit(
+                        request.app, room, Update(sid, key, msg.data))
+                elif msg.type == WSMsgType.BINARY and binary:
+                    metrics.WS_MESSAGES.inc(labels=('binary',))
+                    try:
+                        records = compact.unpack(msg.data)
+                    except compact.ProtocolError as e:
+                        log.error("malformed binary frame", error=str(e))
+                        continue
+                    for user_handle, x, y in records:
+                        if user_handle not in registered:
+                            log.error("unregistered user handle", sid=sid,
+                                      handle=user_handle)
+                            continue
+                        if not (math.isfinite(x) and math.isfinite(y)):
+                            metrics.WS_REJECTED.inc(labels=('invalid',))
+                            continue
+                        await self.submit(request.app, room, Update(
+                            sid, registered[user_handle],
+                            compact.encode_position(user_handle, x, y),
+                            envelope.POSITION))
                 elif msg.type == WSMsgType.ERROR:
                     log.error("websocket error", error=msg.exception())
         finally:
-            request.app[self.WEBSOCKET_KEY][room].remove(handle)
+            handle.finished.set()
+            handle.writer.cancel()
+            stats = request.app[self.STATS_KEY]
+            stats['dropped'] += handle.queue.dropped
+            stats['coalesced'] += handle.queue.coalesced
+            if websockets.remove(room, handle):
+                self.room_states.pop(room, None)
+                self.user_registry.forget(room)
+                self.user_loads.pop(room, None)
+            if self.sharded:
+                await self.sync_subscription(request.app, room)
 
         return ws
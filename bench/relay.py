@@ -0,0 +1,287 @@
+"""
+Load generator and latency benchmark for the /ws -> bus -> fan-out relay.
+
+Starts the relay in a child process against a local Redis, connects
+thousands of simulated clients spread over several rooms and replays drag
+traffic: each client occasionally drags an avatar for a second or two,
+sending updates at --rate per second, then idles. Every update carries its
+send time, so receivers can measure end-to-end latency.
+
+Reports p50/p95/p99 latency, delivered messages per second, server CPU time
+per inbound message, server memory per connection and how many clients
+failed, and writes them as JSON so runs can be compared across commits:
+
+    python bench/relay.py --clients 2000 --rooms 20 --output before.json
+    python bench/relay.py --clients 2000 --rooms 20 --compare before.json
+"""
+import argparse
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+import multiprocessing
+from collections import Counter
+
+import asyncio
+import aiohttp
+from aiohttp import web
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from alignment.bus import LocalBus, RedisBus  # noqa: E402
+from alignment.redis import RedisPool  # noqa: E402
+from alignment.websocket import WebsocketHandler  # noqa: E402
+
+CLK_TCK = os.sysconf('SC_CLK_TCK')
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--clients', type=int, default=1000)
+    parser.add_argument('--rooms', type=int, default=10)
+    parser.add_argument('--duration', type=float, default=30,
+                        help='seconds of traffic to measure')
+    parser.add_argument('--rate', type=float, default=30,
+                        help='updates per second while dragging')
+    parser.add_argument('--dragging', type=float, default=0.1,
+                        help='fraction of clients dragging at any time')
+    parser.add_argument('--redis-url', default='redis://localhost')
+    parser.add_argument('--bus', choices=('redis', 'local'), default='redis')
+    parser.add_argument('--sharded', action='store_true')
+    parser.add_argument('--tick-ms', type=int, default=None)
+    parser.add_argument('--samples', type=int, default=200000,
+                        help='latency samples to keep (reservoir)')
+    parser.add_argument('--output', help='write results as JSON here')
+    parser.add_argument('--compare', help='results JSON to compare against')
+    return parser.parse_args(argv)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def serve(args, port):
+    """Run the relay; the body of the server process"""
+    app = web.Application()
+    if args.bus == 'redis':
+        RedisPool(redis_url=args.redis_url).setup(app)
+        RedisBus().setup(app)
+    else:
+        LocalBus().setup(app)
+    WebsocketHandler(sharded=args.sharded, tick_ms=args.tick_ms).setup(app)
+    web.run_app(app, host='127.0.0.1', port=port, print=None)
+
+
+def process_stats(pid):
+    """(CPU seconds, resident bytes) of :pid:, from /proc"""
+    with open('/proc/{}/stat'.format(pid)) as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    cpu = (int(fields[11]) + int(fields[12])) / CLK_TCK
+    with open('/proc/{}/statm'.format(pid)) as f:
+        rss = int(f.read().split()[1]) * PAGE_SIZE
+    return cpu, rss
+
+
+class Recorder:
+    """Counts deliveries and keeps a uniform sample of their latencies"""
+
+    def __init__(self, size):
+        self.size = size
+        self.samples = []
+        self.seen = 0
+        self.sent = 0
+        self.recording = False
+
+    def record(self, latency):
+        if not self.recording:
+            return
+        self.seen += 1
+        if len(self.samples) < self.size:
+            self.samples.append(latency)
+        else:
+            i = random.randrange(self.seen)
+            if i < self.size:
+                self.samples[i] = latency
+
+    def percentile(self, p):
+        if not self.samples:
+            return None
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+
+async def client(session, url, sid, room, args, recorder, stop):
+    user = {
+        'id': '{}-{}'.format(room, sid),
+        'username': 'bench{}'.format(sid),
+        'discriminator': '0000',
+        'avatar': None,
+    }
+    async with session.ws_connect(url.format(sid=sid, room=room)) as ws:
+        async def receive():
+            async for msg in ws:
+                if msg.type != aiohttp.WSMsgType.TEXT:
+                    continue
+                now = time.time()
+                data = json.loads(msg.data)
+                for update in data if isinstance(data, list) else [data]:
+                    recorder.record(now - update['sent'])
+
+        receiver = asyncio.ensure_future(receive())
+        x, y = random.uniform(0, 600), random.uniform(0, 600)
+        interval = 1 / args.rate
+        try:
+            while not stop.is_set():
+                # idle, then drag for a second or two
+                idle = random.expovariate(args.dragging / 1.5)
+                try:
+                    await asyncio.wait_for(stop.wait(), idle)
+                    break
+                except asyncio.TimeoutError:
+                    pass
+                drag_until = time.monotonic() + random.uniform(1, 2)
+                while time.monotonic() < drag_until and not stop.is_set():
+                    x = min(max(x + random.gauss(0, 5), 0), 600)
+                    y = min(max(y + random.gauss(0, 5), 0), 600)
+                    await ws.send_str(json.dumps({
+                        'user': user,
+                        'position': {'x': round(x), 'y': round(y)},
+                        'sent': time.time(),
+                    }))
+                    if recorder.recording:
+                        recorder.sent += 1
+                    await asyncio.sleep(interval)
+        finally:
+            receiver.cancel()
+
+
+async def run_load(args, port, server_pid):
+    url = 'http://127.0.0.1:{}/ws?sid={{sid}}&room={{room}}'.format(port)
+    recorder = Recorder(args.samples)
+    stop = asyncio.Event()
+    connector = aiohttp.TCPConnector(limit=0)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        _cpu, idle_rss = process_stats(server_pid)
+        clients = [
+            asyncio.ensure_future(client(
+                session, url, sid, 'bench-room-{}'.format(sid % args.rooms),
+                args, recorder, stop))
+            for sid in range(args.clients)
+        ]
+        # let everyone connect and settle before measuring
+        await asyncio.sleep(min(10, 1 + args.clients / 500))
+        cpu_start, connected_rss = process_stats(server_pid)
+        recorder.recording = True
+        started = time.monotonic()
+        await asyncio.sleep(args.duration)
+        recorder.recording = False
+        elapsed = time.monotonic() - started
+        cpu_end, _rss = process_stats(server_pid)
+
+        stop.set()
+        outcomes = await asyncio.gather(*clients, return_exceptions=True)
+
+    # a client that couldn't connect, or was disconnected, ends with an error
+    errors = Counter(
+        '{}: {}'.format(type(outcome).__name__, outcome)
+        for outcome in outcomes if isinstance(outcome, Exception))
+    for error, count in errors.most_common():
+        print('{} clients failed with {}'.format(count, error),
+              file=sys.stderr)
+
+    def ms(seconds):
+        return None if seconds is None else round(seconds * 1000, 3)
+
+    return {
+        'config': {
+            'clients': args.clients,
+            'rooms': args.rooms,
+            'duration': args.duration,
+            'rate': args.rate,
+            'dragging': args.dragging,
+            'bus': args.bus,
+            'sharded': args.sharded,
+            'tick_ms': args.tick_ms,
+        },
+        'commit': git_commit(),
+        'latency_ms': {
+            'p50': ms(recorder.percentile(50)),
+            'p95': ms(recorder.percentile(95)),
+            'p99': ms(recorder.percentile(99)),
+        },
+        'sent_per_second': round(recorder.sent / elapsed, 1),
+        'delivered_per_second': round(recorder.seen / elapsed, 1),
+        'cpu_us_per_inbound_message': round(
+            (cpu_end - cpu_start) / max(recorder.sent, 1) * 1e6, 2),
+        'server_cpu_percent': round((cpu_end - cpu_start) / elapsed * 100, 1),
+        'memory_bytes_per_connection': round(
+            (connected_rss - idle_rss) / max(args.clients, 1)),
+        'client_errors': sum(errors.values()),
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline):
+    """Print each metric next to the baseline's"""
+    def flatten(d, prefix=''):
+        for key, value in d.items():
+            if isinstance(value, dict):
+                yield from flatten(value, prefix + key + '.')
+            elif isinstance(value, (int, float)) and not isinstance(value, bool):
+                yield prefix + key, value
+
+    old = dict(flatten({k: v for k, v in baseline.items() if k != 'config'}))
+    for key, value in flatten({k: v for k, v in results.items()
+                               if k != 'config'}):
+        before = old.get(key)
+        if before:
+            print('{:40} {:>12} -> {:>12} ({:+.1f}%)'.format(
+                key, before, value, (value - before) / before * 100))
+        else:
+            print('{:40} {:>12}'.format(key, value))
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    port = free_port()
+    server = multiprocessing.Process(target=serve, args=(args, port))
+    server.start()
+    try:
+        loop = asyncio.get_event_loop()
+        for _ in range(100):
+            try:
+                socket.create_connection(('127.0.0.1', port), 0.1).close()
+                break
+            except OSError:
+                time.sleep(0.1)
+        results = loop.run_until_complete(run_load(args, port, server.pid))
+    finally:
+        server.terminate()
+        server.join()
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+    else:
+        print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
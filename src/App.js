@@ -80,8 +80,24 @@ class App extends Component {
     }
 
     onMessage(e) {
-        const {userID, position} = JSON.parse(e.data);
-        this.updatePosition(userID, position);
+        const message = JSON.parse(e.data);
+        if (message.reconnect) {
+            // the server is going away: reconnect (to another one) after
+            // the delay it picked, so everyone doesn't reconnect at once
+            const ws = this.state.ws;
+            ws.close(1000);
+            setTimeout(() => ws.open(), message.reconnect.after * 1000);
+            return;
+        }
+        // with TICK_MS set, updates arrive batched in a list
+        const updates = Array.isArray(message) ? message : [message];
+        for (const {userID, user, position} of updates) {
+            // the API relays positions with the whole user, not userID
+            const id = userID !== undefined ? userID : user && user.id;
+            if (this.state.members.has(id)) {
+                this.updatePosition(id, position);
+            }
+        }
     }
 
     render() {
@@ -14,7 +14,9 @@ class DiscordImage extends Component {
             ...others
         } = this.props;
         const imageSize = Math.pow(2, Math.ceil(Math.log2(size)));
-        const url = `${baseURL}${objectID}/${imageID}.png?size=${imageSize}`;
+        // through the server's caching image proxy
+        const origin = `${baseURL}${objectID}/${imageID}.png`;
+        const url = `/image?url=${encodeURIComponent(origin)}&size=${imageSize}`;
         return (
                 <img {...others}
             src={url} height={size} width={size}
@@ -1,12 +1,18 @@
+import json
 import unittest
 import uuid
 
 import aioredis
+import asyncio
 from aiohttp.test_utils import AioHTTPTestCase, unittest_run_loop
 from aiohttp import web
 
+from alignment import envelope
 from alignment.api import APIHandler
+from alignment.bus import BUS_KEY, RedisBus
 from alignment.redis import RedisPool
+from alignment.replay import RedisReplayLog
+from alignment.users import UserRegistry
 from redis_util import cleanup_redis_ns
 
 
@@ -16,9 +22,10 @@ class APITest(AioHTTPTestCase):
 
         app = web.Application()
         redis = RedisPool(redis_url='redis://localhost')
-        api = APIHandler(room_persist_prefix=self.prefix)
+        self.api = APIHandler(room_persist_prefix=self.prefix)
         redis.setup(app)
-        api.setup(app)
+        RedisBus().setup(app)
+        self.api.setup(app)
         return app
 
     async def tearDownAsync(self):
@@ -29,6 +36,14 @@ class APITest(AioHTTPTestCase):
         resp = await self.client.request('GET', '/api/v1/room/someroomid')
         self.assertEqual(resp.status, 404)
 
+    @unittest_run_loop
+    async def test_room_without_image(self):
+        store = self.api.room_store
+        await store.redis.hset(
+            store._get_room_meta_key('noimage'), 'size', 128)
+        resp = await self.client.request('GET', '/api/v1/room/noimage')
+        self.assertEqual(resp.status, 404)
+
     @unittest_run_loop
     async def test_create_no_image(self):
         resp = await self.client.post('/api/v1/room/', json={})
@@ -52,5 +67,306 @@ class APITest(AioHTTPTestCase):
             'positions': []
         })
 
+    @unittest_run_loop
+    async def test_write_behind_positions(self):
+        store = self.api.room_store
+        await store.create_room('wb', 'https://http.cat/202')
+        user = {'id': '1', 'username': 'a'}
+        for x in range(5):
+            await store.set_position('wb', user, {'x': x, 'y': 0})
+        other = {'id': '2', 'username': 'b'}
+        await store.set_position('wb', other, {'x': 7, 'y': 7})
+
+        expected = [
+            {'user': user, 'position': {'x': 4, 'y': 0}},
+            {'user': other, 'position': {'x': 7, 'y': 7}},
+        ]
+        # visible before the buffer is flushed
+        room = await store.get_room('wb')
+        self.assertEqual(room['positions'], expected)
+
+        self.assertTrue(await store.flush())
+        self.assertEqual(
+            await store.redis.hlen(store._get_position_key('wb')), 2)
+        room = await store.get_room('wb')
+        self.assertEqual(room['positions'], expected)
+        self.assertEqual(json.loads(await store.get_room_json('wb')), room)
+
+    @unittest_run_loop
+    async def test_etag(self):
+        await self.api.room_store.create_room('etag', 'https://http.cat/304')
+        resp = await self.client.get('/api/v1/room/etag')
+        self.assertEqual(resp.status, 200)
+        etag = resp.headers['ETag']
+
+        resp = await self.client.get(
+            '/api/v1/room/etag', headers={'If-None-Match': etag})
+        self.assertEqual(resp.status, 304)
+
+        await self.api.room_store.set_position(
+            'etag', {'id': '1'}, {'x': 1, 'y': 1})
+        resp = await self.client.get(
+            '/api/v1/room/etag', headers={'If-None-Match': etag})
+        self.assertEqual(resp.status, 200)
+        self.assertNotEqual(resp.headers['ETag'], etag)
+        body = await resp.json()
+        self.assertEqual(body['positions'], [
+            {'user': {'id': '1'}, 'position': {'x': 1, 'y': 1}}])
+
+        # the same room, reloaded, keeps its ETag
+        etag = resp.headers['ETag']
+        self.assertTrue(await self.api.room_store.flush())
+        self.api.room_store._cache.clear()
+        resp = await self.client.get(
+            '/api/v1/room/etag', headers={'If-None-Match': etag})
+        self.assertEqual(resp.status, 304)
+
+    @unittest_run_loop
+    async def test_paginated_positions(self):
+        store = self.api.room_store
+        await store.create_room('pages', 'https://http.cat/206')
+        for i in range(25):
+            await store.set_position(
+                'pages', {'id': str(i)}, {'x': i, 'y': i})
+            if i == 19:
+                # the last few stay buffered
+                self.assertTrue(await store.flush())
+
+        ids = []
+        url = '/api/v1/room/pages/positions?limit=10'
+        resp = await self.client.get(url)
+        while True:
+            self.assertEqual(resp.status, 200)
+            body = await resp.json()
+            self.assertLessEqual(len(body['positions']), 10)
+            ids.extend(p['user']['id'] for p in body['positions'])
+            if body['next'] is None:
+                break
+            resp = await self.client.get(url, params={'cursor': body['next']})
+        self.assertEqual(ids, [str(i) for i in range(25)])
+
+        resp = await self.client.get(
+            '/api/v1/room/pages/positions', params={'cursor': 'nope'})
+        self.assertEqual(resp.status, 400)
+        resp = await self.client.get('/api/v1/room/nowhere/positions')
+        self.assertEqual(resp.status, 404)
+
+    @unittest_run_loop
+    async def test_stream(self):
+        self.api.page_size = 3
+        store = self.api.room_store
+        await store.create_room('stream', 'https://http.cat/200')
+        for i in range(8):
+            await store.set_position(
+                'stream', {'id': str(i)}, {'x': i, 'y': 0})
+        self.assertTrue(await store.flush())
+
+        resp = await self.client.get('/api/v1/room/stream?stream=1')
+        self.assertEqual(resp.status, 200)
+        streamed = await resp.json()
+        resp = await self.client.get('/api/v1/room/stream')
+        self.assertEqual(streamed, await resp.json())
+        self.assertEqual(len(streamed['positions']), 8)
+
+        resp = await self.client.get('/api/v1/room/nowhere?stream=1')
+        self.assertEqual(resp.status, 404)
+
+    @unittest_run_loop
+    async def test_create_batch(self):
+        resp = await self.client.post('/api/v1/rooms/', json={'rooms': [
+            {'image': 'https://http.cat/201'},
+            {'size': 64},
+            {'image': 'https://http.cat/202', 'size': 64},
+        ]})
+        self.assertEqual(resp.status, 200)
+        created, missing, sized = (await resp.json())['rooms']
+        self.assertEqual(missing, {'error': 'missing image parameter'})
+
+        resp = await self.client.get(created['api_url'])
+        self.assertEqual((await resp.json())['size'], 128)
+        resp = await self.client.get(sized['api_url'])
+        self.assertEqual(await resp.json(), {
+            'image': 'https://http.cat/202', 'size': 64, 'positions': []})
+
+        self.api.max_batch_size = 2
+        resp = await self.client.post(
+            '/api/v1/rooms/', json={'rooms': [{'image': 'x'}] * 3})
+        self.assertEqual(resp.status, 413)
+
+    @unittest_run_loop
+    async def test_set_positions_batch(self):
+        store = self.api.room_store
+        await store.create_room('bulk', 'https://http.cat/200')
+        # buffered, and superseded by the batch
+        await store.set_position('bulk', {'id': '0'}, {'x': -1, 'y': -1})
+        positions = [
+            {'user': {'id': str(i)}, 'position': {'x': i, 'y': i}}
+            for i in range(1200)]
+        self.api.max_batch_size = 2000
+        bus = self.app[BUS_KEY]
+        receiver = bus.receiver()
+        await bus.subscribe(receiver, self.api.pubsub_key)
+        resp = await self.client.post(
+            '/api/v1/room/bulk/positions',
+            json={'positions': positions + [{'user': {'id': 'x'}}]})
+        self.assertEqual(resp.status, 200)
+        results = (await resp.json())['positions']
+        self.assertEqual(results[:-1], [{'ok': True}] * 1200)
+        self.assertIn('error', results[-1])
+
+        # relayed to websockets as a batch per chunk
+        relayed = []
+        for _ in range(3):
+            room, batch, updates = envelope.unpack(
+                await asyncio.wait_for(receiver.__anext__(), 5))
+            self.assertEqual((room, batch), ('bulk', True))
+            relayed.extend(json.loads(u.payload) for u in updates)
+        await bus.close(receiver)
+        self.assertEqual(relayed, positions)
+
+        self.assertTrue(await store.flush())
+        self.assertEqual(
+            await store.redis.hlen(store._get_position_key('bulk')), 1200)
+        stored = [p async for p in store.get_positions('bulk')]
+        self.assertEqual(
+            sorted(stored, key=lambda p: int(p['user']['id'])), positions)
+
+        resp = await self.client.post(
+            '/api/v1/room/nowhere/positions', json={'positions': []})
+        self.assertEqual(resp.status, 404)
+
+    @unittest_run_loop
+    async def test_compact_users_bounded(self):
+        registry = self.api.user_registry
+        registry.max_rooms = 2
+        for room in ('a', 'b', 'c'):
+            await registry.register(
+                self.api.room_store.room_redis(room), room, {'id': room})
+        # a was the least recently used, and is still in Redis
+        self.assertEqual(sorted(registry._users), ['b', 'c'])
+        user = await registry.lookup(
+            self.api.room_store.room_redis('a'), 'a', 1)
+        self.assertEqual(json.loads(user), {'id': 'a'})
+        self.assertEqual(sorted(registry._users), ['a', 'c'])
+
+    @unittest_run_loop
+    async def test_set_positions_replayed(self):
+        self.api.replay_log = RedisReplayLog(key_prefix=self.prefix)
+        await self.api.room_store.create_room('logged', 'https://http.cat/200')
+        positions = [
+            {'user': {'id': str(i)}, 'position': {'x': i, 'y': i}}
+            for i in range(3)]
+        resp = await self.client.post(
+            '/api/v1/room/logged/positions', json={'positions': positions})
+        self.assertEqual(resp.status, 200)
+
+        # numbered like the websockets' updates, so resuming clients get it
+        seq, logged = await self.api.replay_log.recent(self.app, 'logged')
+        self.assertEqual(seq, 1)
+        self.assertEqual(len(logged), 1)
+        read = envelope.read(logged[0])
+        self.assertEqual(
+            (read.room, read.batch, read.seq), ('logged', True, 1))
+        self.assertEqual(
+            [json.loads(u.payload) for u in read.updates], positions)
+
+
+class RoomLifecycleTest(AioHTTPTestCase):
+    async def get_application(self):
+        self.prefix = 'test_lifecycle:'
+
+        app = web.Application()
+        redis = RedisPool(redis_url='redis://localhost')
+        self.api = APIHandler(room_persist_prefix=self.prefix,
+                              room_ttl=3600, position_ttl=60)
+        redis.setup(app)
+        RedisBus().setup(app)
+        self.api.setup(app)
+        return app
+
+    async def tearDownAsync(self):
+        await cleanup_redis_ns(self.prefix)
+
+    @unittest_run_loop
+    async def test_expiry_and_compaction(self):
+        store = self.api.room_store
+        await store.create_room('life', 'https://http.cat/410')
+        await store.set_position('life', {'id': '1'}, {'x': 1, 'y': 1})
+        await store.set_position('life', {'id': '2'}, {'x': 2, 'y': 2})
+        await UserRegistry(self.prefix).register(
+            store.redis, 'life', {'id': '1'})
+        self.assertTrue(await store.flush())
+
+        for key in store._get_room_keys('life'):
+            self.assertGreater(await store.redis.ttl(key), 0)
+        self.assertIsNotNone(await store.redis.zscore(
+            store._get_active_rooms_key(), 'life'))
+
+        # user 1 left two minutes ago
+        await store.redis.zadd(
+            store._get_position_sort_key('life'), store.time() - 120, '1')
+        positions = [p async for p in store.get_positions('life')]
+        self.assertEqual(positions, [
+            {'user': {'id': '2'}, 'position': {'x': 2, 'y': 2}}])
+
+        self.assertEqual(await store.compact(), 1)
+        self.assertEqual(
+            await store.redis.hkeys(
+                store._get_position_key('life'), encoding='utf-8'), ['2'])
+
+        # and everyone has left since
+        await store.redis.zadd(
+            store._get_position_sort_key('life'), store.time() - 120, '2')
+        await store.redis.zadd(
+            store._get_active_rooms_key(), store.time() - 120, 'life')
+        self.assertEqual(await store.compact(), 1)
+        self.assertIsNone(await store.redis.zscore(
+            store._get_active_rooms_key(), 'life'))
+
+
+class ShardedRoomTest(AioHTTPTestCase):
+    async def get_application(self):
+        self.prefix = 'test_sharded:'
+        self.urls = ['redis://localhost/0', 'redis://localhost/1']
+
+        app = web.Application()
+        redis = RedisPool(redis_url=','.join(self.urls))
+        self.api = APIHandler(room_persist_prefix=self.prefix)
+        redis.setup(app)
+        RedisBus().setup(app)
+        self.api.setup(app)
+        return app
+
+    async def tearDownAsync(self):
+        for url in self.urls:
+            await cleanup_redis_ns(self.prefix, url)
+
+    @unittest_run_loop
+    async def test_rooms_on_their_shard(self):
+        store = self.api.room_store
+        rooms = ['shard{}'.format(i) for i in range(20)]
+        for room in rooms:
+            await store.create_room(room, 'https://http.cat/200')
+            await store.set_position(room, {'id': '1'}, {'x': 1, 'y': 1})
+        self.assertTrue(await store.flush())
+
+        self.assertEqual(len(store.shards), 2)
+        used = set()
+        for room in rooms:
+            redis = store.room_redis(room)
+            used.add(redis)
+            for other in store.shards:
+                self.assertEqual(
+                    await other.exists(store._get_position_key(room)),
+                    int(other is redis))
+            self.assertTrue(
+                await redis.exists(store._get_room_meta_key(room)))
+            store._cache.clear()
+            room_body = await store.get_room(room)
+            self.assertEqual(room_body['positions'], [
+                {'user': {'id': '1'}, 'position': {'x': 1, 'y': 1}}])
+        self.assertEqual(len(used), 2)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,30 @@
+import json
+import unittest
+
+from alignment import binary
+
+
+class BinaryTest(unittest.TestCase):
+    def test_round_trip(self):
+        frame = binary.pack(7, 100, 200.5) + binary.pack(8, 0, 1)
+        self.assertEqual(len(frame), 24)
+        self.assertEqual(binary.unpack(frame), [(7, 100, 200.5), (8, 0, 1)])
+
+    def test_bad_length(self):
+        for frame in (b'', b'\x00' * 13):
+            with self.assertRaises(binary.ProtocolError):
+                binary.unpack(frame)
+
+    def test_position_payload(self):
+        payload = binary.encode_position(7, 100.0, 200.5)
+        self.assertEqual(payload, '7 100 200.5')
+        handle, x, y = binary.decode_position(payload)
+        self.assertEqual((handle, x, y), (7, 100, 200.5))
+        self.assertIsInstance(x, int)
+        self.assertEqual(
+            json.loads(binary.position_json('{"id": "1"}', x, y)),
+            {'user': {'id': '1'}, 'position': {'x': 100, 'y': 200.5}})
+
+
+if __name__ == "__main__":
+    unittest.main()
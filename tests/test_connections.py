@@ -0,0 +1,65 @@
+import unittest
+
+from alignment.connections import ConnectionRegistry
+
+
+class Connection:
+    __slots__ = ('sid',)
+
+    def __init__(self, sid):
+        self.sid = sid
+
+
+class ConnectionRegistryTest(unittest.TestCase):
+    def test_rooms(self):
+        registry = ConnectionRegistry()
+        a, b, c = Connection('a'), Connection('b'), Connection('c')
+        registry.add('room', a)
+        registry.add('room', b)
+        registry.add('other', c)
+        self.assertEqual(registry.in_room('room'), (a, b))
+        self.assertEqual(registry.count('room'), 2)
+        self.assertEqual(len(registry), 3)
+        self.assertEqual(set(registry), {a, b, c})
+        self.assertIs(registry.get('b'), b)
+
+        self.assertFalse(registry.remove('room', a))
+        self.assertEqual(registry.in_room('room'), (b,))
+        self.assertIsNone(registry.get('a'))
+        self.assertTrue(registry.remove('room', b))
+        self.assertNotIn('room', registry)
+        self.assertEqual(registry.rooms(), ['other'])
+        self.assertEqual(len(registry), 1)
+
+    def test_lookups_leave_nothing_behind(self):
+        registry = ConnectionRegistry()
+        self.assertEqual(registry.in_room('nowhere'), ())
+        self.assertEqual(registry.count('nowhere'), 0)
+        self.assertNotIn('nowhere', registry)
+        self.assertTrue(registry.remove('nowhere', Connection('a')))
+        self.assertEqual(registry.rooms(), [])
+
+    def test_snapshot(self):
+        registry = ConnectionRegistry()
+        a, b = Connection('a'), Connection('b')
+        registry.add('room', a)
+        snapshot = registry.in_room('room')
+        self.assertIs(registry.in_room('room'), snapshot)
+        # changes don't affect a snapshot being iterated
+        for connection in snapshot:
+            registry.add('room', b)
+            registry.remove('room', connection)
+        self.assertEqual(snapshot, (a,))
+        self.assertEqual(registry.in_room('room'), (b,))
+
+    def test_reused_sid(self):
+        registry = ConnectionRegistry()
+        first, second = Connection('a'), Connection('a')
+        registry.add('room', first)
+        registry.add('room', second)
+        registry.remove('room', first)
+        self.assertIs(registry.get('a'), second)
+
+
+if __name__ == '__main__':
+    unittest.main()
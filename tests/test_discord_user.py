@@ -0,0 +1,92 @@
+import base64
+import functools
+import os
+import unittest
+
+import asyncio
+from aiohttp.test_utils import AioHTTPTestCase, unittest_run_loop
+from aiohttp import web
+
+from alignment.discord_user import DiscordUserHandler
+from alignment.discordclient import DiscordClient
+
+
+class DiscordUserTest(AioHTTPTestCase):
+    """Talks to a stub of Discord's API served by the test server"""
+
+    user = {'id': '11358', 'username': 'stillinbeta', 'avatar': 'abc'}
+
+    async def get_application(self):
+        self.calls = 0
+        self.rate_limited = 0
+        self.retry_after_ms = 10
+
+        app = web.Application()
+        app.router.add_get('/api/v6/users/@me', self.stub_me)
+
+        self.handler = DiscordUserHandler(
+            cookie_secret=base64.urlsafe_b64decode(
+                base64.urlsafe_b64encode(os.urandom(32))),
+            oauth_client_id='client',
+            oauth_client_secret='secret',
+            redirect_uri='http://localhost/auth',
+        )
+        self.handler.setup(app)
+        return app
+
+    async def stub_me(self, request):
+        self.calls += 1
+        if self.rate_limited:
+            self.rate_limited -= 1
+            return web.json_response(
+                {'retry_after': self.retry_after_ms}, status=429)
+        # give concurrent lookups a chance to pile up
+        await asyncio.sleep(0.05)
+        return web.json_response(self.user)
+
+    def setUp(self):
+        super().setUp()
+        self.handler.discord_client_class = type(
+            'StubDiscordClient', (DiscordClient,), {
+                'name': 'stub-discord',
+                'user_info_url': str(
+                    self.client.make_url('/api/v6/users/@me')),
+            })
+
+    @unittest_run_loop
+    async def test_user_info_cached(self):
+        self.assertEqual(await self.handler.fetch_user_info('t'), self.user)
+        self.assertEqual(await self.handler.fetch_user_info('t'), self.user)
+        self.assertEqual(self.calls, 1)
+
+        await self.handler.fetch_user_info('other-token')
+        self.assertEqual(self.calls, 2)
+
+    @unittest_run_loop
+    async def test_concurrent_lookups_coalesced(self):
+        users = await asyncio.gather(
+            *[self.handler.fetch_user_info('t') for _ in range(5)],
+            loop=self.loop)
+        self.assertEqual(users, [self.user] * 5)
+        self.assertEqual(self.calls, 1)
+
+    @unittest_run_loop
+    async def test_rate_limit_retried(self):
+        self.rate_limited = 2
+        self.assertEqual(await self.handler.fetch_user_info('t'), self.user)
+        self.assertEqual(self.calls, 3)
+
+    @unittest_run_loop
+    async def test_rate_limit_delay_capped(self):
+        self.rate_limited = 2
+        self.retry_after_ms = 60 * 1000
+        self.handler.discord_client_class = functools.partial(
+            self.handler.discord_client_class,
+            timeout=0.2, max_retry_delay=0.15)
+        # the waits are longer than an attempt's timeout, but not part of it
+        self.assertEqual(await self.handler.fetch_user_info('t'), self.user)
+        self.assertEqual(self.calls, 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,51 @@
+import json
+import unittest
+
+from alignment import envelope
+from alignment.envelope import Update
+
+
+class EnvelopeTest(unittest.TestCase):
+    def test_round_trip(self):
+        update = Update('1', '11358', '{"user": {"username": "ßtill\\n"}}')
+        room, batch, updates = envelope.unpack(
+            envelope.pack('room\nwith newline', [update]))
+        self.assertEqual(room, 'room\nwith newline')
+        self.assertFalse(batch)
+        self.assertEqual(updates, [update])
+
+    def test_batch(self):
+        updates = [Update('1', 'a', '{"x": "ü"}'), Update('2', None, '[]')]
+        room, batch, unpacked = envelope.unpack(
+            envelope.pack('r', updates, batch=True))
+        self.assertTrue(batch)
+        self.assertEqual(unpacked, updates)
+        self.assertEqual(
+            json.loads(envelope.frame(u.payload for u in unpacked)), [{'x': 'ü'}, []])
+
+    def test_kind(self):
+        update = Update('1', '11358', '7 100 200.5', envelope.POSITION)
+        _room, _batch, updates = envelope.unpack(
+            envelope.pack('r', [update]))
+        self.assertEqual(updates, [update])
+
+    def test_sent(self):
+        data = envelope.pack('r', [Update('1', None, '{}')], sent=12.5)
+        self.assertEqual(envelope.read(data).sent, 12.5)
+        self.assertIsNone(envelope.read(envelope.pack('r', [])).sent)
+
+    def test_sequence(self):
+        update = Update('1', None, '{}')
+        data = envelope.sequence(envelope.pack('r', [update]), 42)
+        self.assertEqual(envelope.read(data), envelope.Envelope(
+            'r', False, [update], None, 42))
+
+    def test_malformed(self):
+        for data in ('', 'not json\n{}', '{"room": "r"}\n',
+                     '{"room": "r", "updates": [["1", null, 10]]}\n{}'):
+            with self.assertRaises(envelope.EnvelopeError):
+                envelope.unpack(data)
+
+
+if __name__ == "__main__":
+    unittest.main()
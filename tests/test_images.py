@@ -0,0 +1,151 @@
+import base64
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+import asyncio
+from aiohttp.test_utils import AioHTTPTestCase, unittest_run_loop
+from aiohttp import web
+
+from alignment import images
+from alignment.images import ImageProxyHandler
+
+# a 1x1 transparent PNG
+PIXEL = base64.b64decode(
+    'iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNkYPhfDwAChw'
+    'GA60e6kgAAAABJRU5ErkJggg==')
+
+
+class ImageProxyTest(AioHTTPTestCase):
+    """Proxies a stub origin served by the test server"""
+
+    async def get_application(self):
+        self.calls = 0
+        self.cache_dir = tempfile.mkdtemp()
+
+        app = web.Application()
+        app.router.add_get('/origin/moved.png', self.stub_redirect)
+        app.router.add_get('/origin/page.html', self.stub_page)
+        app.router.add_get('/origin/{name}.png', self.stub_image)
+        self.handler = ImageProxyHandler(
+            cache_dir=self.cache_dir,
+            max_cache_bytes=len(PIXEL) * 2,
+            allowed_hosts=('127.0.0.1',),
+            allowed_schemes=('http',))
+        self.handler.setup(app)
+        return app
+
+    def tearDown(self):
+        super().tearDown()
+        shutil.rmtree(self.cache_dir)
+
+    async def stub_image(self, request):
+        self.calls += 1
+        # give concurrent misses a chance to pile up
+        await asyncio.sleep(0.05)
+        return web.Response(body=PIXEL, content_type='image/png')
+
+    async def stub_page(self, request):
+        return web.Response(text='<html></html>', content_type='text/html')
+
+    async def stub_redirect(self, request):
+        raise web.HTTPFound('/origin/a.png')
+
+    def proxy(self, name, **params):
+        origin = self.client.make_url('/origin/{}'.format(name))
+        return self.client.get('/image', params=dict(url=str(origin), **params))
+
+    @unittest_run_loop
+    async def test_cached(self):
+        responses = await asyncio.gather(
+            *(self.proxy('a.png') for _ in range(5)))
+        self.assertEqual(self.calls, 1)
+        for resp in responses:
+            self.assertEqual(resp.status, 200)
+            self.assertEqual(await resp.read(), PIXEL)
+            self.assertEqual(resp.content_type, 'image/png')
+            self.assertIn('max-age', resp.headers['Cache-Control'])
+
+        resp = await self.proxy('a.png')
+        self.assertEqual(self.calls, 1)
+        resp = await self.client.get('/image', params={
+            'url': str(self.client.make_url('/origin/a.png')),
+        }, headers={'If-None-Match': resp.headers['ETag']})
+        self.assertEqual(resp.status, 304)
+
+    @unittest_run_loop
+    async def test_lru_eviction(self):
+        for name in ('a', 'b', 'a', 'c'):
+            resp = await self.proxy(name + '.png')
+            self.assertEqual(resp.status, 200)
+        self.assertEqual(self.calls, 3)
+        # b was the least recently used
+        self.assertEqual(len(os.listdir(self.cache_dir)), 2)
+        await self.proxy('a.png')
+        self.assertEqual(self.calls, 3)
+        await self.proxy('b.png')
+        self.assertEqual(self.calls, 4)
+
+    @unittest_run_loop
+    async def test_sizes(self):
+        resp = await self.proxy('a.png', size='40')
+        self.assertEqual(resp.status, 200)
+        # already smaller than every variant, so the original is served
+        self.assertEqual(await resp.read(), PIXEL)
+        self.assertTrue(resp.headers['ETag'].endswith('-orig"'))
+        resp = await self.proxy('a.png', size='big')
+        self.assertEqual(resp.status, 400)
+
+    def test_resized_variants(self):
+        image = images.Image.new('RGB', (256, 256), 'red')
+        encoded = io.BytesIO()
+        image.save(encoded, 'PNG')
+        variants = images.resize_image(
+            encoded.getvalue(), '.png', [32, 64, 128], 1 << 20)
+        self.assertEqual(sorted(variants), [32, 64, 128])
+        self.assertEqual(
+            images.Image.open(io.BytesIO(variants[64])).size, (64, 64))
+
+    def test_load_index_keeps_other_files(self):
+        key = 'ab' * 32
+        names = {
+            'notes.txt': b'mine',
+            'a.b.c': b'mine',
+            key + '.orig.png': PIXEL,
+            # being written by another worker
+            key + '.64.png.tmp': PIXEL,
+            # left behind by a crash
+            'cd' * 32 + '.orig.png.tmp': PIXEL,
+        }
+        for name, data in names.items():
+            with open(os.path.join(self.cache_dir, name), 'wb') as f:
+                f.write(data)
+        stale = os.path.join(self.cache_dir, 'cd' * 32 + '.orig.png.tmp')
+        os.utime(stale, (0, 0))
+
+        handler = ImageProxyHandler(cache_dir=self.cache_dir)
+        handler.load_index()
+        self.assertEqual(list(handler.index), [key])
+        self.assertEqual(sorted(os.listdir(self.cache_dir)), sorted(
+            name for name in names if not name.startswith('cd')))
+
+    @unittest_run_loop
+    async def test_refused(self):
+        resp = await self.client.get('/image')
+        self.assertEqual(resp.status, 400)
+        resp = await self.client.get(
+            '/image', params={'url': 'http://169.254.169.254/latest'})
+        self.assertEqual(resp.status, 403)
+        resp = await self.client.get(
+            '/image', params={'url': 'file:///etc/passwd'})
+        self.assertEqual(resp.status, 403)
+        resp = await self.proxy('page.html')
+        self.assertEqual(resp.status, 502)
+        resp = await self.proxy('moved.png')
+        self.assertEqual(resp.status, 502)
+
+
+if __name__ == '__main__':
+    unittest.main()
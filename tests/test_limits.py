@@ -0,0 +1,43 @@
+import unittest
+
+from alignment.limits import TokenBucket, validate_update
+
+
+class TokenBucketTest(unittest.TestCase):
+    def test_rate_and_burst(self):
+        now = [0]
+        bucket = TokenBucket(rate=10, burst=5, clock=lambda: now[0])
+        self.assertEqual([bucket.consume() for _ in range(6)],
+                         [True] * 5 + [False])
+        now[0] += 0.2
+        self.assertTrue(bucket.consume(2))
+        self.assertFalse(bucket.consume())
+        # never more than a burst banked up
+        now[0] += 100
+        self.assertTrue(bucket.consume(5))
+        self.assertFalse(bucket.consume())
+
+
+class ValidateUpdateTest(unittest.TestCase):
+    def test_valid(self):
+        for update in (
+                {'user': {'id': '1', 'username': 'a'},
+                 'position': {'x': 1, 'y': 2.5}},
+                {'userID': 7, 'position': {'x': 0, 'y': 0}, 'extra': []}):
+            self.assertIsNone(validate_update(update))
+
+    def test_invalid(self):
+        for update in (
+                [], 'x', {},
+                {'user': 'me', 'position': {'x': 1, 'y': 1}},
+                {'user': {'id': None}, 'position': {'x': 1, 'y': 1}},
+                {'user': {'id': 'x' * 1000}, 'position': {'x': 1, 'y': 1}},
+                {'user': {'id': '1'}},
+                {'user': {'id': '1'}, 'position': {'x': '1', 'y': 1}},
+                {'user': {'id': '1'}, 'position': {'x': float('nan'), 'y': 1}},
+                {'user': {'id': '1'}, 'position': {'x': True, 'y': 1}}):
+            self.assertIsNotNone(validate_update(update), update)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,95 @@
+import unittest
+
+from aiohttp.test_utils import AioHTTPTestCase, unittest_run_loop
+from aiohttp import web
+
+from alignment import metrics
+from alignment.bus import LocalBus
+from alignment.metrics import Counter, Gauge, Histogram, MetricsHandler, Registry
+from alignment.websocket import WebsocketHandler
+
+
+class RegistryTest(unittest.TestCase):
+    def test_render(self):
+        registry = Registry()
+        counter = registry.register(Counter('c_total', 'A counter', ['room']))
+        gauge = registry.register(Gauge('g', 'A gauge'))
+        histogram = registry.register(
+            Histogram('h_seconds', 'A histogram', buckets=(0.1, 1)))
+        counter.inc(labels=('a"b',))
+        counter.inc(2, labels=('a"b',))
+        gauge.set(5)
+        gauge.dec()
+        histogram.observe(0.05)
+        histogram.observe(0.5)
+        histogram.observe(3)
+
+        self.assertEqual(registry.render().splitlines(), [
+            '# HELP c_total A counter',
+            '# TYPE c_total counter',
+            'c_total{room="a\\"b"} 3',
+            '# HELP g A gauge',
+            '# TYPE g gauge',
+            'g 4',
+            '# HELP h_seconds A histogram',
+            '# TYPE h_seconds histogram',
+            'h_seconds_bucket{le="0.1"} 1',
+            'h_seconds_bucket{le="1"} 2',
+            'h_seconds_bucket{le="+Inf"} 3',
+            'h_seconds_sum 3.55',
+            'h_seconds_count 3',
+        ])
+
+    def test_function(self):
+        registry = Registry()
+        counter = registry.register(Counter('c_total', 'A counter'))
+        registry.register(Gauge('g', 'A gauge', ['room']))
+        counter.set_function(lambda: 7)
+        self.assertEqual(registry.render().splitlines(), [
+            '# HELP c_total A counter',
+            '# TYPE c_total counter',
+            'c_total 7',
+            '# HELP g A gauge',
+            '# TYPE g gauge',
+        ])
+
+
+class MetricsHandlerTest(AioHTTPTestCase):
+    async def get_application(self):
+        app = web.Application()
+        MetricsHandler(trace=True).setup(app)
+        LocalBus().setup(app)
+        WebsocketHandler().setup(app)
+        return app
+
+    def tearDown(self):
+        super().tearDown()
+        metrics.TRACING = False
+
+    @unittest_run_loop
+    async def test_metrics(self):
+        url = self.client.make_url('/ws?sid=1&room=metrics-room')
+        async with self.client.session.ws_connect(url) as ws1:
+            async with self.client.session.ws_connect(
+                    url.with_query(sid=2, room='metrics-room')) as ws2:
+                await ws1.send_json(
+                    {'user': {'id': '1'}, 'position': {'x': 1, 'y': 2}})
+                await ws2.receive_json(timeout=5)
+                resp = await self.client.request('GET', '/metrics')
+                self.assertEqual(resp.status, 200)
+                text = await resp.text()
+
+        self.assertIn('alignment_websockets_open 2', text)
+        self.assertIn('alignment_websocket_dropped_total 0', text)
+        self.assertIn('alignment_fanout_seconds_count', text)
+        self.assertIn('alignment_bus_lag_seconds_count{subscriber="fanout"}',
+                      text)
+
+        resp = await self.client.request('GET', '/metrics')
+        self.assertIn('alignment_http_request_seconds_count{'
+                      'method="GET",route="/metrics",status="200"}',
+                      await resp.text())
+
+
+if __name__ == "__main__":
+    unittest.main()
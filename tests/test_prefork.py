@@ -0,0 +1,94 @@
+import os
+import signal
+import socket
+import time
+import unittest
+import multiprocessing
+
+from alignment.prefork import Supervisor
+
+
+def serve_pid(sock):
+    """Answer every connection with this worker's pid"""
+    while True:
+        conn, _addr = sock.accept()
+        with conn:
+            conn.sendall(str(os.getpid()).encode())
+
+
+def serve_stubbornly(sock):
+    """Like serve_pid, but ignore SIGTERM"""
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    serve_pid(sock)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class SupervisorTest(unittest.TestCase):
+    target = staticmethod(serve_pid)
+    shutdown_timeout = 5
+
+    def setUp(self):
+        self.port = free_port()
+        supervisor = Supervisor(self.target, 2, host='127.0.0.1',
+                                port=self.port,
+                                shutdown_timeout=self.shutdown_timeout,
+                                restart_delay=0.1)
+        self.process = multiprocessing.Process(target=supervisor.run)
+        self.process.start()
+
+    def tearDown(self):
+        if self.process.is_alive():
+            self.process.terminate()
+        self.process.join(10)
+
+    def worker_pid(self):
+        for _ in range(50):
+            try:
+                with socket.create_connection(('127.0.0.1', self.port), 1) as conn:
+                    return int(conn.recv(32))
+            except (OSError, ValueError):
+                time.sleep(0.1)
+        self.fail('no worker answered')
+
+    def test_workers_share_port(self):
+        pids = {self.worker_pid() for _ in range(20)}
+        self.assertTrue(pids)
+        self.assertNotIn(self.process.pid, pids)
+
+    def test_restart_and_stop(self):
+        crashed = self.worker_pid()
+        os.kill(crashed, signal.SIGKILL)
+        time.sleep(0.5)
+        pids = {self.worker_pid() for _ in range(20)}
+        self.assertNotIn(crashed, pids)
+
+        os.kill(self.process.pid, signal.SIGTERM)
+        self.process.join(10)
+        self.assertEqual(self.process.exitcode, 0)
+        for pid in pids:
+            with self.assertRaises(ProcessLookupError):
+                os.kill(pid, 0)
+
+
+class StubbornSupervisorTest(SupervisorTest):
+    target = staticmethod(serve_stubbornly)
+    # not whole seconds, as a timeout derived from DRAIN_TIMEOUT may be
+    shutdown_timeout = 0.5
+
+    def test_kill_after_timeout(self):
+        pids = {self.worker_pid() for _ in range(20)}
+        os.kill(self.process.pid, signal.SIGTERM)
+        self.process.join(10)
+        self.assertEqual(self.process.exitcode, 0)
+        for pid in pids:
+            with self.assertRaises(ProcessLookupError):
+                os.kill(pid, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,34 @@
+import unittest
+from collections import Counter
+
+from alignment.redis import HashRing
+
+
+class HashRingTest(unittest.TestCase):
+    def test_spread(self):
+        nodes = ['redis://a', 'redis://b', 'redis://c']
+        ring = HashRing(nodes)
+        counts = Counter(ring.get('room{}'.format(i)) for i in range(3000))
+        self.assertEqual(set(counts), set(nodes))
+        for node in nodes:
+            self.assertGreater(counts[node], 700)
+
+    def test_stable(self):
+        ring = HashRing(['redis://a', 'redis://b'])
+        again = HashRing(['redis://b', 'redis://a'])
+        for i in range(100):
+            room = 'room{}'.format(i)
+            self.assertEqual(ring.get(room), again.get(room))
+
+    def test_add_node(self):
+        rooms = ['room{}'.format(i) for i in range(3000)]
+        before = HashRing(['redis://a', 'redis://b', 'redis://c'])
+        after = HashRing(['redis://a', 'redis://b', 'redis://c', 'redis://d'])
+        moved = [room for room in rooms if before.get(room) != after.get(room)]
+        # only rooms now on the new node move, about a quarter of them
+        self.assertTrue(all(after.get(room) == 'redis://d' for room in moved))
+        self.assertLess(len(moved), len(rooms) * 0.35)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,58 @@
+import unittest
+
+import asyncio
+
+from alignment.sendqueue import (SendQueue, QueueOverflow, DROP_OLDEST,
+                                 COALESCE, DISCONNECT)
+
+
+class SendQueueTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.close()
+
+    def drain(self, queue):
+        async def drain():
+            return [await queue.get() for _ in range(len(queue))]
+        return self.loop.run_until_complete(drain())
+
+    def test_unknown_policy(self):
+        with self.assertRaises(ValueError):
+            SendQueue(policy='shrug', loop=self.loop)
+
+    def test_drop_oldest(self):
+        queue = SendQueue(maxsize=2, policy=DROP_OLDEST, loop=self.loop)
+        for i in range(4):
+            queue.put(i)
+        self.assertEqual(queue.dropped, 2)
+        self.assertEqual(self.drain(queue), [2, 3])
+
+    def test_coalesce(self):
+        queue = SendQueue(maxsize=2, policy=COALESCE, loop=self.loop)
+        queue.put('a1', key='a')
+        queue.put('b1', key='b')
+        queue.put('a2', key='a')
+        self.assertEqual(queue.coalesced, 1)
+        self.assertEqual(queue.dropped, 0)
+        queue.put('c1', key='c')
+        self.assertEqual(queue.dropped, 1)
+        self.assertEqual(self.drain(queue), ['b1', 'c1'])
+
+    def test_disconnect(self):
+        queue = SendQueue(maxsize=1, policy=DISCONNECT, loop=self.loop)
+        queue.put('a')
+        with self.assertRaises(QueueOverflow):
+            queue.put('b')
+
+    def test_get_waits_for_put(self):
+        queue = SendQueue(loop=self.loop)
+        self.loop.call_later(0.01, queue.put, 'late')
+        got = self.loop.run_until_complete(
+            asyncio.wait_for(queue.get(), 1, loop=self.loop))
+        self.assertEqual(got, 'late')
+
+
+if __name__ == "__main__":
+    unittest.main()
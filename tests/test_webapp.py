@@ -0,0 +1,90 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from aiohttp.test_utils import AioHTTPTestCase, unittest_run_loop
+from aiohttp import web
+
+from alignment.webapp import WebappHandler, IMMUTABLE, REVALIDATE
+
+
+class WebappTest(AioHTTPTestCase):
+    script = b'console.log("hello, world");\n' * 100
+
+    def setUp(self):
+        self.build_dir = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.build_dir, 'static', 'js'))
+        self.write('index.html', b'<html><body>alignment</body></html>')
+        self.write('static/js/main.0123abcd.js', self.script)
+        self.write('static/js/large.0123abcd.js', self.script * 10)
+        super().setUp()
+
+    def tearDown(self):
+        super().tearDown()
+        shutil.rmtree(self.build_dir)
+
+    def write(self, name, data):
+        with open(os.path.join(self.build_dir, name), 'wb') as f:
+            f.write(data)
+
+    async def get_application(self):
+        app = web.Application()
+        WebappHandler(
+            build_dir=self.build_dir,
+            sendfile_size=len(self.script) * 2).setup(app)
+        return app
+
+    @unittest_run_loop
+    async def test_app_shell(self):
+        resp = await self.client.get('/app/room/abc')
+        self.assertEqual(resp.status, 200)
+        self.assertEqual(resp.headers['Cache-Control'], REVALIDATE)
+        self.assertIn('alignment', await resp.text())
+
+        resp = await self.client.get(
+            '/app', headers={'If-None-Match': resp.headers['ETag']})
+        self.assertEqual(resp.status, 304)
+
+    @unittest_run_loop
+    async def test_compressed_fingerprinted_asset(self):
+        resp = await self.client.get(
+            '/static/js/main.0123abcd.js',
+            headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(resp.status, 200)
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(resp.headers['Cache-Control'], IMMUTABLE)
+        self.assertEqual(resp.headers['Vary'], 'Accept-Encoding')
+        # decompressed by the client
+        self.assertEqual(await resp.read(), self.script)
+        etag = resp.headers['ETag']
+
+        resp = await self.client.get(
+            '/static/js/main.0123abcd.js',
+            headers={'Accept-Encoding': 'gzip;q=0, identity'})
+        self.assertNotIn('Content-Encoding', resp.headers)
+        self.assertNotEqual(resp.headers['ETag'], etag)
+        self.assertEqual(await resp.read(), self.script)
+
+        resp = await self.client.get(
+            '/static/js/main.0123abcd.js',
+            headers={'Accept-Encoding': 'gzip', 'If-None-Match': etag})
+        self.assertEqual(resp.status, 304)
+
+    @unittest_run_loop
+    async def test_large_asset_from_disk(self):
+        resp = await self.client.get('/static/js/large.0123abcd.js')
+        self.assertEqual(resp.status, 200)
+        self.assertEqual(await resp.read(), self.script * 10)
+        self.assertIn('ETag', resp.headers)
+
+    @unittest_run_loop
+    async def test_missing_asset(self):
+        resp = await self.client.get('/static/js/../../index.html')
+        self.assertEqual(resp.status, 404)
+        resp = await self.client.get('/static/nope.js')
+        self.assertEqual(resp.status, 404)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,15 +1,22 @@
 import unittest
 import uuid
 
+import asyncio
+
 from aiohttp.test_utils import AioHTTPTestCase, unittest_run_loop
-from aiohttp import web
+from aiohttp import web, WSCloseCode, WSMsgType
 
 
+from alignment import binary, envelope
+from alignment.bus import LocalBus, RedisBus
 from alignment.redis import RedisPool
+from alignment.replay import LocalReplayLog, RedisReplayLog
 from alignment.websocket import WebsocketHandler
+from redis_util import cleanup_redis_ns
 
 
 class WebsocketTest(AioHTTPTestCase):
+    prefix = 'test_ws:'
     example_data = {
         "user": {
             "username": "stillinbeta",
@@ -27,11 +34,15 @@ class WebsocketTest(AioHTTPTestCase):
     async def get_application(self):
         app = web.Application()
         redis = RedisPool(redis_url='redis://localhost')
-        websocket = WebsocketHandler()
+        websocket = WebsocketHandler(room_prefix=self.prefix)
         redis.setup(app)
+        RedisBus().setup(app)
         websocket.setup(app)
         return app
 
+    async def tearDownAsync(self):
+        await cleanup_redis_ns(self.prefix)
+
     def ws(self, id_=1):
         return self.client.make_url('/ws?sid={}'.format(id_))
 
@@ -53,6 +64,370 @@ class WebsocketTest(AioHTTPTestCase):
                 recieved = await ws2.receive_json(timeout=5)
                 self.assertEqual(recieved, self.example_data)
 
+    @unittest_run_loop
+    async def test_stats(self):
+        async with self.client.session.ws_connect(self.ws()) as ws:
+            resp = await self.client.get('/ws/stats')
+            self.assertEqual(resp.status, 200)
+            stats = await resp.json()
+            self.assertEqual(stats['connections'], 1)
+            self.assertEqual(stats['dropped'], 0)
+            await ws.close()
+
+    @unittest_run_loop
+    async def test_binary_protocol(self):
+        async with self.client.session.ws_connect(
+                self.ws(), protocols=(binary.PROTOCOL,)) as ws1:
+            async with self.client.session.ws_connect(self.ws(2)) as ws2:
+                self.assertIn('users', await ws1.receive_json(timeout=5))
+                user = self.example_data['user']
+                await ws1.send_json({'register': [user]})
+                handles = await ws1.receive_json(timeout=5)
+                handle = handles['handles'][user['id']]
+
+                await ws1.send_bytes(binary.pack(handle, 100, 205))
+                recieved = await ws2.receive_json(timeout=5)
+                self.assertEqual(recieved, self.example_data)
+
+                await ws2.send_json(self.example_data)
+                msg = await ws1.receive(timeout=5)
+                self.assertEqual(
+                    binary.unpack(msg.data), [(handle, 100, 205)])
+
+    @unittest_run_loop
+    async def test_snapshot_on_join(self):
+        room = str(uuid.uuid4())
+
+        def url(id_, **query):
+            return self.client.make_url('/ws').with_query(
+                sid=id_, room=room, **query)
+
+        async with self.client.session.ws_connect(
+                url(1, snapshot=1)) as ws1:
+            self.assertEqual(await ws1.receive_json(timeout=5), {'room': {
+                'image': None, 'size': 128, 'positions': []}})
+            async with self.client.session.ws_connect(url(2)) as ws2:
+                await ws1.send_json(self.example_data)
+                await ws2.receive_json(timeout=5)
+                async with self.client.session.ws_connect(
+                        url(3, snapshot=1)) as ws3:
+                    snapshot = await ws3.receive_json(timeout=5)
+                    self.assertEqual(
+                        snapshot['room']['positions'], [self.example_data])
+
+
+class LocalBusWebsocketTest(WebsocketTest):
+    """The same tests, in-process and without a Redis server"""
+
+    async def get_application(self):
+        app = web.Application()
+        self.websocket = WebsocketHandler()
+        LocalBus().setup(app)
+        self.websocket.setup(app)
+        return app
+
+    async def tearDownAsync(self):
+        pass
+
+    @unittest_run_loop
+    async def test_users_forgotten_when_room_empties(self):
+        user = self.example_data['user']
+        async with self.client.session.ws_connect(
+                self.ws(), protocols=(binary.PROTOCOL,)) as ws:
+            await ws.receive_json(timeout=5)
+            await ws.send_json({'register': [user]})
+            await ws.receive_json(timeout=5)
+        # the server notices the close asynchronously
+        for _ in range(50):
+            if 'default' not in self.app[WebsocketHandler.WEBSOCKET_KEY]:
+                break
+            await asyncio.sleep(0.05)
+        registry = self.websocket.user_registry
+        self.assertEqual(registry.users('default'), {})
+        self.assertIsNone(registry.handle('default', user['id']))
+
+
+class ShardedWebsocketTest(WebsocketTest):
+    async def get_application(self):
+        app = web.Application()
+        redis = RedisPool(redis_url='redis://localhost')
+        websocket = WebsocketHandler(room_prefix=self.prefix, sharded=True)
+        redis.setup(app)
+        RedisBus().setup(app)
+        websocket.setup(app)
+        return app
+
+    def ws(self, id_=1, room='default'):
+        return self.client.make_url('/ws').with_query(sid=id_, room=room)
+
+    @unittest_run_loop
+    async def test_other_room_not_recieved(self):
+        async with self.client.session.ws_connect(self.ws(1, 'a')) as ws1:
+            async with self.client.session.ws_connect(self.ws(2, 'b')) as ws2:
+                async with self.client.session.ws_connect(
+                        self.ws(3, 'a')) as ws3:
+                    await ws1.send_json(self.example_data)
+                    recieved = await ws3.receive_json(timeout=5)
+                    self.assertEqual(recieved, self.example_data)
+                    with self.assertRaises(asyncio.TimeoutError):
+                        await ws2.receive_json(timeout=0.5)
+
+    @unittest_run_loop
+    async def test_unsubscribe_when_room_empty(self):
+        async with self.client.session.ws_connect(self.ws(1, 'a')) as ws:
+            await ws.send_json(self.example_data)
+            self.assertIn(
+                'a', self.app[WebsocketHandler.SUBSCRIPTIONS_KEY])
+        # the server notices the close asynchronously
+        for _ in range(50):
+            if not self.app[WebsocketHandler.SUBSCRIPTIONS_KEY]:
+                break
+            await asyncio.sleep(0.05)
+        self.assertEqual(self.app[WebsocketHandler.SUBSCRIPTIONS_KEY], set())
+        self.assertNotIn('a', self.app[WebsocketHandler.WEBSOCKET_KEY])
+
+
+class TickWebsocketTest(AioHTTPTestCase):
+    def update(self, user_id, x):
+        return {'user': {'id': user_id}, 'position': {'x': x, 'y': 0}}
+
+    async def get_application(self):
+        app = web.Application()
+        redis = RedisPool(redis_url='redis://localhost')
+        # ticks are driven by the test, so no batch straddles two of them
+        self.websocket = WebsocketHandler(tick_ms=3600 * 1000)
+        redis.setup(app)
+        RedisBus().setup(app)
+        self.websocket.setup(app)
+        return app
+
+    def ws(self, id_=1):
+        return self.client.make_url('/ws?sid={}'.format(id_))
+
+    @unittest_run_loop
+    async def test_latest_wins_batch(self):
+        async with self.client.session.ws_connect(self.ws()) as ws1:
+            async with self.client.session.ws_connect(self.ws(2)) as ws2:
+                for x in range(10):
+                    await ws1.send_json(self.update('a', x))
+                await ws1.send_json(self.update('b', 1))
+                # the server reads a websocket's messages in order
+                for _ in range(50):
+                    if 'b' in self.websocket.pending.get('default', ()):
+                        break
+                    await asyncio.sleep(0.05)
+                await self.websocket.flush_pending(self.app)
+                recieved = await ws2.receive_json(timeout=5)
+                self.assertEqual(
+                    recieved, [self.update('a', 9), self.update('b', 1)])
+
+
+class ReplayWebsocketTest(AioHTTPTestCase):
+    prefix = 'test_replay:'
+
+    async def get_application(self):
+        app = web.Application()
+        redis = RedisPool(redis_url='redis://localhost')
+        websocket = WebsocketHandler(
+            room_prefix=self.prefix,
+            replay_log=RedisReplayLog(size=3, key_prefix=self.prefix))
+        redis.setup(app)
+        RedisBus().setup(app)
+        websocket.setup(app)
+        return app
+
+    async def tearDownAsync(self):
+        await cleanup_redis_ns(self.prefix)
+
+    def setUp(self):
+        super().setUp()
+        self.room = str(uuid.uuid4())
+
+    def ws(self, id_, **query):
+        return self.client.make_url('/ws').with_query(
+            sid=id_, room=self.room, **query)
+
+    def update(self, x):
+        return {'user': {'id': '1'}, 'position': {'x': x, 'y': 0}}
+
+    @unittest_run_loop
+    async def test_resume(self):
+        async with self.client.session.ws_connect(self.ws(1)) as ws1:
+            async with self.client.session.ws_connect(
+                    self.ws(2, seq=1)) as ws2:
+                await ws1.send_json(self.update(1))
+                self.assertEqual(await ws2.receive_json(timeout=5), {
+                    'seq': 1, 'update': self.update(1)})
+            # missed while ws2 was away
+            await ws1.send_json(self.update(2))
+            await ws1.send_json(self.update(3))
+            async with self.client.session.ws_connect(
+                    self.ws(2, last_seq=1)) as ws2:
+                self.assertEqual(await ws2.receive_json(timeout=5), {
+                    'seq': 2, 'update': self.update(2)})
+                self.assertEqual(await ws2.receive_json(timeout=5), {
+                    'seq': 3, 'update': self.update(3)})
+                await ws1.send_json(self.update(4))
+                self.assertEqual(await ws2.receive_json(timeout=5), {
+                    'seq': 4, 'update': self.update(4)})
+
+    @unittest_run_loop
+    async def test_resume_too_far_behind(self):
+        async with self.client.session.ws_connect(self.ws(1)) as ws1:
+            # the snapshot makes this node keep the room's state
+            async with self.client.session.ws_connect(
+                    self.ws(2, seq=1, snapshot=1)) as ws2:
+                self.assertIn('room', await ws2.receive_json(timeout=5))
+                for x in range(5):
+                    await ws1.send_json(self.update(x))
+                for _ in range(5):
+                    await ws2.receive_json(timeout=5)
+                async with self.client.session.ws_connect(
+                        self.ws(3, last_seq=0)) as ws3:
+                    snapshot = await ws3.receive_json(timeout=5)
+                    self.assertEqual(snapshot['seq'], 5)
+                    self.assertEqual(
+                        snapshot['room']['positions'], [self.update(4)])
+
+    @unittest_run_loop
+    async def test_cold_snapshot_includes_logged(self):
+        async with self.client.session.ws_connect(self.ws(1)) as ws1:
+            # nothing persists these, so only the log has them
+            await ws1.send_json(self.update(1))
+            await ws1.send_json(self.update(2))
+            await asyncio.sleep(0.1)
+            async with self.client.session.ws_connect(
+                    self.ws(2, seq=1, snapshot=1)) as ws2:
+                snapshot = await ws2.receive_json(timeout=5)
+                self.assertEqual(snapshot['seq'], 2)
+                self.assertEqual(
+                    snapshot['room']['positions'], [self.update(2)])
+
+    @unittest_run_loop
+    async def test_unsequenced_clients(self):
+        async with self.client.session.ws_connect(self.ws(1)) as ws1:
+            async with self.client.session.ws_connect(self.ws(2)) as ws2:
+                await ws1.send_json(self.update(1))
+                self.assertEqual(
+                    await ws2.receive_json(timeout=5), self.update(1))
+
+
+class LocalReplayWebsocketTest(ReplayWebsocketTest):
+    async def get_application(self):
+        app = web.Application()
+        LocalBus().setup(app)
+        WebsocketHandler(replay_log=LocalReplayLog(size=3)).setup(app)
+        return app
+
+    async def tearDownAsync(self):
+        pass
+
+    @unittest_run_loop
+    async def test_idle_rooms_expire(self):
+        replay = LocalReplayLog(ttl=0.1)
+        data = envelope.pack('idle', [envelope.Update('1', '1', '{}')])
+        await replay.publish(self.app, 'channel', 'idle', data)
+        self.assertEqual((await replay.recent(self.app, 'idle'))[0], 1)
+        await asyncio.sleep(0.2)
+        await replay.publish(self.app, 'channel', 'busy', data)
+        self.assertEqual(await replay.recent(self.app, 'idle'), (0, []))
+        self.assertEqual(list(replay._seqs), ['busy'])
+
+
+class DrainWebsocketTest(AioHTTPTestCase):
+    update = {'user': {'id': '1'}, 'position': {'x': 1, 'y': 1}}
+
+    async def get_application(self):
+        app = web.Application()
+        LocalBus().setup(app)
+        self.handler = WebsocketHandler(drain_timeout=5, reconnect_window=0.5)
+        self.handler.setup(app)
+        return app
+
+    def ws(self, id_):
+        return self.client.make_url('/ws').with_query(sid=id_)
+
+    @unittest_run_loop
+    async def test_drain(self):
+        async with self.client.session.ws_connect(self.ws(1)) as ws1, \
+                self.client.session.ws_connect(self.ws(2)) as ws2:
+            await ws1.send_json(self.update)
+            self.assertEqual(await ws2.receive_json(timeout=5), self.update)
+
+            drain = self.loop.create_task(self.handler.drain(self.app))
+            for ws in (ws1, ws2):
+                hint = await ws.receive_json(timeout=5)
+                self.assertLessEqual(hint['reconnect']['after'], 0.5)
+            # ws1 follows the hint, ws2 is closed by the server
+            await ws1.close()
+            msg = await ws2.receive(timeout=5)
+            self.assertEqual(msg.type, WSMsgType.CLOSE)
+            self.assertEqual(ws2.close_code, WSCloseCode.SERVICE_RESTART)
+            await asyncio.wait_for(drain, 5)
+
+        async with self.client.session.ws_connect(self.ws(3)) as ws3:
+            await ws3.receive(timeout=5)
+            self.assertEqual(ws3.close_code, WSCloseCode.SERVICE_RESTART)
+
+
+class LimitsWebsocketTest(AioHTTPTestCase):
+    def update(self, x):
+        return {'user': {'id': '1'}, 'position': {'x': x, 'y': 0}}
+
+    async def get_application(self):
+        app = web.Application()
+        LocalBus().setup(app)
+        WebsocketHandler(
+            rate=1, burst=2, max_room_connections=2, max_connections=3,
+            max_msg_size=1024).setup(app)
+        return app
+
+    def ws(self, id_, room='default'):
+        return self.client.make_url('/ws').with_query(sid=id_, room=room)
+
+    @unittest_run_loop
+    async def test_connection_caps(self):
+        async with self.client.session.ws_connect(self.ws(1)) as ws1, \
+                self.client.session.ws_connect(self.ws(2)) as ws2:
+            async with self.client.session.ws_connect(self.ws(3)) as ws3:
+                await ws3.receive(timeout=5)
+                self.assertEqual(ws3.close_code, WSCloseCode.TRY_AGAIN_LATER)
+            async with self.client.session.ws_connect(
+                    self.ws(3, 'other')) as ws3, \
+                    self.client.session.ws_connect(
+                        self.ws(4, 'other')) as ws4:
+                await ws4.receive(timeout=5)
+                self.assertEqual(ws4.close_code, WSCloseCode.TRY_AGAIN_LATER)
+                self.assertFalse(ws3.closed)
+            # the ones admitted first are left alone
+            self.assertFalse(ws1.closed)
+            self.assertFalse(ws2.closed)
+
+    @unittest_run_loop
+    async def test_rate_limit(self):
+        async with self.client.session.ws_connect(self.ws(1)) as ws1, \
+                self.client.session.ws_connect(self.ws(2)) as ws2:
+            for x in range(10):
+                await ws1.send_json(self.update(x))
+            self.assertEqual(await ws2.receive_json(timeout=5), self.update(0))
+            self.assertEqual(await ws2.receive_json(timeout=5), self.update(1))
+            with self.assertRaises(asyncio.TimeoutError):
+                await ws2.receive_json(timeout=0.5)
+            await ws1.receive(timeout=5)
+            self.assertEqual(ws1.close_code, WSCloseCode.POLICY_VIOLATION)
+
+    @unittest_run_loop
+    async def test_invalid_and_oversized(self):
+        async with self.client.session.ws_connect(self.ws(1)) as ws1, \
+                self.client.session.ws_connect(self.ws(2)) as ws2:
+            await ws1.send_str('not json')
+            await ws1.send_json({'user': {'id': '1'}, 'position': 'nowhere'})
+            with self.assertRaises(asyncio.TimeoutError):
+                await ws2.receive_json(timeout=0.5)
+            await ws1.send_str(' ' * 2048)
+            await ws1.receive(timeout=5)
+            self.assertEqual(ws1.close_code, WSCloseCode.MESSAGE_TOO_BIG)
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -6,7 +6,9 @@ from aiohttp import web
 
 from alignment.websocket import WebsocketHandler
 from alignment.api import APIHandler
+from alignment.bus import RedisBus
 from alignment.redis import RedisPool
+from alignment.stream import UpdateStream
 from redis_util import cleanup_redis_ns
 
 
@@ -56,6 +58,7 @@ class IntegrationTest(AioHTTPTestCase):
         api = APIHandler(room_persist_prefix=self.prefix)
         ws = WebsocketHandler()
         redis.setup(app)
+        RedisBus().setup(app)
         api.setup(app)
         ws.setup(app)
         return app
@@ -86,5 +89,54 @@ class IntegrationTest(AioHTTPTestCase):
             })
 
 
+class DrainIntegrationTest(IntegrationTest):
+    async def get_application(self):
+        self.prefix = 'test_room:'
+
+        app = web.Application()
+        redis = RedisPool(redis_url='redis://localhost')
+        self.api = APIHandler(room_persist_prefix=self.prefix)
+        ws = WebsocketHandler(reconnect_window=0.5)
+        redis.setup(app)
+        RedisBus().setup(app)
+        # the API's shutdown hooks are registered first
+        self.api.setup(app)
+        ws.setup(app)
+        return app
+
+    @unittest_run_loop
+    async def test_persist_while_draining(self):
+        await self.api.room_store.create_room(
+            'draining', 'https://http.cat/503')
+        url = self.client.make_url(self.app.router['ws'].url_for()).with_query(
+            sid=1, room='draining')
+        async with self.client.session.ws_connect(url) as ws:
+            shutdown = self.loop.create_task(self.app.shutdown())
+            self.assertIn('reconnect', await ws.receive_json(timeout=5))
+            await ws.send_json(self.position_data[0])
+            await ws.close()
+            await asyncio.wait_for(shutdown, 10)
+
+        positions = [
+            p async for p in self.api.room_store.get_positions('draining')]
+        self.assertEqual(positions, self.position_data[:1])
+
+
+class StreamIntegrationTest(IntegrationTest):
+    async def get_application(self):
+        self.prefix = 'test_room:'
+
+        app = web.Application()
+        redis = RedisPool(redis_url='redis://localhost')
+        stream = UpdateStream(key=self.prefix + 'updates', block_ms=100)
+        api = APIHandler(room_persist_prefix=self.prefix, update_stream=stream)
+        ws = WebsocketHandler(update_stream=stream)
+        redis.setup(app)
+        RedisBus().setup(app)
+        api.setup(app)
+        ws.setup(app)
+        return app
+
+
 if __name__ == "__main__":
     unittest.main()